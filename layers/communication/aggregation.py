@@ -0,0 +1,128 @@
+"""
+.. _Aggregation:
+
+Aggregation
+===========
+Streaming average of the weights received by the chief of a federated process. Instead of keeping the weights of
+every worker until the end of the round, the chief keeps one float64 accumulator per variable, allocated once, and
+folds the weights of each worker into it as soon as they arrive. The memory of the chief does not grow with the number
+of workers and the average is ready when the last weights land.
+
+Weights sent uncompressed, neither quantized nor sparsified, are folded directly from the buffer they were received in.
+The others are first decompressed, dequantized or densified into a new buffer, which is freed once they are folded.
+The chief still needs several times the size of the model: with float32 weights the accumulators alone take
+twice the model, the messages being received up to SEND_RECEIVE_CONF.received_models more (see MUX_CONF.receive_budget),
+every decoded copy one more, and the averaged weights and the snapshot broadcast to the workers one each, so the chief
+peaks at about 4 to 5 times the model.
+
+The weights of an aggregator (see :ref:`Topology`) are already the average of several nodes and are added with the
+number of nodes as weight, so the result is the average of all the nodes.
+
+A round is opened with :meth:`StreamingAverage.start_round` and closed with :meth:`StreamingAverage.close`. Weights
+added after the round is closed, e.g., by a straggler, are ignored.
+
+:Example:
+>>> average = StreamingAverage(my_weights)
+>>> average.start_round(iteration)
+>>> average.add(my_weights, iteration, 'chief')
+>>> average.add(weights_of_worker1, iteration, 'worker1')
+>>> contributors = average.close()
+>>> averaged_weights = average.average()
+
+"""
+import threading
+import numpy as np
+
+
+class StreamingAverage:
+    """
+    Average of the weights of several nodes computed while they arrive
+
+    :param list templates: arrays with the shapes and dtypes of the variables of the model
+    """
+
+    def __init__(self, templates):
+        templates = [np.asarray(template) for template in templates]
+        self.shapes = [template.shape for template in templates]
+        self.dtypes = [template.dtype for template in templates]
+        self._accumulators = [np.zeros(shape, dtype=np.float64) for shape in self.shapes]
+        self._lock = threading.Lock()
+        self.round = None
+        self.open = False
+        self.count = 0
+        self.contributors = []
+
+    def start_round(self, iteration):
+        """
+        Open a new round and clear the accumulators
+
+        :param int iteration: iteration of the round
+        """
+        with self._lock:
+            for accumulator in self._accumulators:
+                accumulator.fill(0)
+            self.round = iteration
+            self.open = True
+            self.count = 0
+            self.contributors = []
+
+    def add(self, arrays, iteration, contributor=None, weight=1):
+        """
+        Fold the weights of a node into the accumulators
+
+        :param list arrays: weights of the node, with the shapes of the templates
+        :param int iteration: iteration in which the weights were sent
+        :param contributor: identifier of the node, e.g., its session
+        :param int,optional weight: number of nodes averaged in the weights
+        :return: False if the round of the weights is already closed
+        :rtype: bool
+
+        """
+        if len(arrays) != len(self._accumulators):
+            raise ValueError('expected {} arrays, received {}'.format(len(self._accumulators), len(arrays)))
+        for shape, array in zip(self.shapes, arrays):
+            if np.shape(array) != shape:
+                raise ValueError('expected an array of shape {}, received {}'.format(shape, np.shape(array)))
+        if weight < 1:
+            raise ValueError('the weights must average at least one node, not {}'.format(weight))
+        with self._lock:
+            if not self.open or iteration != self.round:
+                return False
+            for accumulator, array in zip(self._accumulators, arrays):
+                if weight == 1:
+                    np.add(accumulator, array, out=accumulator)
+                else:
+                    accumulator += np.multiply(array, weight, dtype=np.float64)
+            self.count += weight
+            self.contributors.append(contributor)
+            return True
+
+    def close(self):
+        """
+        Close the round, no more weights are added to it
+
+        :return: contributors of the round in the order their weights were added
+        :rtype: list
+
+        """
+        with self._lock:
+            self.open = False
+            return list(self.contributors)
+
+    def average(self):
+        """
+        Average of the weights added in the round, with the dtypes of the templates
+
+        :return: averaged weights
+        :rtype: list
+
+        """
+        with self._lock:
+            if self.count == 0:
+                raise ValueError('no weights were added in round {}'.format(self.round))
+            averaged = []
+            for accumulator, dtype in zip(self._accumulators, self.dtypes):
+                result = np.empty(accumulator.shape, dtype=dtype)
+                np.divide(accumulator, self.count, out=result, casting='unsafe')
+                averaged.append(result)
+            return averaged
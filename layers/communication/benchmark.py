@@ -0,0 +1,285 @@
+"""
+.. _Benchmark:
+
+Benchmark
+=========
+Loopback benchmark of the communication layer. For every message size and concurrency level the benchmark starts
+N receivers and M senders on 127.0.0.1, each sender sends its messages to one receiver, and the results are reported
+as JSON. Every case runs in a fresh process so the peak resident memory of one case does not hide the next one.
+
+Two transports can be measured:
+
+* p2p: :class:`layers.communication.p2p_com.Sender` and :class:`layers.communication.p2p_com.Receiver`
+* federated: the weight transport of :class:`layers.communication.federated_hook._FederatedHook` (signed numpy
+  arrays in the format of :ref:`Tensors` over the sessions of :ref:`Session`), without the transactions in the BSMD
+
+For each case the report has messages/s, MB/s, latency percentiles (from the start of a send until the receiver has
+the whole message), CPU time of the process and peak RSS. With --compression the transports negotiate a codec on
+each connection (see :ref:`Compression`). With --multiplexed the p2p senders share one connection per receiver
+(see :ref:`Mux`). With --tls the connections use the shared contexts of
+:ref:`TLS` and the report includes the TLS session resumption rates.
+
+:Example:
+>>> python3 -m layers.communication.benchmark --transport=p2p --sizes=100,1000000 --concurrency=1:1,4:8 \
+--output=p2p.json
+
+"""
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import resource
+import threading
+import time
+from absl import app
+from absl import flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_enum('transport', 'p2p', ['p2p', 'federated'], 'Transport to benchmark')
+flags.DEFINE_list('sizes', ['100', '1000', '10000', '100000', '1000000', '10000000', '100000000', '1000000000'],
+                  'Message sizes in bytes')
+flags.DEFINE_list('concurrency', ['1:1', '1:4', '4:4'], 'Concurrency levels as receivers:senders')
+flags.DEFINE_integer('messages', 200, 'Maximum number of messages per sender')
+flags.DEFINE_float('budget', 2e9, 'Maximum number of bytes sent by each sender in a case')
+flags.DEFINE_string('output', None, 'File for the JSON report, by default the report is printed')
+flags.DEFINE_boolean('tls', False, 'Protect the connections with the shared TLS contexts')
+flags.DEFINE_string('cert_path', None, 'Certificate used with --tls, by default SSL_CONF.cert_path')
+flags.DEFINE_string('key_path', None, 'Private key used with --tls, by default SSL_CONF.key_path')
+flags.DEFINE_boolean('compression', False, 'Negotiate the compression of the payloads')
+flags.DEFINE_boolean('multiplexed', False, 'Send the p2p messages on streams of one connection per peer')
+
+BENCHMARK_HOST = '127.0.0.1'
+
+
+def percentile(values, q):
+    """
+    Nearest rank percentile
+
+    :param list[float] values: measured values
+    :param float q: percentile between 0 and 100
+    :return: the percentile of the values
+    :rtype: float
+
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(math.ceil(q / 100.0 * len(ordered))) - 1, 0)
+    return ordered[rank]
+
+
+def _run_p2p(size, receivers, senders, messages, tls, compression, multiplexed):
+    """
+    Run one case of the p2p transport
+
+    :return: latencies of all messages and seconds spent by the senders
+    :rtype: tuple(list[float], float)
+
+    """
+    from layers.communication.p2p_com import Receiver, Sender
+
+    def on_message(client_address, message):
+        pass
+
+    listeners = [Receiver(BENCHMARK_HOST, 0, on_message, tls, compression, multiplexed) for _ in range(receivers)]
+    for listener in listeners:
+        listener.daemon = True
+        listener.start()
+        listener.listening.wait()
+
+    payload = 'x' * size
+    latencies = [[] for _ in range(senders)]
+
+    def send(index):
+        listener = listeners[index % receivers]
+        sender = Sender(BENCHMARK_HOST, listener.port, tls, compression, multiplexed)
+        for _ in range(messages):
+            start = time.perf_counter()
+            sender.send(payload)
+            latencies[index].append(time.perf_counter() - start)
+
+    elapsed = _run_senders(send, senders)
+    for listener in listeners:
+        listener.stop()
+    for listener in listeners:
+        listener.join()
+    return [latency for sender_latencies in latencies for latency in sender_latencies], elapsed
+
+
+def _run_federated(size, receivers, senders, messages, tls, compression, multiplexed):
+    """
+    Run one case of the federated weight transport
+
+    :return: latencies of all messages and seconds spent by the senders
+    :rtype: tuple(list[float], float)
+
+    """
+    import numpy as np
+    from layers.communication.federated_hook import _FederatedHook, SEND_RECEIVE_CONF
+    from layers.communication.tensors import encode, decode
+    from layers.communication.session import SessionServer, WorkerSession
+
+    servers = [SessionServer(BENCHMARK_HOST, 0, SEND_RECEIVE_CONF.key, tls, compression, _FederatedHook._new_verifier)
+               for _ in range(receivers)]
+    for server in servers:
+        server.start()
+
+    def serve(server, name):
+        session = server.session(name, timeout=60)
+        for _ in range(messages):
+            decode(_FederatedHook._receiving_subroutine(session))
+
+    arrays = [np.ones(max(size // 4, 1), dtype=np.float32)]
+    latencies = [[] for _ in range(senders)]
+    serving = []
+
+    def send(index):
+        server = servers[index % receivers]
+        name = 'sender{}'.format(index)
+        session = WorkerSession(BENCHMARK_HOST, server.port, name, SEND_RECEIVE_CONF.key, tls, compression)
+        session.connect()
+        for _ in range(messages):
+            start = time.perf_counter()
+            _FederatedHook._sending_subroutine(encode(arrays, sender='benchmark'), session)
+            latencies[index].append(time.perf_counter() - start)
+        session.close()
+
+    # each sender has its own session with a receiver
+    for index in range(senders):
+        thread = threading.Thread(target=serve, args=(servers[index % receivers], 'sender{}'.format(index)),
+                                  daemon=True)
+        thread.start()
+        serving.append(thread)
+
+    elapsed = _run_senders(send, senders)
+    for thread in serving:
+        thread.join()
+    for server in servers:
+        server.stop()
+    return [latency for sender_latencies in latencies for latency in sender_latencies], elapsed
+
+
+def _run_senders(send, senders):
+    """
+    Run the senders in parallel and wait for all of them
+
+    :param function send: function called with the index of the sender
+    :param int senders: number of senders
+    :return: seconds from the start of the first sender until the end of the last one
+    :rtype: float
+
+    """
+    threads = [threading.Thread(target=send, args=(index,)) for index in range(senders)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+TRANSPORTS = {'p2p': _run_p2p, 'federated': _run_federated}
+
+
+def run_case(transport, size, receivers, senders, messages, tls=None, compression=False, multiplexed=False):
+    """
+    Run one case of the benchmark and measure it
+
+    :param str transport: name of the transport, p2p or federated
+    :param int size: size of the messages in bytes
+    :param int receivers: number of receivers
+    :param int senders: number of senders
+    :param int messages: number of messages sent by each sender
+    :param tuple(str, str),optional tls: certificate and private key paths to protect the connections with TLS
+    :param bool,optional compression: negotiate the compression of the payloads
+    :param bool,optional multiplexed: share one connection per peer between the senders
+    :return: measures of the case
+    :rtype: dict
+
+    """
+    if tls is not None:
+        from layers.communication.tls import SSL_CONF
+        SSL_CONF.cert_path, SSL_CONF.key_path = tls
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    # the transports print every message, keep the report clean
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        latencies, elapsed = TRANSPORTS[transport](size, receivers, senders, messages, tls is not None,
+                                                       compression, multiplexed)
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    total_messages = len(latencies)
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    result = {'transport': transport,
+              'size': size,
+              'receivers': receivers,
+              'senders': senders,
+              'messages': total_messages,
+              'seconds': elapsed,
+              'messages_per_second': total_messages / elapsed,
+              'mb_per_second': total_messages * size / elapsed / 1e6,
+              'latency_p50': percentile(latencies, 50),
+              'latency_p99': percentile(latencies, 99),
+              'latency_max': max(latencies),
+              'cpu_seconds': cpu,
+              # ru_maxrss is in kilobytes on Linux
+              'peak_rss_mb': usage_end.ru_maxrss / 1024.0}
+    if tls is not None:
+        from layers.communication.tls import tls_statistics
+        result['tls'] = tls_statistics()
+    return result
+
+
+def run_sweep(transport, sizes, concurrency, messages, budget, tls=None, compression=False, multiplexed=False):
+    """
+    Run every combination of message size and concurrency level, each one in a new process
+
+    :param str transport: name of the transport, p2p or federated
+    :param list[int] sizes: sizes of the messages in bytes
+    :param list[tuple(int, int)] concurrency: pairs of receivers and senders
+    :param int messages: maximum number of messages per sender
+    :param float budget: maximum number of bytes sent by each sender in a case
+    :param tuple(str, str),optional tls: certificate and private key paths to protect the connections with TLS
+    :param bool,optional compression: negotiate the compression of the payloads
+    :param bool,optional multiplexed: share one connection per peer between the senders
+    :return: measures of all the cases
+    :rtype: list[dict]
+
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in sizes:
+        count = max(1, min(messages, int(budget // size)))
+        for receivers, senders in concurrency:
+            with context.Pool(processes=1) as pool:
+                result = pool.apply(run_case, (transport, size, receivers, senders, count, tls, compression,
+                                                multiplexed))
+            print('{transport} size={size} receivers={receivers} senders={senders}: '
+                  '{messages_per_second:.1f} msg/s, {mb_per_second:.2f} MB/s, '
+                  'p99={latency_p99:.4f} s'.format(**result), flush=True)
+            results.append(result)
+    return results
+
+
+def main(argv):
+    """
+    Run the benchmark with the command line flags
+    """
+    sizes = [int(float(size)) for size in FLAGS.sizes]
+    concurrency = [tuple(int(n) for n in level.split(':')) for level in FLAGS.concurrency]
+    tls = None
+    if FLAGS.tls:
+        from layers.communication.tls import SSL_CONF
+        tls = (FLAGS.cert_path or SSL_CONF.cert_path, FLAGS.key_path or SSL_CONF.key_path)
+    results = run_sweep(FLAGS.transport, sizes, concurrency, FLAGS.messages, FLAGS.budget, tls,
+                        FLAGS.compression, FLAGS.multiplexed)
+    report = json.dumps({'transport': FLAGS.transport, 'results': results}, indent=2)
+    if FLAGS.output:
+        with open(FLAGS.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,304 @@
+"""
+.. _BlobStore:
+
+Blob store
+==========
+Content addressed store of the model snapshots exchanged in the federated processes of the BSMD. A snapshot is kept
+under the hash of its bytes (its address), so the same snapshot is stored once however many times it is sent, and
+the address written in the BSMD is a pointer that anyone can check against the snapshot.
+
+The snapshots are written to disk, under ``BLOB_CONF.root``, and the most recently used ones are also kept in memory.
+Both tiers drop the least recently used snapshots when they exceed their capacity. The address of a snapshot is
+hashed from its buffers without joining them, and with ``wait=False`` the snapshot is written to disk by a background
+thread, so storing the weights of a round costs the training thread a hash and a copy.
+
+A node that does not have a snapshot can fetch it from any peer it has a session with (see :ref:`Session`): the
+request and the snapshot go on a stream of the existing connection and the snapshot is checked against its address
+before it is stored.
+
+:Example:
+>>> store = BlobStore()
+>>> address = store.put(encode(weights), wait=False)
+>>> metadata, arrays = decode(store.get(address))
+>>> # on a node without the snapshot, from the sessions of its peers
+>>> message = store.fetch(address, [session.connection])
+
+"""
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import os
+import socket
+import tempfile
+import threading
+from layers.communication.mux import MUX_CONF, StreamClosed
+
+BLOB_CONF = lambda x: x
+BLOB_CONF.root = os.path.join(tempfile.gettempdir(), 'bsmd_blobs')
+# bytes of snapshots kept in memory
+BLOB_CONF.memory_capacity = 256 * 1024 * 1024
+# bytes of snapshots kept on disk
+BLOB_CONF.disk_capacity = 4 * 1024 * 1024 * 1024
+BLOB_CONF.hashfunction = hashlib.sha256
+# label of the streams on which the snapshots are requested
+BLOB_CONF.label = 'blobs'
+# seconds to wait for a peer to send a snapshot
+BLOB_CONF.timeout = 60
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def address_of(parts):
+    """
+    Address of a snapshot
+
+    :param list parts: buffers of the snapshot, e.g., returned by :func:`layers.communication.tensors.encode`
+    :return: hexadecimal hash of the bytes of the snapshot
+    :rtype: str
+
+    """
+    digest = BLOB_CONF.hashfunction()
+    for part in parts:
+        digest.update(memoryview(part).cast('B'))
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """
+    Snapshots kept by their address, on disk and in memory
+
+    :param str,optional root: directory of the snapshots on disk
+    :param int,optional memory_capacity: bytes of snapshots kept in memory
+    :param int,optional disk_capacity: bytes of snapshots kept on disk
+    """
+
+    def __init__(self, root=None, memory_capacity=None, disk_capacity=None):
+        self.root = root or BLOB_CONF.root
+        self.memory_capacity = BLOB_CONF.memory_capacity if memory_capacity is None else memory_capacity
+        self.disk_capacity = BLOB_CONF.disk_capacity if disk_capacity is None else disk_capacity
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        # snapshots not written to disk yet, by address
+        self._pending = {}
+        # bytes on disk, None until the directory is scanned
+        self._disk_size = None
+        self._writer = None
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, address):
+        if len(address) < 3 or not all(c in '0123456789abcdef' for c in address):
+            raise ValueError('{} is not the address of a snapshot'.format(address))
+        return os.path.join(self.root, address[:2], address)
+
+    def _remember(self, address, blob):
+        """
+        Keep a snapshot in memory, dropping the least recently used ones
+        """
+        with self._lock:
+            if address in self._memory:
+                self._memory.move_to_end(address)
+                return
+            if len(blob) > self.memory_capacity:
+                return
+            self._memory[address] = blob
+            self._memory_size += len(blob)
+            while self._memory_size > self.memory_capacity:
+                _, dropped = self._memory.popitem(last=False)
+                self._memory_size -= len(dropped)
+
+    def _trim_disk(self):
+        """
+        Delete the least recently used snapshots on disk until they fit in the capacity. The directory is only
+        scanned when the bytes written since the last scan may exceed the capacity
+        """
+        if self._disk_size is not None and self._disk_size <= self.disk_capacity:
+            return
+        files = []
+        for directory in os.listdir(self.root):
+            path = os.path.join(self.root, directory)
+            if os.path.isdir(path):
+                for name in os.listdir(path):
+                    try:
+                        stat = os.stat(os.path.join(path, name))
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_atime, stat.st_size, os.path.join(path, name)))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_capacity:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._disk_size = total
+
+    def _write(self, address, blob):
+        """
+        Write a snapshot to disk
+        """
+        path = self._path(address)
+        try:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # the snapshot appears complete or not at all, even with other processes using the same directory
+                temporary = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+                with open(temporary, 'wb') as file:
+                    file.write(blob)
+                os.replace(temporary, path)
+                if self._disk_size is not None:
+                    self._disk_size += len(blob)
+                self._trim_disk()
+        finally:
+            with self._lock:
+                self._pending.pop(address, None)
+
+    def put(self, parts, wait=True):
+        """
+        Store a snapshot
+
+        :param parts: buffers of the snapshot, or a single buffer
+        :param bool,optional wait: wait until the snapshot is on disk. If False it is written in the background and
+                                   kept in memory until then, see :meth:`flush`
+        :return: address of the snapshot
+        :rtype: str
+
+        """
+        if not isinstance(parts, (list, tuple)):
+            parts = [parts]
+        address = address_of(parts)
+        with self._lock:
+            if address in self._memory:
+                self._memory.move_to_end(address)
+                return address
+            if address in self._pending:
+                return address
+        # a copy, the buffers can be reused by the caller once this returns
+        blob = b''.join(memoryview(part).cast('B') for part in parts)
+        self._remember(address, blob)
+        if wait:
+            self._write(address, blob)
+            return address
+        with self._lock:
+            self._pending[address] = blob
+            if self._writer is None:
+                self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='blobs')
+            future = self._writer.submit(self._write, address, blob)
+        future.add_done_callback(functools.partial(self._report_write, address))
+        return address
+
+    @staticmethod
+    def _report_write(address, future):
+        if future.exception() is not None:
+            print('Could not write snapshot {} ({})'.format(address, future.exception()))
+
+    def flush(self):
+        """
+        Wait until the snapshots stored in the background are on disk
+        """
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.shutdown(wait=True)
+
+    def get(self, address):
+        """
+        Snapshot stored under an address
+
+        :param str address: address of the snapshot
+        :return: the snapshot, None if it is not in the store
+        :rtype: bytes
+
+        """
+        with self._lock:
+            blob = self._memory.get(address)
+            if blob is not None:
+                self._memory.move_to_end(address)
+                return blob
+            blob = self._pending.get(address)
+            if blob is not None:
+                return blob
+        try:
+            with open(self._path(address), 'rb') as file:
+                blob = file.read()
+        except FileNotFoundError:
+            return None
+        if address_of([blob]) != address:
+            print('Snapshot ' + address + ' is corrupted, removing it')
+            os.remove(self._path(address))
+            return None
+        self._remember(address, blob)
+        return blob
+
+    def __contains__(self, address):
+        with self._lock:
+            if address in self._memory or address in self._pending:
+                return True
+        return os.path.exists(self._path(address))
+
+    def serve(self, stream):
+        """
+        Answer the requests of snapshots of a peer until the stream is closed. A snapshot that is not in the store
+        is answered with an empty message
+
+        :param Stream stream: stream opened by the peer with the label BLOB_CONF.label
+        """
+        try:
+            while True:
+                address = str(stream.recv(), 'utf-8')
+                try:
+                    blob = self.get(address)
+                except ValueError:
+                    blob = None
+                stream.send(blob if blob is not None else b'')
+        except (StreamClosed, UnicodeDecodeError):
+            stream.close()
+
+    def fetch(self, address, connections, timeout=None):
+        """
+        Snapshot stored under an address, requested to the peers if it is not in the store
+
+        :param str address: address of the snapshot
+        :param list connections: connections with the peers to ask, in order
+        :param float,optional timeout: seconds to wait for every peer
+        :return: the snapshot, None if no peer has it
+        :rtype: bytes
+
+        """
+        blob = self.get(address)
+        if blob is not None:
+            return blob
+        timeout = BLOB_CONF.timeout if timeout is None else timeout
+        for connection in connections:
+            try:
+                stream = connection.open_stream(BLOB_CONF.label, MUX_CONF.priority_bulk)
+                try:
+                    stream.send(address.encode('utf-8'))
+                    answer = stream.recv(timeout)
+                finally:
+                    stream.close()
+            except (OSError, socket.timeout) as error:
+                print('Could not fetch snapshot {} from {} ({})'.format(address, connection.address, error))
+                continue
+            if len(answer) and address_of([answer]) == address:
+                self.put(answer)
+                return self.get(address)
+        return None
+
+
+def default_store():
+    """
+    Store shared by the federated processes of this program, created the first time it is needed
+
+    :rtype: BlobStore
+
+    """
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = BlobStore()
+        return _default_store
@@ -0,0 +1,93 @@
+"""
+.. _Checkpoint:
+
+Checkpoint
+==========
+Round state of the chief of a federated process, kept on disk so a chief that dies can be started again without
+starting the training again. After every round the chief writes the averaged weights in the tensor format (see
+:ref:`Tensors`) with its state (round, members, ring, version of the global model, ...) as metadata. The file is
+written through a memory map into a temporary file that replaces the previous checkpoint, so a checkpoint is always
+complete. It is read through a memory map too, and the weights are copied out of it so the file is closed once it
+is read.
+
+:Example:
+>>> save(path, weights, iteration=120, workers=['worker1', 'worker2'])
+>>> state, weights = load(path)
+>>> print(state['iteration'])
+120
+
+"""
+import mmap
+import os
+import tempfile
+import threading
+import numpy as np
+from layers.communication.tensors import encode, decode, message_size
+
+CHECKPOINT_CONF = lambda x: x
+CHECKPOINT_CONF.directory = os.path.join(tempfile.gettempdir(), 'bsmd_checkpoints')
+
+
+def default_path(name):
+    """
+    Path of the checkpoint of a node
+
+    :param str name: name of the node in the BSMD
+    :rtype: str
+
+    """
+    return os.path.join(CHECKPOINT_CONF.directory, name.replace(os.sep, '_') + '.ckpt')
+
+
+def save(path, weights, **state):
+    """
+    Write a checkpoint, replacing the previous one
+
+    :param str path: path of the checkpoint
+    :param list weights: numpy arrays of the model
+    :param state: JSON serializable values of the state of the chief
+    """
+    parts = encode(weights, **state)
+    size = message_size(parts)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temporary = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+    with open(temporary, 'w+b') as file:
+        file.truncate(size)
+        with mmap.mmap(file.fileno(), size) as memory:
+            position = 0
+            for part in parts:
+                view = memoryview(part).cast('B')
+                memory[position:position + len(view)] = view
+                position += len(view)
+    os.replace(temporary, path)
+
+
+def load(path):
+    """
+    Read a checkpoint
+
+    :param str path: path of the checkpoint
+    :return: state and weights of the checkpoint, None if there is no checkpoint
+    :rtype: tuple(dict, list)
+
+    """
+    try:
+        with open(path, 'rb') as file:
+            memory = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    error = None
+    with memory:
+        try:
+            state, views = decode(memory)
+            # the views of the file must be released before it is closed
+            weights = [np.array(view) for view in views]
+            views = None
+        except (ValueError, KeyError) as decoding:
+            error = str(decoding)
+    if error is not None:
+        print('Could not read the checkpoint {} ({})'.format(path, error))
+        return None
+    state.pop('names', None)
+    return state, weights
@@ -0,0 +1,316 @@
+"""
+.. _Compression:
+
+Compression
+===========
+Payload compression for the p2p and weight transports. When a connection is established both ends negotiate the
+codecs they can use (none, zlib and, when installed, lz4 or zstandard). Every payload starts with one byte that
+identifies the codec, so the receiver does not need to know how the sender chose it. A small payload can inflate to
+gigabytes, so the receiver gives :func:`decompress` the size of the largest message it accepts and the codecs stop
+as soon as the output exceeds it.
+
+The sender uses an :class:`AdaptiveCompressor` per peer. It periodically measures the compression ratio and speed of
+each negotiated codec on a sample of the payload, keeps the measured throughput of the link, and picks the codec that
+minimizes the estimated time to compress and transfer the payload. On a fast LAN this is usually no compression,
+on a WAN link the weights are compressed.
+
+:Example:
+>>> codecs = negotiate(connection_socket, server_side=False)
+>>> compressor = AdaptiveCompressor(codecs)
+>>> payload = compressor.compress(serialized)
+>>> # after sending the payload
+>>> compressor.record_transfer(len(payload), seconds)
+>>> # on the other side
+>>> serialized = decompress(payload, max_size)
+
+"""
+import struct
+import time
+import zlib
+from layers.communication.framing import FrameTooLarge
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_CONF = lambda x: x
+COMPRESSION_CONF.zlib_level = 1
+COMPRESSION_CONF.zstd_level = 1
+# payloads smaller than this are never compressed
+COMPRESSION_CONF.min_size = 1024
+# bytes of the payload used to measure the codecs
+COMPRESSION_CONF.sample_size = 256 * 1024
+# measure the codecs again every probe_interval payloads
+COMPRESSION_CONF.probe_interval = 20
+# assumed throughput of a link (bytes per second) before it is measured
+COMPRESSION_CONF.default_throughput = 12.5e6
+# only transfers of at least this size measure the throughput, smaller ones are dominated by the latency
+COMPRESSION_CONF.min_transfer = 256 * 1024
+# weight of the newest measure in the moving averages
+COMPRESSION_CONF.smoothing = 0.3
+
+
+def _inflate(data, limit):
+    """
+    Decompress zlib data, stopping after limit + 1 bytes of output
+    """
+    inflater = zlib.decompressobj()
+    try:
+        output = inflater.decompress(data, limit + 1)
+    except zlib.error as error:
+        raise ValueError('corrupted zlib payload ({})'.format(error))
+    if len(output) <= limit and not inflater.eof:
+        raise ValueError('truncated zlib payload')
+    return output
+
+
+def _zstd_decompress(data, limit):
+    """
+    Decompress zstandard data, stopping after limit + 1 bytes of output. The size written in the frame is not trusted
+    """
+    reader = zstandard.ZstdDecompressor().stream_reader(bytes(data))
+    chunks, size = [], 0
+    while size <= limit:
+        chunk = reader.read(limit + 1 - size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    return b''.join(chunks)
+
+
+def _lz4_decompress(data, limit):
+    """
+    Decompress lz4 data, stopping after limit + 1 bytes of output
+    """
+    return lz4_frame.LZ4FrameDecompressor().decompress(bytes(data), max_length=limit + 1)
+
+
+# codec name: (id, compress, decompress), the decompress functions are called with the data and the largest output
+CODECS = {'none': (0, bytes, lambda data, limit: data),
+          'zlib': (1, lambda data: zlib.compress(data, COMPRESSION_CONF.zlib_level), _inflate)}
+if zstandard is not None:
+    CODECS['zstd'] = (3, lambda data: zstandard.ZstdCompressor(level=COMPRESSION_CONF.zstd_level).compress(data),
+                      _zstd_decompress)
+if lz4_frame is not None:
+    CODECS['lz4'] = (2, lz4_frame.compress, _lz4_decompress)
+CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+
+
+def available_codecs():
+    """
+    Codecs that can be used in this node
+
+    :return: names of the codecs
+    :rtype: list[str]
+
+    """
+    return list(CODECS)
+
+
+def _send_short(sock, data):
+    sock.sendall(struct.pack('!H', len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError('connection closed during the negotiation of the compression')
+        data += chunk
+    return data
+
+
+def _recv_short(sock):
+    size = struct.unpack('!H', _recv_exactly(sock, 2))[0]
+    return _recv_exactly(sock, size)
+
+
+def negotiate(sock, server_side, codecs=None):
+    """
+    Agree with the other end of the connection on the codecs both can use. The client offers its codecs and the
+    server answers with the ones it also supports
+
+    :param sock: a socket with a connection already established
+    :param bool server_side: whether this end accepted the connection
+    :param list[str],optional codecs: codecs offered by this end, by default all the available ones
+    :return: codecs both ends can use
+    :rtype: list[str]
+
+    """
+    if codecs is None:
+        codecs = available_codecs()
+    if server_side:
+        offered = _recv_short(sock).decode('ascii').split(',')
+        agreed = [codec for codec in offered if codec in codecs]
+        _send_short(sock, ','.join(agreed).encode('ascii'))
+        return agreed
+    _send_short(sock, ','.join(codecs).encode('ascii'))
+    return [codec for codec in _recv_short(sock).decode('ascii').split(',') if codec]
+
+
+def compress(data, codec='none'):
+    """
+    Compress a payload with a given codec
+
+    :param bytes data: payload to be sent
+    :param str,optional codec: name of the codec
+    :return: codec id followed by the compressed data
+    :rtype: bytes
+
+    """
+    codec_id, compress_function, _ = CODECS[codec]
+    return bytes([codec_id]) + compress_function(data)
+
+
+def decompress(payload, max_size):
+    """
+    Decompress a payload produced by :meth:`AdaptiveCompressor.compress`
+
+    :param bytes payload: codec id followed by the compressed data
+    :param int max_size: bytes of the largest output accepted, e.g., the largest message of the transport
+    :return: the original data. Uncompressed data is returned as a view of the payload, without copying it
+    :rtype: bytes or memoryview
+    :raises FrameTooLarge: if the payload decompresses to more than max_size bytes, decompression stops there
+
+    """
+    view = memoryview(payload)
+    name = CODEC_NAMES.get(view[0])
+    if name is None:
+        raise ValueError('unknown compression codec {}'.format(view[0]))
+    data = CODECS[name][2](view[1:], max_size)
+    if len(data) > max_size:
+        raise FrameTooLarge('the payload decompresses to more than {} bytes'.format(max_size))
+    return data
+
+
+class AdaptiveCompressor:
+    """
+    Chooses the codec for each payload sent to a peer from the measured compression ratio and speed of the codecs
+    and the measured throughput of the link
+
+    :param list[str] codecs: codecs negotiated with the peer
+    """
+
+    def __init__(self, codecs):
+        self.codecs = [codec for codec in codecs if codec in CODECS] or ['none']
+        self.ratio = {'none': 1.0}
+        self.speed = {'none': float('inf')}
+        self.decompression_speed = {'none': float('inf')}
+        self.throughput = None
+        self.last_codec = 'none'
+        self._payloads = 0
+        self._since_measure = 0
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return (1 - COMPRESSION_CONF.smoothing) * old + COMPRESSION_CONF.smoothing * new
+
+    def _probe(self, data):
+        """
+        Measure the compression ratio and speed of the codecs on a sample of the payload. The decompression speed
+        is measured here too, assuming the peer is as fast as this node
+        """
+        sample = bytes(memoryview(data)[:COMPRESSION_CONF.sample_size])
+        for codec in self.codecs:
+            if codec == 'none':
+                continue
+            start = time.perf_counter()
+            compressed = CODECS[codec][1](sample)
+            middle = time.perf_counter()
+            CODECS[codec][2](compressed, len(sample))
+            end = time.perf_counter()
+            self.ratio[codec] = self._average(self.ratio.get(codec), len(compressed) / len(sample))
+            self.speed[codec] = self._average(self.speed.get(codec), len(sample) / max(middle - start, 1e-9))
+            self.decompression_speed[codec] = self._average(self.decompression_speed.get(codec),
+                                                            len(sample) / max(end - middle, 1e-9))
+
+    def estimated_time(self, codec, size):
+        """
+        Estimated seconds to compress, transfer and decompress a payload
+
+        :param str codec: name of the codec
+        :param int size: size of the payload in bytes
+        :rtype: float
+
+        """
+        throughput = self.throughput or COMPRESSION_CONF.default_throughput
+        return (size / self.speed[codec] + size * self.ratio[codec] / throughput +
+                size / self.decompression_speed[codec])
+
+    def choose(self, data, size=None):
+        """
+        Choose the codec for a payload
+
+        :param bytes data: payload to be sent, or a sample of it
+        :param int,optional size: size of the payload when data is just a sample
+        :return: name of the codec
+        :rtype: str
+
+        """
+        if size is None:
+            size = len(data)
+        if size < COMPRESSION_CONF.min_size or self.codecs == ['none']:
+            return 'none'
+        self._since_measure += 1
+        if size >= COMPRESSION_CONF.min_transfer and (self.throughput is None or
+                                                      self._since_measure > COMPRESSION_CONF.probe_interval):
+            # send this payload as it is to measure the throughput of the link
+            return 'none'
+        if self._payloads % COMPRESSION_CONF.probe_interval == 0 or any(c not in self.ratio for c in self.codecs):
+            self._probe(data)
+        self._payloads += 1
+        return min(self.codecs, key=lambda codec: self.estimated_time(codec, size))
+
+    def compress(self, data):
+        """
+        Compress a payload with the best codec for the link
+
+        :param bytes data: payload to be sent
+        :return: codec id followed by the compressed data
+        :rtype: bytes
+
+        """
+        self.last_codec = self.choose(data)
+        return compress(data, self.last_codec)
+
+    def compress_parts(self, parts):
+        """
+        Compress a payload made of several buffers. If the best codec is no compression the buffers are not copied
+
+        :param list parts: buffers of the payload, any objects supporting the buffer protocol
+        :return: buffers with the codec id followed by the compressed data
+        :rtype: list
+
+        """
+        views = [memoryview(part).cast('B') for part in parts]
+        size = sum(len(view) for view in views)
+        sample = bytearray()
+        for view in views:
+            if len(sample) >= COMPRESSION_CONF.sample_size:
+                break
+            sample += view[:COMPRESSION_CONF.sample_size - len(sample)]
+        self.last_codec = self.choose(sample, size)
+        if self.last_codec == 'none':
+            return [bytes([CODECS['none'][0]])] + views
+        return [compress(b''.join(views), self.last_codec)]
+
+    def record_transfer(self, size, seconds):
+        """
+        Update the throughput of the link with a transfer
+
+        :param int size: bytes transferred
+        :param float seconds: time of the transfer
+
+        """
+        if size >= COMPRESSION_CONF.min_transfer and seconds > 0:
+            self.throughput = self._average(self.throughput, size / seconds)
+            self._since_measure = 0
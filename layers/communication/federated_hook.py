@@ -26,35 +26,97 @@ limitations under the License.
 .. _comind.org: https://github.com/coMindOrg/federated-averaging-tutorials/tree/master/federated-sockets
 
 """
-import socket
 import time
-import ssl
-import hmac
+import socket
+import struct
+import functools
+import threading
+import concurrent.futures
 import tensorflow as tf
 import numpy as np
 import json
-import hashlib
-from utils.iroha import set_detail_to_node
+from layers.communication.tls import SSL_CONF, tls_statistics
+from layers.communication.mux import MUX_CONF
+from layers.communication.session import SESSION_CONF, SessionServer, WorkerSession
+from layers.communication.tensors import encode, decode, message_size
+from layers.communication.aggregation import StreamingAverage
+from layers.communication.quantization import Quantizer, dequantize
+from layers.communication.sparsification import Sparsifier, densify
+from layers.communication.topology import assign
+from layers.communication.ring import RingAllReduce
+from layers.communication.ledger import LEDGER_CONF, get_journal, flush_journals, queue_depth, write_seconds
+from layers.communication.blobstore import BLOB_CONF, address_of, default_store
+from layers.communication.interval import AdaptiveInterval, relative_divergence
+from layers.communication.integrity import IntegrityError, SegmentVerifier, tag_table, repair_message
+from layers.communication import checkpoint
+from layers.communication.metrics import RoundMetrics, measure, start_endpoint
+from layers.communication import sharedmem
+from layers.communication.layout import LAYOUT_CONF, Layout
 
 SEND_RECEIVE_CONF = lambda x: x
 SEND_RECEIVE_CONF.key = b'4C5jwen4wpNEjBeq1YmdBayIQ1oD'
-SEND_RECEIVE_CONF.hashfunction = hashlib.sha1
-SEND_RECEIVE_CONF.hashsize = int(160 / 8)
 SEND_RECEIVE_CONF.error = b'error'
+# followed by the numbers of the corrupted segments of the message (see :ref:`Integrity`)
+SEND_RECEIVE_CONF.resend = b'resend'
+# the receiver cannot open the shared memory of the sender (see :ref:`SharedMemory`)
+SEND_RECEIVE_CONF.unshared = b'unshared'
 SEND_RECEIVE_CONF.recv = b'reciv'
 SEND_RECEIVE_CONF.signal = b'go!go!go!'
 SEND_RECEIVE_CONF.buffer = 8192*2
+# seconds to wait for the weights of a peer
+SEND_RECEIVE_CONF.timeout = 240
+# seconds from the start of a round until the chief averages the weights received so far
+SEND_RECEIVE_CONF.round_timeout = 120
+# models the chief receives at the same time, the rest of the workers wait (see MUX_CONF.receive_budget)
+SEND_RECEIVE_CONF.received_models = 2
+# star: the chief averages the weights, ring: the nodes average them with a ring all-reduce (see :ref:`Ring`),
+# async: the chief mixes the weights of every worker into the global model as soon as they arrive
+SEND_RECEIVE_CONF.synchronizations = ['star', 'ring', 'async']
+# weight of the weights of a worker that are not stale in the async mixing, divided by sqrt(1 + staleness)
+SEND_RECEIVE_CONF.mixing = 0.5
+# async mode: mixes between two snapshots of the global model stored and recorded in the BSMD, None for one snapshot
+# every as many mixes as nodes, so the records grow with the rounds rather than with the pushes of the workers
+SEND_RECEIVE_CONF.record_mixes = None
+# suffix of the name of the sessions between the nodes of a ring
+SEND_RECEIVE_CONF.ring_suffix = '/ring'
+# label of the stream on which a worker tells its parent that it leaves the training
+SEND_RECEIVE_CONF.leave = 'leave'
 CHIEF_NAME = ''
 
-SSL_CONF = lambda x: x
-SSL_CONF.key_path = 'layers/communication/server.key'
-SSL_CONF.cert_path = 'layers/communication/server.pem'
+# the snapshots of the weights sent are addressed, stored and recorded in the BSMD by a background thread
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def _in_background(function, *args, **kwargs):
+    """
+    Run a function in the thread that records the snapshots, in the order the functions are given
+
+    :param function: function to be run
+    """
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='records')
+        future = _recorder.submit(function, *args, **kwargs)
+    future.add_done_callback(_report_background)
+
+
+def _report_background(future):
+    error = future.exception()
+    if error is not None:
+        print('Could not record the weights sent ({})'.format(error))
 
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+def _flush_background():
+    """
+    Wait until the snapshots given to the background thread are recorded
+    """
+    global _recorder
+    with _recorder_lock:
+        recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.shutdown(wait=True)
 
 
 def convert_weights_to_json(weights):
@@ -77,9 +139,11 @@ class _FederatedHook(tf.train.SessionRunHook):
 
     The hook has two different ways of working depending if it is the chief worker or not.
 
-    The chief starts creating a socket that will act as server. Then it stays
-    waiting _wait_time seconds and accepting connections of all those workers that
-    want to join the training, and distributes a task index to each of them.
+    The chief starts a session server (see :ref:`Session`). Then it stays
+    waiting, at most _wait_time seconds, and accepting the sessions of all those workers that
+    want to join the training, and distributes a task index to each of them. It stops waiting as soon as all the
+    list_of_workers or a quorum of workers have opened their sessions.
+    The sessions are kept for the whole training, so the rounds only cost the transfer of the weights.
     This task index is not always necessary. In our demos we use it to tell
     each worker which part of the data-set it has to use for the training and it
     could have other applications.
@@ -94,7 +158,40 @@ class _FederatedHook(tf.train.SessionRunHook):
     and if so, it gathers the weights of all the workers and its own, averages them
     and sends the average to all those workers.
 
-    Workers open a socket connection with the chief and wait to get their worker number.
+    Workers open a session with the chief and wait to get their worker number. If the session is lost
+    they open it again with the same name.
+    Workers started with an aggregator_ip are aggregators: the chief can give them a group of workers, whose weights
+    they average and send upstream as a single partial average (see :ref:`Topology`). The workers of the group open
+    their session with the aggregator instead of the chief.
+    With the ring synchronization the nodes average their weights among them with a ring all-reduce, every node
+    only talks to the next and the previous one. The chief gives the order of the ring and records the rounds in the
+    BSMD.
+    With the async synchronization there are no rounds: the chief mixes the weights of a worker into the global
+    model as soon as they arrive, with a weight that decreases with their staleness (the number of versions of the
+    global model since the worker received its own), and answers with the newest global model. The workers keep
+    training while their weights travel and apply the answer in their next synchronization. Weights staler than
+    max_staleness are discarded. The global model is recorded in the BSMD once every
+    SEND_RECEIVE_CONF.record_mixes mixes.
+    With adaptive_interval the steps between two synchronizations change after every synchronization with the
+    divergence of the nodes and the time spent communicating (see :ref:`Interval`). In the star synchronization the
+    chief chooses them and sends the step of the next synchronization with the averaged weights, in the ring
+    synchronization every node takes the same choice from the averaged measures of all the nodes, and in the async
+    synchronization every node chooses its own.
+    With a checkpoint the chief writes its round state and the averaged weights after every round (see
+    :ref:`Checkpoint`). A chief started again with the same checkpoint resumes from the last round: it does not wait
+    wait_time for new workers nor send the initial weights, it waits for the nodes it knew to open their sessions again,
+    and they repeat the round they were in.
+    In the star and async synchronizations the workers can also join and leave between two rounds. A worker that
+    opens its session after the training started gets its task index at the end of the next round, with the address
+    of the snapshot of the averaged weights (see :ref:`BlobStore`), fetches them from the chief and takes part in the
+    rounds from the following one. A worker that ends its training tells its parent, which stops waiting for it. In
+    the ring synchronization the ring is fixed when the training starts.
+    The time spent in every phase of a round and the bytes exchanged with every peer are measured (see
+    :ref:`Metrics`), written in a JSONL file with metrics and offered to Prometheus with metrics_port.
+    The weights sent to a node on the same host are written in shared memory and only their descriptor goes through
+    the session (see :ref:`SharedMemory`).
+    With flat the weights of all the variables are packed in a single float32 vector (see :ref:`Layout`), read with
+    one fetch and injected with one placeholder, and they travel and are averaged as one array.
     Once the training is going to start they wait for the chief to send them its weights.
     After each training round they check if _interval_steps has been completed,
     and if so, they send their weights to the chief and wait for it's response,
@@ -107,18 +204,54 @@ class _FederatedHook(tf.train.SessionRunHook):
     :param str public_ip: ip to which the workers are going to connect.
     :param str private_key: private key of the node for signing the transactions
     :param list[str] list_of_workers: list of all the nodes that are willing to participate. In theory the chief node
-                                    knows the list as he creates the domain and accounts for the participants
+                                    knows the list as he creates the domain and accounts for the participants.
+                                    The training starts as soon as all of them have opened their sessions
     :param str domain: name of the domain
     :param str ip: ip address for connecting to the BSMD
-    :param int,optional wait_time: how long the chief should wait at the beginning for the workers to connect.
+    :param int,optional wait_time: how long the chief should wait at most at the beginning for the workers to
+                                   connect.
     :param int,optional interval_steps: number of steps between two "average op", which specifies how frequent a model
                                         synchronization is performed
+    :param str,optional quantization: quantization of the weights exchanged after the first round, one of
+                                      none, float16, int8 or stochastic (see :ref:`Quantization`)
+    :param str,optional sparsification: workers send the topk or threshold entries of the difference between their
+                                        weights and the last averaged weights instead of their weights, or none
+                                        (see :ref:`Sparsification`)
+    :param str,optional aggregator_ip: complete ip in which the node serves the workers it aggregates, announced to
+                                       the chief. None if the node is not an aggregator
+    :param int,optional fanout: only for the chief, maximum number of children of the chief and of every aggregator.
+                                By default the chief aggregates the aggregators and they split the workers evenly
+    :param str,optional synchronization: star (the chief averages the weights), ring (ring all-reduce among the
+                                         nodes) or async (bounded-staleness asynchronous averaging). Only the star
+                                         synchronization uses aggregators
+    :param str,optional peer_ip: complete ip in which the node accepts the session of the previous node of the ring
+    :param int,optional max_staleness: only for the chief in async mode, versions of the global model after which
+                                       the weights of a worker are discarded. Every node adds a version in each
+                                       synchronization, by default twice the number of nodes
+    :param bool,optional adaptive_interval: adapt the steps between two synchronizations, starting from
+                                            interval_steps. In the star synchronization only the chief needs it, in the
+                                            ring synchronization all the nodes must use it
+    :param int,optional min_interval_steps: minimum steps between two synchronizations with adaptive_interval
+    :param int,optional max_interval_steps: maximum steps between two synchronizations with adaptive_interval
+    :param str,optional checkpoint: only for the chief, path of the checkpoint of its round state, None to not keep
+                                    one
+    :param int,optional quorum: only for the chief, number of workers after which the training starts without
+                                waiting for the rest of the list_of_workers, who can still join later
+    :param str,optional metrics: path of the JSONL file in which the metrics of every round are written, None to
+                                 not write them
+    :param int,optional metrics_port: port in which the metrics are offered to Prometheus, None to not offer them
+    :param bool,optional shared_memory: send the weights to the nodes on the same host through shared memory
+    :param bool,optional flat: read, send, average and assign the weights as a single float32 vector of all the
+                               variables. All the nodes must use it or none
 
     .. _article: https://medium.com/comind/raspberry-pis-federated-learning-751b10fc92c9
       """
 
     def __init__(self, is_chief, name, private_ip, public_ip, private_key, list_of_workers, domain, ip,
-                 wait_time=30, interval_steps=100):
+                 wait_time=30, interval_steps=100, quantization='none',
+                 sparsification='none', aggregator_ip=None, fanout=None, synchronization='star', peer_ip=None,
+                 max_staleness=None, adaptive_interval=False, min_interval_steps=None, max_interval_steps=None,
+                 checkpoint=None, quorum=None, metrics=None, metrics_port=None, shared_memory=True, flat=False):
         self._is_chief = is_chief
         self._name = name
         self._private_ip = private_ip.split(':')[0]
@@ -132,59 +265,390 @@ class _FederatedHook(tf.train.SessionRunHook):
         self._interval_steps = interval_steps
         self._wait_time = wait_time
         self._nex_task_index = 0
+        self._chief_name = CHIEF_NAME
+        # names of the workers taking part in the rounds, in the order of their task index
+        self._workers = []
+        # weights of the workers are received at the same time by a pool of threads
+        self._executor = None
+        self._gathering = {}
+        # average of the weights computed while they arrive, allocated in the first round
+        self._aggregator = None
+        # averaged weights are sent to all the workers at the same time
+        self._broadcaster = None
+        # quantizer of the weights sent by this node, with its own error feedback
+        self._quantizer = Quantizer(quantization)
+        # the weights sent downstream have their own error feedback
+        self._broadcast_quantizer = Quantizer(quantization)
+        # workers send sparse updates against the last averaged weights, which the chief also keeps
+        self._sparsifier = Sparsifier(sparsification, quantization=quantization)
+        # iteration and weights of the last averaged model received from upstream and sent downstream
+        self._reference = None
+        self._children_reference = None
+        # the chief and the aggregators serve the sessions of their children
+        self._aggregator_ip = aggregator_ip
+        self._fanout = fanout
+        self._server = None
+        # depth of the node in the tree, the rounds of the aggregators close earlier than those of the chief
+        self._level = 0
+        if synchronization not in SEND_RECEIVE_CONF.synchronizations:
+            raise ValueError('unknown synchronization {}, use one of {}'.format(synchronization,
+                                                                                SEND_RECEIVE_CONF.synchronizations))
+        self._synchronization = synchronization
+        self._peer_ip = peer_ip
+        # position in the ring, session with the next node and name of the previous one
+        self._ring = None
+        self._ring_next = None
+        self._ring_previous = None
+        self._ring_following = None
+        # async mode: version and weights of the global model, last version recorded in the BSMD, version this node
+        # trained from and the exchange of a worker in progress
+        self._max_staleness = max_staleness
+        self._global = None
+        self._global_lock = threading.Lock()
+        self._version = 0
+        self._recorded = 0
+        self._base = 0
+        self._pending = None
+        self._stopped = threading.Event()
+        # adaptive interval: step of the next synchronization (None to synchronize every interval_steps), divergence
+        # of this node and of the groups of its children in the last synchronization, and timings of the rounds
+        self._interval = None
+        self._next_sync = None
+        if adaptive_interval:
+            self._interval = AdaptiveInterval(interval_steps, min_interval_steps, max_interval_steps)
+            self._next_sync = interval_steps
+        self._divergence = None
+        self._reported = {}
+        self._last_sync = time.time()
+        self._sync_start = None
+        self._computation = 0.0
+        self._communication = 0.0
+        # the chief writes its checkpoint in the background, and resumes from the state and weights it read
+        self._checkpoint = checkpoint
+        self._checkpointer = None
+        self._checkpointing = None
+        self._recovered = None
+        self._ring_members = None
+        # workers with a task index, those that told they leave the training and, for a worker, the state of the
+        # training when it joined late
+        self._quorum = quorum
+        self._members = set()
+        self._leaving = set()
+        self._membership_lock = threading.Lock()
+        self._joined = None
+        self._join_step = None
+        # bytes sent and received in the current round
+        self._traffic = {'sent': 0, 'received': 0}
+        self._traffic_lock = threading.Lock()
+        # seconds and bytes of the rounds, and seconds the ledger had spent writing when the round started
+        self._metrics = RoundMetrics(name, metrics)
+        self._ledger_seconds = write_seconds()
+        if metrics_port is not None:
+            start_endpoint(metrics_port)
+        # segments of shared memory with the nodes on the same host, by connection
+        self._shared_memory = shared_memory
+        self._channels = {}
+        self._channels_lock = threading.Lock()
+        # weights as a single vector, and the position of every variable in it
+        self._flat = flat
+        self._layout = None
+        self._read_op = None
         # We get the number of connections that have been made, and which task_index
         # corresponds to this worker.
         self.task_index, self.num_workers = self._get_task_index()
 
     def _get_task_index(self):
         """
-        Chief distributes task index number to workers that connect to it and lets them know how many workers are
-        there in total.
+        Chief distributes task index number to workers that open a session with it and lets them know how many
+        workers are there in total. It also places the nodes in a tree (see :ref:`Topology`) and tells every node
+        its parent and its children. Nodes whose parent is an aggregator open their session with it, and the
+        aggregators wait for the sessions of their children.
 
         :return: task index corresponding to this worker and the total workers.
          """
         if self._is_chief:
-            self._server_socket = self._start_socket_server()
-            self._server_socket.settimeout(5)
-            users = []
-            t_end = time.time() + self._wait_time
-
-            while time.time() < t_end:
-                try:
-                    sock, _ = self._server_socket.accept()
-                    connection_socket = ssl.wrap_socket(
-                        sock,
-                        server_side=True,
-                        certfile=SSL_CONF.cert_path,
-                        keyfile=SSL_CONF.key_path,
-                        ssl_version=ssl.PROTOCOL_TLSv1)
-                    if connection_socket not in users:
-                        users.append(connection_socket)
-                except socket.timeout:
-                    pass
+            self._start_server(self._private_ip, self._private_port)
+            if self._checkpoint is not None:
+                self._recovered = checkpoint.load(self._checkpoint)
+                if self._recovered is not None:
+                    return self._resume(self._recovered[0])
+            users = self._server.wait_sessions(self._list_of_workers, self._quorum, self._wait_time)
 
             num_workers = len(users) + 1
-            _ = [us.send((str(i + 1) + ':' + str(num_workers)).encode('utf-8')) \
-                 for i, us in enumerate(users)]
+            addresses = {us.name: us.info['aggregator'] for us in users if 'aggregator' in us.info}
+            ring = None
+            if self._synchronization != 'star':
+                # the nodes do not average through the tree, so there are no aggregators
+                addresses = {}
+            if self._synchronization == 'ring':
+                ring = [{'name': self._name, 'address': self._public_ip + ':' + str(self._public_port)}]
+                ring += [{'name': us.name, 'address': us.info['peer']} for us in users if 'peer' in us.info]
+            tree = assign(self._name, [us.name for us in users if us.name in addresses],
+                          [us.name for us in users if us.name not in addresses], self._fanout)
+            for i, us in enumerate(users):
+                node = tree[us.name]
+                parent = None
+                if node['parent'] != self._name:
+                    parent = {'name': node['parent'], 'address': addresses[node['parent']]}
+                assignment = {'task_index': i + 1, 'num_workers': num_workers, 'parent': parent,
+                              'children': node['children'], 'level': node['level'], 'ring': ring}
+                us.send_control(json.dumps(assignment).encode('utf-8'))
+            self._workers = tree[self._name]['children']
+            self._members = set(us.name for us in users)
             self._nex_task_index = len(users) + 1
-            _ = [us.close() for us in users]
-
-            self._server_socket.settimeout(120)
+            self._ring_members = ring
+            if ring is not None:
+                self._join_ring(ring)
             return 0, num_workers
 
-        client_socket = self._start_socket_worker()
-        message = client_socket.recv(1024).decode('utf-8').split(':')
-        client_socket.close()
-        return int(message[0]), int(message[1])
+        info = None
+        if self._aggregator_ip is not None:
+            # the workers of the group can be redirected as soon as the chief places the nodes
+            host, port = self._aggregator_ip.split(':')
+            self._start_server(host, int(port))
+            info = {'aggregator': self._aggregator_ip}
+        if self._synchronization == 'ring':
+            # the previous node of the ring opens its session with this server
+            host, port = self._peer_ip.split(':')
+            self._start_server(host, int(port))
+            info = {'peer': self._peer_ip}
+        self._session = WorkerSession(self._public_ip, self._public_port, self._name, SEND_RECEIVE_CONF.key,
+                                      info=info, inspector=self._new_verifier)
+        self._session.connect()
+        assignment = json.loads(str(self._session.recv_control(), 'utf-8'))
+        self._workers = assignment['children']
+        self._level = assignment['level']
+        self._joined = assignment.get('join')
+        if assignment['parent'] is not None:
+            print('Aggregated by ' + assignment['parent']['name'])
+            self._session.close()
+            host, port = assignment['parent']['address'].split(':')
+            self._session = WorkerSession(host, int(port), self._name, SEND_RECEIVE_CONF.key, info=info,
+                                          inspector=self._new_verifier)
+            self._session.reconnect()
+        if self._workers:
+            deadline = time.time() + self._wait_time
+            for name in self._workers:
+                if self._server.session(name, max(deadline - time.time(), 0)) is None:
+                    print('Worker ' + name + ' did not open its session')
+        if assignment.get('ring') is not None:
+            self._join_ring(assignment['ring'])
+        return assignment['task_index'], assignment['num_workers']
+
+    def _resume(self, state):
+        """
+        Take the round state of the checkpoint of the chief and wait for the nodes it knew to open their sessions
+        again. The nodes keep their task index and their place in the tree or in the ring
+
+        :param dict state: state of the checkpoint
+        :return: task index of the chief and the total workers
+        """
+        print('Resuming from the checkpoint of iteration {}'.format(state['iteration']))
+        self._workers = state['workers']
+        self._members = set(state.get('members', self._workers))
+        self._nex_task_index = state['nex_task_index']
+        self._version = self._base = self._recorded = state.get('version', 0)
+        self._next_sync = state.get('next_sync', self._next_sync)
+        if self._interval is not None and state.get('interval') is not None:
+            self._interval.steps = state['interval']
+        deadline = time.time() + self._wait_time
+        for name in self._workers:
+            if self._server.session(name, max(deadline - time.time(), 0)) is None:
+                print('Worker ' + name + ' did not open its session again')
+        self._ring_members = state.get('ring')
+        if self._ring_members is not None:
+            self._join_ring(self._ring_members)
+        return 0, state['num_workers']
+
+    def _save_checkpoint(self, step_value, weights):
+        """
+        Write the round state and the weights of the chief in its checkpoint, in the background. If the last
+        checkpoint is still being written this round is not written
+
+        :param int step_value: current step
+        :param list weights: weights at the end of the round, they must not be changed afterwards
+        """
+        if self._checkpointing is not None and not self._checkpointing.done():
+            return
+        if self._checkpointer is None:
+            self._checkpointer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        state = {'iteration': int(step_value), 'workers': list(self._workers), 'num_workers': self.num_workers,
+                 'nex_task_index': self._nex_task_index, 'members': sorted(self._members), 'version': self._version,
+                 'next_sync': self._next_sync, 'interval': self._interval.steps if self._interval is not None else None,
+                 'ring': self._ring_members}
+        self._checkpointing = self._checkpointer.submit(checkpoint.save, self._checkpoint, weights, **state)
+        self._checkpointing.add_done_callback(self._report_checkpoint)
+
+    @staticmethod
+    def _report_checkpoint(future):
+        """
+        Report a checkpoint that could not be written
+
+        :param future: future of the writing
+        """
+        error = future.exception()
+        if error is not None:
+            print('Could not write the checkpoint ({})'.format(error))
+
+    def _start_server(self, host, port):
+        """
+        Start accepting the sessions of other nodes. The nodes with a session can also fetch the snapshots of the
+        weights stored by this node (see :ref:`BlobStore`) and tell that they leave the training
+
+        :param str host: my local ip address
+        :param int port: my local port
+        """
+        self._server = SessionServer(host, port, SEND_RECEIVE_CONF.key, inspector=self._new_verifier)
+        self._server.handlers[BLOB_CONF.label] = default_store().serve
+        self._server.handlers[SEND_RECEIVE_CONF.leave] = self._on_leave
+        self._server.start()
+
+    def _on_leave(self, stream):
+        """
+        Take note of a worker that leaves the training, it is let go at the end of the round
+
+        :param Stream stream: stream opened by the worker with the label SEND_RECEIVE_CONF.leave
+        """
+        for user in self._server.sessions():
+            if user.connection is stream.connection:
+                with self._membership_lock:
+                    self._leaving.add(user.name)
+                print('Worker ' + user.name + ' leaves the training')
+        try:
+            stream.send(SEND_RECEIVE_CONF.recv)
+        except OSError:
+            pass
+        stream.close()
+
+    def _leave(self):
+        """
+        Tell the parent of the worker that it leaves the training, so the next rounds do not wait for it
+        """
+        if self._session.closed:
+            return
+        try:
+            stream = self._session.connection.open_stream(SEND_RECEIVE_CONF.leave, MUX_CONF.priority_control)
+            try:
+                stream.send(self._name.encode('utf-8'))
+                stream.recv(SESSION_CONF.heartbeat_timeout)
+            finally:
+                stream.close()
+        except (OSError, socket.timeout) as error:
+            print('Could not tell the chief that the worker leaves ({})'.format(error))
+
+    def _update_membership(self, iteration, weights):
+        """
+        Between two rounds, let go the workers that left the training and, on the chief, admit those that opened their
+        session after it started. A worker that joins gets its task index with the address of the snapshot of the
+        averaged weights of the round, which it fetches from the chief, and takes part in the rounds from the next one
+
+        :param int iteration: current iteration
+        :param list weights: averaged weights of the round
+        """
+        with self._membership_lock:
+            leaving, self._leaving = self._leaving, set()
+        for name in leaving:
+            if name in self._workers:
+                self._workers.remove(name)
+                self._gathering.pop(name, None)
+            self._members.discard(name)
+        if not self._is_chief:
+            return
+        joining = [user for user in self._server.sessions() if user.name not in self._members
+                   and user.name not in leaving and not user.name.endswith(SEND_RECEIVE_CONF.ring_suffix)]
+        if not joining:
+            return
+        # with sparsification the joining workers send their updates relative to the weights the others received
+        snapshot = self._children_reference[1] if self._children_reference is not None else weights
+        join = {'iteration': int(iteration), 'address': default_store().put(encode(snapshot), wait=False),
+                'version': self._version}
+        if self._synchronization == 'star' and self._next_sync is not None:
+            join['next_sync'] = self._next_sync
+        for user in joining:
+            assignment = {'task_index': self._nex_task_index, 'num_workers': len(self._members) + len(joining) + 1,
+                          'parent': None, 'children': [], 'level': 1, 'ring': None, 'join': join}
+            try:
+                user.send_control(json.dumps(assignment).encode('utf-8'))
+            except OSError:
+                print('Could not admit ' + user.name)
+                continue
+            print('Worker ' + user.name + ' joins the training at iteration {}'.format(iteration))
+            self._nex_task_index += 1
+            self._members.add(user.name)
+            self._workers.append(user.name)
+            if self._synchronization == 'async':
+                threading.Thread(target=self._serve_async, args=(user.name,), name='async', daemon=True).start()
+        if self._synchronization == 'star':
+            # the pools of the rounds are sized for the workers, the next round creates them again
+            for pool in (self._executor, self._broadcaster):
+                if pool is not None:
+                    pool.shutdown(wait=False)
+            self._executor = self._broadcaster = None
+
+    def _fetch_snapshot(self, address):
+        """
+        Weights whose snapshot was recorded in the BSMD with some address. The snapshot is taken from the store of
+        this node or, if it is not there, fetched from the nodes this node has a session with
+
+        :param str address: address of the snapshot
+        :return: metadata and arrays of the snapshot, None if no node has it
+        :rtype: tuple(dict, list)
+
+        """
+        connections = []
+        for session in [self._session, self._ring_next]:
+            if session is not None and not session.closed:
+                connections.append(session.connection)
+        if self._server is not None:
+            connections += [session.connection for session in self._server.sessions()]
+        blob = default_store().fetch(address, connections)
+        if blob is None:
+            return None
+        return decode(blob)
+
+    def _join_ring(self, ring):
+        """
+        Open the session with the next node of the ring and wait for the session of the previous one
+
+        :param list[dict] ring: name and address of the nodes of the ring, in order
+        """
+        names = [node['name'] for node in ring]
+        if self._name not in names:
+            print('Not in the ring, the weights are not averaged')
+            return
+        rank = names.index(self._name)
+        self._ring = RingAllReduce(rank, len(ring))
+        if len(ring) == 1:
+            return
+        following = ring[(rank + 1) % len(ring)]
+        self._ring_following = following['name']
+        self._ring_previous = names[rank - 1] + SEND_RECEIVE_CONF.ring_suffix
+        host, port = following['address'].split(':')
+        self._ring_next = WorkerSession(host, int(port), self._name + SEND_RECEIVE_CONF.ring_suffix,
+                                        SEND_RECEIVE_CONF.key)
+        self._ring_next.reconnect()
+        if self._server.session(self._ring_previous, self._wait_time) is None:
+            print('The previous node of the ring, ' + names[rank - 1] + ', did not open its session')
 
     def _create_placeholders(self):
         """
-        Creates the placeholders that we will use to inject the weights into the graph
+        Creates the placeholders that we will use to inject the weights into the graph, and the op that reads them.
+        With flat weights there is a single placeholder for the vector of all the variables (see :ref:`Layout`)
         """
-        for var in tf.trainable_variables():
-            self._placeholders.append(tf.placeholder_with_default(var, var.shape,
-                                                                  name="%s/%s" % ("FedAvg",
-                                                                                  var.op.name)))
+        variables = tf.trainable_variables()
+        self._layout = Layout([var.shape.as_list() for var in variables])
+        if not self._flat:
+            self._read_op = variables
+            for var in variables:
+                self._placeholders.append(tf.placeholder_with_default(var, var.shape,
+                                                                      name="%s/%s" % ("FedAvg",
+                                                                                      var.op.name)))
+            return
+        self._read_op = tf.concat([tf.reshape(tf.cast(var, LAYOUT_CONF.dtype), [-1]) for var in variables], 0)
+        # the variables of the vector keep their own scales when it is quantized
+        self._quantizer.segments = self._broadcast_quantizer.segments = self._layout.sizes
+        self._placeholders.append(tf.placeholder_with_default(self._read_op, [self._layout.size],
+                                                              name="%s/%s" % ("FedAvg", "flat")))
 
     def _assign_vars(self, local_vars):
         """
@@ -195,72 +659,216 @@ class _FederatedHook(tf.train.SessionRunHook):
 
         """
         reassign_ops = []
+        if self._flat:
+            # the vector is split in the graph, the weights are fed at once
+            pieces = tf.split(self._placeholders[0], self._layout.sizes)
+            for var, piece in zip(local_vars, pieces):
+                reassign_ops.append(tf.assign(var, tf.cast(tf.reshape(piece, var.shape), var.dtype.base_dtype)))
+            return tf.group(*(reassign_ops))
         for var, fvar in zip(local_vars, self._placeholders):
             reassign_ops.append(tf.assign(var, fvar))
         return tf.group(*(reassign_ops))
 
+    def _read_weights(self, session):
+        """
+        Read the weights of the graph
+
+        :param session: tensorflow session
+        :return: numpy arrays of the variables, or the flat vector of all of them in a list
+        :rtype: list
+        """
+        weights = session.run(self._read_op)
+        return [weights] if self._flat else weights
+
+    def _assign_weights(self, session, weights):
+        """
+        Inject weights into the graph. The weights of a node that does not use flat weights are converted, e.g.,
+        those of a checkpoint written by such a chief
+
+        :param session: tensorflow session
+        :param list weights: numpy arrays of the variables, or the flat vector of all of them in a list
+        """
+        if self._flat:
+            weights = [self._layout.flatten(weights)]
+        else:
+            weights = self._layout.unflatten(weights)
+        feed_dict = {}
+        for placeh, weight in zip(self._placeholders, weights):
+            feed_dict[placeh] = weight
+        session.run(self._update_local_vars_op, feed_dict=feed_dict)
+
     @staticmethod
-    def _receiving_subroutine(connection_socket):
+    def _receiving_subroutine(session, timeout=None):
         """
         Subroutine inside _get_np_array to receive a list of numpy arrays.
-        If the sending was not correctly received it sends back an error message
-        to the sender in order to try it again.
-
-        :param connection_socket: a socket with a connection already established.
-        :return:
+        The table of tags and the message arrive as a single message of the weights stream of the session, and the
+        answer is sent on the control stream. The segments of the message are checked by the session while they
+        arrive (see :ref:`Integrity`), so the check ends with the transfer. A message the sender wrote in shared
+        memory (see :ref:`SharedMemory`) is copied out of it and then checked.
+        If the table is not correct it sends back an error message to the sender in order to try it again, and if
+        some segments are corrupted it asks for those segments only.
+
+        :param session: session with the other node, see :ref:`Session`.
+        :param float,optional timeout: seconds to wait for the message, by default SEND_RECEIVE_CONF.timeout
+        :return: the message without its table of tags
+        :rtype: memoryview
 
         """
-        timeout = 0.5
+        if timeout is None:
+            timeout = SEND_RECEIVE_CONF.timeout
         while True:
-            ultimate_buffer = b''
-            connection_socket.settimeout(240)
-            first_round = True
-            while True:
+            view = memoryview(session.recv(timeout)).cast('B')
+            verifier = getattr(session, 'inspection', None)
+            if sharedmem.is_descriptor(view):
                 try:
-                    receiving_buffer = connection_socket.recv(SEND_RECEIVE_CONF.buffer)
-                except socket.timeout:
-                    break
-                if first_round:
-                    connection_socket.settimeout(timeout)
-                    first_round = False
-                if not receiving_buffer:
-                    break
-                ultimate_buffer += receiving_buffer
+                    view = sharedmem.read(view, session.connection)
+                except (OSError, ValueError) as error:
+                    print('Could not read the weights in shared memory ({}), asking for them through the '
+                          'session'.format(error))
+                    session.send_control(SEND_RECEIVE_CONF.unshared)
+                    continue
+                verifier = None
+            if verifier is None:
+                # compressed messages and those in shared memory are checked once they are in the buffer
+                verifier = _FederatedHook._new_verifier()
+                verifier.update(view, 0, len(view))
+            if not verifier.complete:
+                session.send_control(SEND_RECEIVE_CONF.error)
+                continue
+            if verifier.bad and view.readonly:
+                view = memoryview(bytearray(view))
+            while verifier.bad:
+                print('Corrupted segments {}, asking for them again'.format(verifier.bad))
+                session.send_control(SEND_RECEIVE_CONF.resend + struct.pack('!' + 'I' * len(verifier.bad),
+                                                                            *verifier.bad))
+                try:
+                    verifier.repair(view, session.recv(timeout))
+                except IntegrityError as error:
+                    print('Could not repair the segments ({})'.format(error))
+            session.send_control(SEND_RECEIVE_CONF.recv)
+            return verifier.payload(view)
+
+    def _get_np_array(self, session, timeout=None, iteration=None, answer_stale=False):
+        """
+        Routine to receive a list of numpy arrays. The arrays are views of the received message, they are not
+        copied.
 
-            pos_signature = SEND_RECEIVE_CONF.hashsize
-            signature = ultimate_buffer[:pos_signature]
-            message = ultimate_buffer[pos_signature:]
-            good_signature = hmac.new(SEND_RECEIVE_CONF.key, message, SEND_RECEIVE_CONF.hashfunction).digest()
+        :param session: session with the other node.
+        :param float,optional timeout: seconds to wait for the arrays
+        :param int,optional iteration: if given, arrays sent in earlier iterations are discarded
+        :param bool,optional answer_stale: tell the sender of the discarded arrays that their round is closed, so it
+                                           does not wait for the averaged weights of that round
+        :return: name of the sender, the arrays and the metadata of the message
 
-            if signature != good_signature:
-                connection_socket.send(SEND_RECEIVE_CONF.error)
-                timeout += 0.5
+        """
+        while True:
+            start = time.perf_counter()
+            message = self._receiving_subroutine(session, timeout)
+            elapsed = time.perf_counter() - start
+            with self._metrics.timer('deserialize'):
+                metadata, final_image = decode(message)
+            self._count_traffic('received', len(message), metadata['sender'])
+            # the time until the first byte arrived was spent waiting for the sender
+            transfer = min(getattr(session, 'transfer', None) or 0.0, elapsed)
+            self._metrics.add('receive', transfer, metadata['sender'])
+            self._metrics.add('wait', elapsed - transfer, metadata['sender'])
+            if iteration is not None and metadata.get('iteration', iteration) < iteration:
+                print('Discarded weights of iteration {} from {}'.format(metadata['iteration'], metadata['sender']))
+                if answer_stale:
+                    self._answer_stale(session, iteration)
                 continue
-            else:
-                connection_socket.send(SEND_RECEIVE_CONF.recv)
-                connection_socket.settimeout(120)
-                return message
+            with self._metrics.timer('deserialize'):
+                if 'quantization' in metadata:
+                    final_image = dequantize(final_image, metadata['quantization'])
+                if 'sparsification' in metadata:
+                    final_image = self._densify(final_image, metadata)
+            return metadata['sender'], final_image, metadata
+
+    def _answer_stale(self, session, iteration):
+        """
+        Tell a worker that sent the weights of a round that was already closed to continue with its own weights
+
+        :param session: session with the worker
+        :param int iteration: iteration of the round in progress
+        """
+        metadata = {'stale': True}
+        if self._synchronization == 'star' and self._next_sync is not None:
+            metadata['next_sync'] = self._next_sync
+        self._sending_subroutine(encode([], sender=self._name, iteration=iteration, **metadata), session)
+
+    def _densify(self, arrays, metadata):
+        """
+        Restore the weights of a worker from its sparse update (see :ref:`Sparsification`)
+
+        :param list arrays: received arrays
+        :param dict metadata: metadata of the message
+        :return: the weights of the worker
+        """
+        reference = self._children_reference
+        if reference is None or metadata.get('base') != reference[0]:
+            raise ValueError('the update of {} is relative to the weights of iteration {}, not to the last averaged '
+                             'weights'.format(metadata['sender'], metadata.get('base')))
+        return densify(arrays, metadata['sparsification'], reference[1])
 
-    def _get_np_array(self, connection_socket):
+    def _count_traffic(self, direction, size, peer=None):
         """
-        Routine to receive a list of numpy arrays.
+        Add the bytes of a message to the traffic of the round.
 
-        :param connection_socket: a socket with a connection already established.
+        :param str direction: sent or received
+        :param int size: bytes of the message
+        :param str,optional peer: name of the node the message was exchanged with
+        """
+        with self._traffic_lock:
+            self._traffic[direction] += size
+        self._metrics.count(direction, size, peer)
+
+    def _log_traffic(self, iteration):
+        """
+        Print the bytes exchanged in the round, the error of the quantization and the records waiting to be written
+        in the BSMD, and start counting again. The metrics of the round are written too.
+
+        :param int iteration: iteration of the round
+        """
+        with self._traffic_lock:
+            traffic = dict(self._traffic)
+            self._traffic = {'sent': 0, 'received': 0}
+        print('Round {}: sent {:.2f} MB, received {:.2f} MB, {} quantization error {:.2e}, density {:.3f}, '
+              'ledger queue {}'.format(iteration, traffic['sent'] / 1e6, traffic['received'] / 1e6,
+                                       self._quantizer.mode,
+                                       max(self._quantizer.last_error, self._broadcast_quantizer.last_error),
+                                       self._sparsifier.last_density, queue_depth()))
+        ledger = write_seconds()
+        self._metrics.add('ledger', max(ledger - self._ledger_seconds, 0.0))
+        self._ledger_seconds = ledger
+        self._metrics.end_round(iteration, self._connections(), workers=self.num_workers)
+
+    def _connections(self):
+        """
+        Connections of the node, with the name of the peer at the other end
 
+        :return: name of the peer and connection, for every connection
+        :rtype: list[tuple]
         """
-        message = self._receiving_subroutine(connection_socket)
-        received_from, final_image = pickle.loads(message)
-        return received_from, final_image
+        connections = []
+        if self._server is not None:
+            connections += [(user.name.replace(SEND_RECEIVE_CONF.ring_suffix, ''), user.connection)
+                            for user in self._server.sessions()]
+        if not self._is_chief:
+            connections.append((self._chief_name, self._session.connection))
+        if self._ring_next is not None:
+            connections.append((self._ring_following, self._ring_next.connection))
+        return connections
 
     @staticmethod
-    def _send_np_array(arrays_to_send, connection_socket, iteration, tot_workers, sender, private_key, receiver, domain,
-                       ip, list_participants=None):
+    def _send_np_array(arrays_to_send, session, iteration, tot_workers, sender, private_key, receiver, domain,
+                       ip, list_participants=None, metrics=None, channel=None, **metadata):
 
         """
-        Send weights to nodes via a socket. Also write the transaction in the BSMD
+        Send weights to nodes via a session. The address of the weights (see :ref:`BlobStore`) is computed and the
+        transaction is written in the BSMD with it in the background, the arrays must not be changed afterwards
 
         :param arrays_to_send: weight to be send
-        :param connection_socket:
+        :param session: session with the receiver
         :param int iteration: iteration number in the federated process
         :param int tot_workers: total number of node in the federated process
         :param str sender: name of the node sending the information
@@ -268,81 +876,243 @@ class _FederatedHook(tf.train.SessionRunHook):
         :param str receiver: name of the receiver
         :param array, optional list_participants: list of participants in the federated process. This variable is
                                                     just need in the first loop
+        :param RoundMetrics,optional metrics: metrics in which the serialization and the sending are timed
+        :param SharedChannel,optional channel: shared memory with the receiver (see :ref:`SharedMemory`)
+        :param metadata: description of the encoding of the arrays, e.g., quantization
+        :return: bytes of the message
+        :rtype: int
 
         """
 
         if list_participants is None:
             list_participants = []
-        serialized = pickle.dumps([sender, arrays_to_send])
+        with measure(metrics, 'serialize'):
+            parts = encode(arrays_to_send, sender=sender, iteration=iteration, **metadata)
+            signature = _FederatedHook._sign(parts)
 
+        # Send transactions to the blockchain, the weights sent up are not fetched by any node, only their address
+        # is recorded
+        receivers = list_participants if iteration == 0 else [receiver]
+        _in_background(_FederatedHook._record_snapshot, arrays_to_send, iteration, tot_workers, sender, private_key,
+                       receivers, domain, ip, False, **metadata)
+
+        # Send weight using the session
+        with measure(metrics, 'send', receiver):
+            _FederatedHook._sending_subroutine(parts, session, signature, channel, metrics, receiver)
+        return message_size(parts)
+
+    @staticmethod
+    def _record_snapshot(arrays, iteration, tot_workers, sender, private_key, receivers, domain, ip, store=True,
+                         **metadata):
+        """
+        Address the weights sent to some nodes, keep them in the store so other nodes can fetch them, and write the
+        transaction in the BSMD with their address. Called in the background, see :func:`_in_background`
+
+        :param list arrays: arrays sent
+        :param int iteration: iteration number in the federated process
+        :param int tot_workers: total number of node in the federated process
+        :param str sender: name of the node sending the information
+        :param str private_key: private key of the node sending the transaction
+        :param list[str] receivers: names of the receivers
+        :param str domain: name of the domain
+        :param str ip: ip address for connecting to the BSMD
+        :param bool,optional store: keep the snapshot in the store, False to only compute its address
+        :param metadata: description of the encoding of the arrays, e.g., quantization
+        """
+        parts = encode(arrays, **metadata)
+        address = default_store().put(parts) if store else address_of(parts)
+        _FederatedHook._record_transaction(iteration, tot_workers, sender, private_key, receivers, domain, ip,
+                                           address)
+
+    @staticmethod
+    def _record_transaction(iteration, tot_workers, sender, private_key, receivers, domain, ip, address='address'):
+        """
+        Write in the BSMD that weights were sent to some nodes. The records are queued in the journal of the node
+        and written in the background (see :ref:`Ledger`)
+
+        :param int iteration: iteration number in the federated process
+        :param int tot_workers: total number of node in the federated process
+        :param str sender: name of the node sending the information
+        :param str private_key: private key of the node sending the transaction
+        :param list[str] receivers: names of the receivers
+        :param str domain: name of the domain
+        :param str ip: ip address for connecting to the BSMD
+        :param str,optional address: address of the snapshot of the weights in the store of the sender
+
+        """
         transaction_data = dict()
         transaction_data['Process'] = 'BSMD-ML'
         transaction_data['Received from'] = sender
-        # in this example weights are send using a socket, but you can write the address
-        # were the weight is stored (e.g., see https://ipfs.io/)
-        transaction_data['address'] = 'address'
+        # the weights are sent using a session, the address is the hash of their snapshot and any node with a
+        # session can fetch it (see :ref:`BlobStore`)
+        transaction_data['address'] = address
         transaction_data['Total workers'] = str(tot_workers)
         transaction_data['iteration'] = str(iteration)
         transaction_json = json.dumps(transaction_data)
         json_in_ledger = str(transaction_json)
         transaction = json_in_ledger.replace('"', '')
 
-        # Send transactions to the blockchain
         detail_key = sender + '_weight'
-        if iteration == 0:
-            for rec in list_participants:
-                set_detail_to_node(sender, rec, private_key, detail_key, transaction, domain, ip)
-        else:
-            set_detail_to_node(sender, receiver, private_key, detail_key, transaction, domain, ip)
+        get_journal(sender, private_key, domain, ip).record(iteration, receivers, detail_key, transaction)
 
-        # Send weight using a socket
-        signature = hmac.new(SEND_RECEIVE_CONF.key, serialized, SEND_RECEIVE_CONF.hashfunction).digest()
-        assert len(signature) == SEND_RECEIVE_CONF.hashsize
-        message = signature + serialized
-        print('byte size:', len(serialized))
-        print('byte size:', len(message))
+    @staticmethod
+    def _new_verifier():
+        """
+        Checker of the segments of a message received with its table of tags, see :ref:`Integrity`
 
-        connection_socket.settimeout(240)
-        start = time.time()
-        connection_socket.sendall(message)
-        end = time.time()
-        print('send weghts in: ' + str(end - start) + '\n')
-        while True:
-            check = connection_socket.recv(len(SEND_RECEIVE_CONF.error))
-            if check == SEND_RECEIVE_CONF.error:
-                connection_socket.sendall(message)
-            elif check == SEND_RECEIVE_CONF.recv:
-                connection_socket.settimeout(120)
-                break
+        :rtype: SegmentVerifier
 
-    def _start_socket_server(self):
         """
-        Creates a socket with ssl protection that will act as server.
+        return SegmentVerifier(SEND_RECEIVE_CONF.key)
 
-        :return: ssl secured socket that will act as server.
+    @staticmethod
+    def _sign(parts):
         """
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1  # optional
-        context.set_ciphers('EECDH+AESGCM:EDH+AESGCM:AES256+EECDH:AES256+EDH')
-        server_socket.bind((self._private_ip, self._private_port))
-        server_socket.listen()
-        return server_socket
+        Table of the tags of the segments of a message made of several buffers
+
+        :param list parts: buffers of the message
+        :return: the table
+        :rtype: bytes
 
-    def _start_socket_worker(self):
         """
-        Creates a socket with ssl protection that will act as client.
+        return tag_table(parts, SEND_RECEIVE_CONF.key)
 
-        :return: ssl secured socket that will work as client.
-         """
-        to_wrap_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1  # optional
+    @staticmethod
+    def _sending_subroutine(parts, session, signature=None, channel=None, metrics=None, receiver=None):
+        """
+        Subroutine inside _send_np_array to sign and send a message encoded with the tensor format (see
+        :ref:`Tensors`). The buffers of the message are sent after the table of the tags of its segments as a
+        single message, so the weights are not copied and a message is never received without its tags. The
+        connection of the session compresses the message when it pays off (see :ref:`Compression`).
+        With a channel to a receiver on the same host the message is written in shared memory and only its
+        descriptor goes through the session (see :ref:`SharedMemory`).
+        If the receiver answers with an error message the message is sent again, and if it asks for some corrupted
+        segments only those are sent again. If it cannot open the shared memory the message is sent through the
+        session and the channel is not used again.
+
+        :param list parts: buffers of the message to be sent
+        :param session: session with the receiver, see :ref:`Session`.
+        :param bytes,optional signature: table of tags of the message if it was already signed
+        :param SharedChannel,optional channel: shared memory with the receiver, None to send through the session
+        :param RoundMetrics,optional metrics: metrics in which the writing of the message and its bytes are recorded
+        :param str,optional receiver: name of the receiver in the metrics
+
+        """
+        if signature is None:
+            signature = _FederatedHook._sign(parts)
+
+        message = [signature] + parts
+        shared = channel is not None and channel.accepts(message)
+        if shared:
+            # the segment holds one message until the receiver has copied it
+            channel.lock.acquire()
+        try:
+            with measure(metrics, 'write', receiver):
+                descriptor = channel.write(message) if shared else None
+                session.send(message if descriptor is None else descriptor)
+            while True:
+                check = session.recv_control(SEND_RECEIVE_CONF.timeout)
+                if check == SEND_RECEIVE_CONF.error:
+                    session.send(message)
+                elif check == SEND_RECEIVE_CONF.unshared:
+                    channel.close()
+                    session.send(message)
+                elif check[:len(SEND_RECEIVE_CONF.resend)] == SEND_RECEIVE_CONF.resend:
+                    indices = struct.unpack('!' + 'I' * ((len(check) - len(SEND_RECEIVE_CONF.resend)) // 4),
+                                            check[len(SEND_RECEIVE_CONF.resend):])
+                    session.send(repair_message(signature, parts, indices))
+                elif check == SEND_RECEIVE_CONF.recv:
+                    break
+        finally:
+            if shared:
+                channel.lock.release()
+
+    def _broadcast(self, weights, iteration, users, list_participants=None, quantize=True, record=True):
+        """
+        Send the same weights to several workers at the same time. The weights are encoded and signed once, their
+        snapshot is stored and recorded in the BSMD in the background, and a worker that fails is reported without
+        delaying the others.
+
+        :param weights: weights to be sent, they must not be changed afterwards
+        :param int iteration: iteration number in the federated process
+        :param list users: sessions with the workers
+        :param array, optional list_participants: list of participants in the federated process. This variable is
+                                                    just need in the first loop
+        :param bool,optional quantize: quantize the weights after the first round, if there is a quantization
+        :param bool,optional record: store and record the snapshot of the weights in the BSMD
+        :return: future of the sending to each worker, by name
+        :rtype: dict
 
-        client_socket = ssl.wrap_socket(to_wrap_socket)
-        client_socket.connect((self._public_ip, self._public_port))
-        return client_socket
+        """
+        if self._broadcaster is None:
+            self._broadcaster = concurrent.futures.ThreadPoolExecutor(max_workers=len(self._workers) + 1,
+                                                                      thread_name_prefix='broadcast')
+        metadata = {}
+        if self._synchronization == 'star' and self._next_sync is not None:
+            metadata['next_sync'] = self._next_sync
+        snapshot = {}
+        with self._metrics.timer('serialize'):
+            if quantize and iteration > 0 and self._broadcast_quantizer.mode != 'none':
+                arrays, description = self._broadcast_quantizer.quantize(weights)
+                parts = encode(arrays, sender=self._name, iteration=iteration, quantization=description, **metadata)
+                snapshot['quantization'] = description
+                # the updates of the workers are relative to what they receive
+                weights = dequantize(arrays, description)
+            else:
+                # the snapshot does not depend on the round, the same weights are stored once
+                arrays = weights
+                parts = encode(weights, sender=self._name, iteration=iteration, **metadata)
+            signature = self._sign(parts)
+        if self._sparsifier.mode != 'none':
+            self._children_reference = (iteration, weights)
+        if record:
+            receivers = list_participants if iteration == 0 else [user.name for user in users]
+            _in_background(self._record_snapshot, arrays, iteration, self.num_workers, self._name, self._private_key,
+                           receivers, self._domain, self._ip, **snapshot)
+        futures = {}
+        for user in users:
+            self._count_traffic('sent', message_size(parts), user.name)
+            future = self._broadcaster.submit(self._metrics.call, 'send', user.name, self._sending_subroutine, parts,
+                                              user, signature, self._channel(user), self._metrics, user.name)
+            future.add_done_callback(functools.partial(self._report_broadcast, user.name))
+            futures[user.name] = future
+        return futures
+
+    def _channel(self, session):
+        """
+        Shared memory with the node at the other end of a session if it runs on the same host, see
+        :ref:`SharedMemory`. There is one channel per connection
+
+        :param session: session with the node
+        :return: the channel, None to send through the session
+        :rtype: SharedChannel
+        """
+        connection = session.connection
+        if not self._shared_memory or not sharedmem.colocated(connection):
+            return None
+        with self._channels_lock:
+            channel = self._channels.get(connection)
+            if channel is None:
+                if self._stopped.is_set():
+                    # the segments are removed when the training ends
+                    return None
+                # the segments of connections that were closed, e.g., of workers that left, are removed
+                for closed in [known for known in self._channels if known.closed]:
+                    self._channels.pop(closed).close()
+                channel = self._channels[connection] = sharedmem.SharedChannel()
+        return channel
+
+    @staticmethod
+    def _report_broadcast(name, future):
+        """
+        Report the result of sending the weights to a worker
+
+        :param str name: name of the worker
+        :param future: future of the sending
+        """
+        error = future.exception()
+        if error is not None:
+            print('Could not send to : ' + name + ' ({}), fallen worker'.format(error))
 
     def begin(self):
         """
@@ -352,6 +1122,18 @@ class _FederatedHook(tf.train.SessionRunHook):
         self._create_placeholders()
         self._update_local_vars_op = self._assign_vars(tf.trainable_variables())
         self._global_step = tf.get_collection(tf.GraphKeys.GLOBAL_STEP)[0]
+        if (self._is_chief and self._checkpoint is not None) or self._joined is not None:
+            # a chief that resumes from its checkpoint continues counting from the round it saved, a worker that
+            # joins late from the round in which it joined
+            self._step_placeholder = tf.placeholder(self._global_step.dtype.base_dtype, shape=())
+            self._set_step_op = tf.assign(self._global_step, self._step_placeholder)
+        if (self._is_chief or self._workers) and MUX_CONF.receive_budget is None:
+            # the memory of the chief does not grow with the number of workers
+            model_size = sum(var.shape.num_elements() * var.dtype.size for var in tf.trainable_variables())
+            # a chunk more per model leaves room for the description of the tensors, an aggregator also keeps the
+            # weights received from its parent
+            models = SEND_RECEIVE_CONF.received_models + (0 if self._is_chief else 1)
+            MUX_CONF.receive_budget = models * (model_size + MUX_CONF.chunk_size)
 
     def after_create_session(self, session, coord):
         """
@@ -363,66 +1145,115 @@ class _FederatedHook(tf.train.SessionRunHook):
         Workers:
             Wait for the chief to send them its weights and inject them into
             the graph.
+        Aggregators:
+            Do both, they pass the weights and the signal of the chief to their workers.
+        A chief that resumes from its checkpoint takes the weights and the step of the checkpoint instead, the
+        workers already have their weights and are not waiting for the signal. A worker that joins late fetches the
+        averaged weights of the round in which it joined.
 
         :param session:
         :param coord:
 
         """
-        if self._is_chief:
-            users = []
-            addresses = []
-            while len(users) < (self.num_workers - 1):
-                try:
-                    self._server_socket.settimeout(30)
-                    sock, address = self._server_socket.accept()
-                    connection_socket = ssl.wrap_socket(
-                        sock,
-                        server_side=True,
-                        certfile=SSL_CONF.cert_path,
-                        keyfile=SSL_CONF.key_path,
-                        ssl_version=ssl.PROTOCOL_TLSv1)
-
-                    print('Connected: ' + address[0] + ':' + str(address[1]))
-                except socket.timeout:
-                    print('Some workers could not connect')
-                    break
-                try:
-                    print('SENDING Worker: ' + address[0] + ':' + str(address[1]))
-
-                    self._send_np_array(session.run(tf.trainable_variables()), connection_socket, 0, self.num_workers,
-                                        self._name, self._private_key, 'first_loop_federated_learning', self._domain,
-                                        self._ip, self._list_of_workers)
-                    print('SENT Worker {}'.format(len(users)))
-                    users.append(connection_socket)
-                    addresses.append(address)
-                except (ConnectionResetError, BrokenPipeError):
-                    print('Could not send to : '
-                          + address[0] + ':' + str(address[1])
-                          + ', fallen worker')
-                    connection_socket.close()
-            for i, user in enumerate(users):
-                try:
-                    user.send(SEND_RECEIVE_CONF.signal)
-                    user.close()
-                except (ConnectionResetError, BrokenPipeError):
-                    print('Fallen Worker: ' + addresses[i][0] + ':' + str(address[i][1]))
-                    self.num_workers -= 1
-                    try:
-                        user.close()
-                    except (ConnectionResetError, BrokenPipeError):
-                        pass
-        else:
+        if self._joined is not None:
+            self._join(session)
+            return
+        if not self._is_chief:
             print('Starting Initialization')
-            client_socket = self._start_socket_worker()
-            CHIEF_NAME, broadcast_weights = self._get_np_array(client_socket)
-            feed_dict = {}
-            for placeh, brweigh in zip(self._placeholders, broadcast_weights):
-                feed_dict[placeh] = brweigh
-            session.run(self._update_local_vars_op, feed_dict=feed_dict)
+            self._chief_name, broadcast_weights, metadata = self._get_np_array(self._session)
+            self._reference = (metadata.get('iteration'), broadcast_weights)
+            self._follow(metadata)
+            self._assign_weights(session, broadcast_weights)
             print('Initialization finished')
-            client_socket.settimeout(120)
-            client_socket.recv(len(SEND_RECEIVE_CONF.signal))
-            client_socket.close()
+        if self._recovered is not None:
+            self._restore(session)
+            return
+        users = []
+        if self._is_chief or self._workers:
+            for name in self._workers:
+                user = self._server.session(name)
+                if user is None:
+                    print('Could not send to : ' + name + ', fallen worker')
+                else:
+                    users.append(user)
+            print('SENDING {} Workers'.format(len(users)))
+            if self._is_chief:
+                futures = self._broadcast(self._read_weights(session), 0, users, self._list_of_workers)
+            else:
+                futures = self._broadcast(broadcast_weights, 0, users, [user.name for user in users])
+            concurrent.futures.wait(list(futures.values()))
+            users = [user for user in users if futures[user.name].exception() is None]
+            self.num_workers -= len(futures) - len(users)
+        if not self._is_chief:
+            self._session.recv_control()
+        for user in users:
+            try:
+                user.send_control(SEND_RECEIVE_CONF.signal)
+            except OSError:
+                print('Fallen Worker: ' + user.name)
+                self.num_workers -= 1
+        if self._is_chief and self._synchronization == 'async':
+            self._start_serving(self._read_weights(session))
+
+    def _restore(self, session):
+        """
+        Inject the weights and the step of the checkpoint into the graph of the chief
+
+        :param session: tensorflow session
+        """
+        state, weights = self._recovered
+        self._assign_weights(session, weights)
+        session.run(self._set_step_op, feed_dict={self._step_placeholder: state['iteration']})
+        if self._synchronization == 'async':
+            self._start_serving(weights)
+        # the weights of the checkpoint are not needed once they are in the graph
+        self._recovered = None
+        print('Resumed at iteration {} with {} workers'.format(state['iteration'], self.num_workers))
+
+    def _pool(self, prefix):
+        """
+        Threads that exchange the weights with the workers, one per worker, or the one that exchanges them with the
+        chief on a worker in async mode. They are created the first time they are needed
+
+        :param str prefix: prefix of the names of the threads
+        :return: the pool of threads
+        :rtype: concurrent.futures.ThreadPoolExecutor
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self._workers), 1),
+                                                                   thread_name_prefix=prefix)
+        return self._executor
+
+    def _start_serving(self, weights):
+        """
+        The chief starts the global model of the async mode from some weights and serves every worker in its own thread
+
+        :param list weights: weights the global model starts from
+        """
+        self._global = [np.array(weight) for weight in weights]
+        for name in self._workers:
+            self._pool('async').submit(self._serve_async, name)
+
+    def _join(self, session):
+        """
+        Inject the averaged weights and the step of the round in which the worker joined into its graph
+
+        :param session: tensorflow session
+        """
+        join = self._joined
+        snapshot = self._fetch_snapshot(join['address'])
+        if snapshot is None:
+            raise ConnectionError('could not fetch the weights of iteration {}'.format(join['iteration']))
+        _, weights = snapshot
+        self._assign_weights(session, weights)
+        session.run(self._set_step_op, feed_dict={self._step_placeholder: join['iteration']})
+        # the round of the join is already closed, the worker takes part from the next one
+        self._join_step = join['iteration']
+        self._reference = (join['iteration'], weights)
+        self._base = join['version']
+        self._follow(join)
+        self._joined = None
+        print('Joined the training at iteration {}'.format(join['iteration']))
 
     def before_run(self, run_context):
         """
@@ -431,109 +1262,499 @@ class _FederatedHook(tf.train.SessionRunHook):
         """
         return tf.train.SessionRunArgs(self._global_step)
 
+    def _gather_from(self, name, deadline, iteration):
+        """
+        Receive the weights of a worker and fold them into the average of the round, from the buffer they were
+        received in unless they had to be decompressed, dequantized or densified (see :ref:`Aggregation`). If its
+        session is lost while receiving them the worker has SESSION_CONF.heartbeat_timeout seconds to open it again
+        and resend its weights.
+
+        :param str name: name of the worker
+        :param float deadline: time at which the round is closed
+        :param int iteration: current iteration, weights sent in other iterations are discarded
+        :return: whether the weights arrived before the round was closed, None if they were sent in a later iteration,
+                 e.g., by a worker that kept training while the chief was resumed from its checkpoint
+        """
+        user = self._server.session(name)
+        for attempt in range(2):
+            if user is None:
+                break
+            try:
+                # a straggler is still received after the deadline, so its stream stays in order
+                timeout = max(deadline - time.time(), 0) + SEND_RECEIVE_CONF.timeout
+                _, received, metadata = self._get_np_array(user, timeout, iteration, answer_stale=True)
+                sent = metadata.get('iteration', iteration)
+                if sent != iteration:
+                    # the worker continues with its own weights instead of waiting for the average of its round
+                    print('Discarded weights of iteration {} from {}, in iteration {}'.format(sent, name, iteration))
+                    self._answer_stale(user, iteration)
+                    return None
+                if 'divergence' in metadata:
+                    self._reported[name] = (metadata['divergence'], metadata.get('count', 1))
+                with self._metrics.timer('aggregate'):
+                    return self._aggregator.add(received, sent, user, metadata.get('count', 1))
+            except (OSError, EOFError):
+                if attempt == 0 and name not in self._leaving:
+                    print('Lost the session of ' + name + ', waiting for it to reconnect')
+                    user = self._server.session(name, SESSION_CONF.heartbeat_timeout)
+        raise ConnectionResetError('fallen worker ' + name)
+
+    def _gather(self, own_weights, iteration):
+        """
+        Receive the weights of all the workers at the same time and average them while they arrive (see
+        :ref:`Aggregation`). The round is closed when all the workers have sent their weights or
+        SEND_RECEIVE_CONF.round_timeout seconds after its start (halved at every level of the tree), so the round
+        takes as long as the slowest worker. The weights of the stragglers are received and discarded in the
+        background.
+
+        :param own_weights: weights of the chief
+        :param int iteration: current iteration
+        :return: averaged weights, sessions of the workers received in time and sessions of the stragglers
+        """
+        if self._aggregator is None:
+            self._aggregator = StreamingAverage(own_weights)
+        self._aggregator.start_round(iteration)
+        with self._metrics.timer('aggregate'):
+            self._aggregator.add(own_weights, iteration)
+        # an aggregator closes its round earlier, so its partial average reaches the chief in time
+        deadline = time.time() + SEND_RECEIVE_CONF.round_timeout / 2 ** self._level
+        futures = {}
+        for worker in self._workers:
+            previous = self._gathering.get(worker)
+            if previous is not None and not previous.done():
+                print('Still receiving the last weights of ' + worker + ', skipped in this round')
+                continue
+            futures[worker] = self._pool('gather').submit(self._gather_from, worker, deadline, iteration)
+            self._gathering[worker] = futures[worker]
+        with self._metrics.timer('wait'):
+            concurrent.futures.wait(list(futures.values()), timeout=max(deadline - time.time(), 0))
+        users = [user for user in self._aggregator.close() if user is not None]
+
+        stragglers = []
+        received = [user.name for user in users]
+        for worker, future in futures.items():
+            if worker in received:
+                print('Received from ' + worker)
+            elif future.done() and not future.exception() and future.result() is None:
+                # the worker was told to continue with its own weights
+                continue
+            elif not future.done() or not future.exception():
+                print('Deadline reached before receiving from ' + worker + ', straggler worker')
+                user = self._server.session(worker)
+                if user is not None:
+                    stragglers.append(user)
+            else:
+                print('Could not recieve from : ' + worker + ', fallen worker')
+        with self._metrics.timer('aggregate'):
+            average = self._aggregator.average()
+        return average, users, stragglers
+
     def after_run(self, run_context, run_values):
         """
          Both chief and workers, check if they should average their weights in
         this round. Is this is the case:
 
         If chief:
-            Tries to gather the weights of all the workers, but ignores those
-            that lost connection at some point.
+            Tries to gather the weights of all the workers at the same time, but ignores those
+            that lost connection at some point or missed the deadline of the round.
             It averages them and then send them back to the workers.
             Finally in injects the averaged weights to its own graph.
         Workers:
             Send their weights to the chief.
             Wait for the chief to send them the averaged weights and inject them into
-            their graph.
+            their graph. If the session with the chief is lost they open it again and repeat the round.
+        Aggregators:
+            Average the weights of their workers as the chief does, send the partial average to the chief as a
+            worker does and pass the averaged weights of the chief to their workers.
+        With the ring synchronization all the nodes average their weights with a ring all-reduce instead, and with
+        the async synchronization the weights are mixed into the global model without waiting for the others.
+        After the round the chief admits the workers that joined and lets go those that left.
         """
-        step_value = run_values.results
+        # the step is fetched as a numpy integer, the metadata of the messages must be serializable
+        step_value = int(run_values.results)
         session = run_context.session
-        if step_value % self._interval_steps == 0 and not step_value == 0:
-            if self._is_chief:
-                self._server_socket.listen(self.num_workers - 1)
-                gathered_weights = [session.run(tf.trainable_variables())]
-                users = []
-                names = []
-                addresses = []
-                for i in range(self.num_workers - 1):
-                    try:
-                        self._server_socket.settimeout(30)
-                        sock, address = self._server_socket.accept()
-                        connection_socket = ssl.wrap_socket(
-                            sock,
-                            server_side=True,
-                            certfile=SSL_CONF.cert_path,
-                            keyfile=SSL_CONF.key_path,
-                            ssl_version=ssl.PROTOCOL_TLSv1)
-
-                        print('Connected: ' + address[0] + ':' + str(address[1]))
-                    except socket.timeout:
-                        print('Some workers could not connect')
-                        break
-                    try:
-                        name, received = self._get_np_array(connection_socket)
-                        gathered_weights.append(received)
-                        users.append(connection_socket)
-                        names.append(name)
-                        addresses.append(address)
-                        print('Received from ' + address[0] + ':' + str(address[1]))
-                    except (ConnectionResetError, BrokenPipeError):
-                        print('Could not recieve from : '
-                              + address[0] + ':' + str(address[1])
-                              + ', fallen worker')
-                        connection_socket.close()
-
-                self.num_workers = len(users) + 1
-
-                print('Average applied '
-                      + 'with {} workers, iter: {}'.format(self.num_workers, step_value))
-                rearranged_weights = []
-
-                # In gathered_weights, each list represents the weights of each worker.
-                # We want to gather in each list the weights of a single layer so
-                # to average them afterwards
-                for i in range(len(gathered_weights[0])):
-                    rearranged_weights.append([elem[i] for elem in gathered_weights])
-                for i, elem in enumerate(rearranged_weights):
-                    rearranged_weights[i] = np.mean(elem, axis=0)
-
-                for i, user in enumerate(users):
-                    try:
-                        self._send_np_array(rearranged_weights, user, step_value, self.num_workers, self._name,
-                                            self._private_key, self._domain, self._ip, names[i])
-                        user.close()
-                    except (ConnectionResetError, BrokenPipeError):
-                        print('Fallen Worker: ' + addresses[i][0] + ':' + str(address[i][1]))
-                        self.num_workers -= 1
-                        try:
-                            user.close()
-                        except socket.timeout:
-                            pass
-
-                feed_dict = {}
-                for placeh, reweigh in zip(self._placeholders, rearranged_weights):
-                    feed_dict[placeh] = reweigh
-                session.run(self._update_local_vars_op, feed_dict=feed_dict)
+        if self._next_sync is not None:
+            due = step_value >= self._next_sync
+        else:
+            due = step_value % self._interval_steps == 0 and not step_value == 0
+        if due and step_value == self._join_step:
+            # a worker that joined late starts with the averaged weights of this step
+            due = False
+        if due:
+            self._sync_start = time.time()
+            self._computation = self._sync_start - self._last_sync
+            with self._metrics.timer('read'):
+                weights = self._read_weights(session)
+            if self._synchronization == 'ring':
+                weights = self._ring_average(weights, step_value)
+            elif self._synchronization == 'async':
+                weights = self._async_average(weights, step_value)
+            else:
+                weights = self._star_average(weights, step_value)
+
+            if weights is not None:
+                with self._metrics.timer('assign'):
+                    self._assign_weights(session, weights)
+                if not self._is_chief and self._synchronization == 'star':
+                    print('Weights successfully updated, iter: {}'.format(step_value))
+            if self._is_chief and self._checkpoint is not None and weights is not None:
+                self._save_checkpoint(step_value, weights)
+            self._last_sync = time.time()
+            self._communication = self._last_sync - self._sync_start
+            if self._next_sync is not None:
+                if self._next_sync <= step_value:
+                    # no new step was chosen in this synchronization, the interval stays the same
+                    self._next_sync = step_value + (self._interval.steps if self._interval is not None
+                                                    else self._interval_steps)
+                print('Next synchronization at step {}, in {} steps'.format(self._next_sync,
+                                                                            self._next_sync - step_value))
+            if self._server is not None and self._synchronization != 'ring' and weights is not None:
+                # the workers join and leave between two rounds
+                self._update_membership(step_value, weights)
+            if weights is not None:
+                self._log_traffic(step_value)
+
+    def _adapt(self, step_value, divergence, communication, computation=None):
+        """
+        Choose the step of the next synchronization (see :ref:`Interval`)
+
+        :param int step_value: current step
+        :param float divergence: relative divergence of the nodes, None if unknown
+        :param float communication: seconds spent communicating in the synchronization
+        :param float,optional computation: seconds spent training before the synchronization, by default those
+                                           measured by this node
+        """
+        if computation is None:
+            computation = self._computation
+        steps = self._interval.update(divergence, communication, computation)
+        self._next_sync = step_value + steps
+        print('Synchronizing every {} steps, divergence {}, communication/computation {:.2f}'.format(
+            steps, 'unknown' if divergence is None else '{:.2e}'.format(divergence), self._interval.last_ratio))
+
+    def _group_divergence(self):
+        """
+        Divergence of this node and of the nodes under it, the mean of the last divergences measured by them
+
+        :return: the divergence, None if no node measured it yet
+        :rtype: float
+        """
+        measured = list(self._reported.values())
+        if self._divergence is not None:
+            measured.append((self._divergence, 1))
+        if not measured:
+            return None
+        return sum(value * count for value, count in measured) / sum(count for _, count in measured)
+
+    def _follow(self, metadata):
+        """
+        Take the step of the next synchronization chosen upstream, if any
+
+        :param dict metadata: metadata of the weights received from upstream
+        """
+        if 'next_sync' in metadata:
+            self._next_sync = metadata['next_sync']
+
+    def _star_average(self, weights, step_value):
+        """
+        Average the weights through the chief: the chief and the aggregators gather the weights of their children,
+        the workers and the aggregators exchange theirs with their parent, and the averaged weights go back down.
+
+        :param weights: weights of this node
+        :param int step_value: current step
+        :return: averaged weights
+        """
+        count = 1
+        local = weights
+        if self._is_chief or self._workers:
+            self._reported = {}
+            weights, users, stragglers = self._gather(weights, step_value)
+            count = self._aggregator.count
 
+            print('Average applied '
+                  + 'with {} workers, iter: {}'.format(count, step_value))
+
+        if self._is_chief:
+            self.num_workers = count
+            if self._interval is not None:
+                self._divergence = relative_divergence(local, weights)
+                self._adapt(step_value, self._group_divergence(), time.time() - self._sync_start)
+        else:
+            print('Sending weights')
+            self._session.ensure()
+            # a chief that is restarted from its checkpoint can drop the session again while it stops
+            for attempt in range(SESSION_CONF.reconnect_attempts):
+                try:
+                    name, weights = self._exchange_with_chief(weights, step_value, count)
+                    break
+                except (OSError, EOFError):
+                    if attempt == SESSION_CONF.reconnect_attempts - 1:
+                        raise
+                    print('Lost the session with the chief, repeating the round')
+                    self._session.reconnect()
+                    # the chief may not have the weights the update was relative to, the weights are sent whole
+                    self._reference = None
+            if self._next_sync is not None:
+                # reported to the chief in the next synchronization
+                self._divergence = relative_divergence(local, weights)
+
+        if self._is_chief or self._workers:
+            # the stragglers did not take part in the average, but they continue training with it once they
+            # have finished sending their weights
+            self._broadcast(weights, step_value, users + stragglers)
+        return weights
+
+    def _ring_average(self, weights, step_value):
+        """
+        Average the weights with the other nodes of the ring (see :ref:`Ring`). If the ring is broken the node keeps
+        its own weights for this round and opens its session with the next node again in the next one. The chief
+        records the averaged weights of the round in the BSMD. With adaptive_interval the measures of the nodes are
+        averaged with the weights, so all of them choose the same step for the next synchronization.
+
+        :param weights: weights of this node
+        :param int step_value: current step
+        :return: averaged weights
+        """
+        if self._ring is None or self._ring.size == 1:
+            return weights
+
+        # seconds spent in the transfers, the rest of the all-reduce is spent adding the chunks
+        transfers = []
+
+        def send(chunk, step):
+            start = time.perf_counter()
+            with self._metrics.timer('serialize'):
+                parts = encode([chunk], sender=self._name, iteration=step_value, step=step)
+                signature = self._sign(parts)
+            with self._metrics.timer('send', self._ring_following):
+                self._sending_subroutine(parts, self._ring_next, signature, self._channel(self._ring_next),
+                                         self._metrics, self._ring_following)
+            self._count_traffic('sent', message_size(parts), self._ring_following)
+            transfers.append(time.perf_counter() - start)
+
+        def receive(step):
+            start = time.perf_counter()
+            _, arrays, metadata = self._get_np_array(previous, SEND_RECEIVE_CONF.timeout, step_value)
+            transfers.append(time.perf_counter() - start)
+            if metadata.get('iteration') != step_value or metadata.get('step') != step:
+                raise ValueError('expected step {} of iteration {}, received step {} of iteration {}'.format(
+                    step, step_value, metadata.get('step'), metadata.get('iteration')))
+            return arrays[0]
+
+        try:
+            self._ring_next.ensure()
+            previous = self._server.session(self._ring_previous, SESSION_CONF.heartbeat_timeout)
+            if previous is None:
+                raise ConnectionError('no session with the previous node of the ring')
+            start = time.perf_counter()
+            if self._interval is None:
+                averaged = self._ring.all_reduce(weights, send, receive)
             else:
-                worker_socket = self._start_socket_worker()
-                print('Sending weights')
-                value = session.run(tf.trainable_variables())
+                # a negative divergence is unknown, the nodes measure it in the same rounds
+                measures = np.array([-1 if self._divergence is None else self._divergence, self._communication,
+                                     self._computation], dtype=np.float32)
+                averaged = self._ring.all_reduce(list(weights) + [measures], send, receive)
+                averaged, measures = averaged[:-1], averaged[-1]
+            self._metrics.add('aggregate', max(time.perf_counter() - start - sum(transfers), 0.0))
+        except (OSError, EOFError, ValueError) as error:
+            print('The ring is broken ({}), keeping the local weights, iter: {}'.format(error, step_value))
+            return weights
+        print('Average applied with {} workers in the ring, iter: {}'.format(self._ring.size, step_value))
+        if self._interval is not None:
+            self._adapt(step_value, None if measures[0] < 0 else float(measures[0]), float(measures[1]),
+                        float(measures[2]))
+            self._divergence = relative_divergence(weights, averaged)
+        weights = averaged
+        if self._is_chief:
+            _in_background(self._record_snapshot, weights, step_value, self._ring.size, self._name, self._private_key,
+                           self._workers, self._domain, self._ip)
+        return weights
+
+    def _mix(self, weights, base, name):
+        """
+        Mix the weights of a node into the global model, with a weight that decreases with their staleness
+
+        :param list weights: weights of the node
+        :param int base: version of the global model the node started from
+        :param str name: name of the node
+        :return: version and weights of the newest global model
+        """
+        with self._global_lock:
+            staleness = self._version - base
+            if self._max_staleness is None:
+                self._max_staleness = 2 * (len(self._workers) + 1)
+            if staleness > self._max_staleness:
+                print('Discarded the weights of {}, {} versions old'.format(name, staleness))
+                return self._version, self._global
+            alpha = SEND_RECEIVE_CONF.mixing / (1 + max(staleness, 0)) ** 0.5
+            # the arrays of the global model are never changed, they may still be sent to other workers
+            with self._metrics.timer('aggregate'):
+                self._global = [((1 - alpha) * old + alpha * np.asarray(new)).astype(old.dtype)
+                                for old, new in zip(self._global, weights)]
+            self._version += 1
+            print('Mixed the weights of {} with staleness {}, version: {}'.format(name, staleness, self._version))
+            return self._version, self._global
+
+    def _record_due(self, version):
+        """
+        Whether a version of the global model is stored and recorded in the BSMD. A snapshot is recorded every
+        SEND_RECEIVE_CONF.record_mixes mixes, not at every push of a worker
+
+        :param int version: version of the global model that is sent
+        :rtype: bool
+        """
+        every = SEND_RECEIVE_CONF.record_mixes or len(self._workers) + 1
+        with self._global_lock:
+            if version < self._recorded + every:
+                return False
+            self._recorded = version
+            return True
+
+    def _serve_async(self, name):
+        """
+        Mix the weights of a worker into the global model every time they arrive and answer with the newest global
+        model, until the training ends
+
+        :param str name: name of the worker
+        """
+        while not self._stopped.is_set() and name in self._workers:
+            # short waits, so the loop ends soon after the training
+            user = self._server.session(name, SESSION_CONF.heartbeat_interval)
+            if user is None:
+                continue
+            try:
+                _, received, metadata = self._get_np_array(user, SESSION_CONF.heartbeat_interval)
+                version, weights = self._mix(received, metadata.get('base', 0), name)
+                future = self._broadcast(weights, version, [user], quantize=False, record=self._record_due(version))
+                future[name].result()
+            except socket.timeout:
+                continue
+            except (OSError, EOFError, ValueError) as error:
+                if not self._stopped.is_set():
+                    print('Could not exchange the weights of {} ({})'.format(name, error))
 
-                self._send_np_array(value, worker_socket, step_value, self.num_workers, self._name,
-                                    self._private_key, self._domain, self._ip, CHIEF_NAME)
+    def _async_average(self, weights, step_value):
+        """
+        The chief mixes its own weights into the global model. A worker applies the global model received since
+        its last synchronization, if any, and sends its weights in the background. If its last weights are still
+        travelling the worker just keeps training.
 
-                name, broadcasted_weights = self._get_np_array(worker_socket)
-                feed_dict = {}
-                for placeh, brweigh in zip(self._placeholders, broadcasted_weights):
-                    feed_dict[placeh] = brweigh
-                session.run(self._update_local_vars_op, feed_dict=feed_dict)
-                print('Weights successfully updated, iter: {}'.format(step_value))
-                worker_socket.close()
+        :param weights: weights of this node
+        :param int step_value: current step
+        :return: weights to continue training with, None to keep the current ones
+        """
+        if self._is_chief:
+            self._base, mixed = self._mix(weights, self._base, self._name)
+            self.num_workers = len(self._server.sessions()) + 1
+            if self._interval is not None:
+                self._adapt(step_value, relative_divergence(weights, mixed), self._communication)
+            return mixed
+        if self._pending is not None and not self._pending.done():
+            return None
+        received = None
+        if self._pending is not None:
+            try:
+                received = self._pending.result()
+            except (OSError, EOFError, ValueError) as error:
+                print('Lost the session with the chief ({}), opening it again'.format(error))
+                self._session.reconnect()
+        # the weights were trained from the last version received, the global model is applied after sending them
+        self._pending = self._pool('async').submit(self._push_async, weights, self._base, step_value)
+        if received is None:
+            return None
+        self._base, mixed, round_trip = received
+        print('Global model of version {} applied, iter: {}'.format(self._base, step_value))
+        if self._interval is not None:
+            self._adapt(step_value, relative_divergence(weights, mixed), round_trip)
+        return mixed
+
+    def _push_async(self, weights, base, step_value):
+        """
+        Send the weights of the worker to the chief and receive the newest global model
+
+        :param weights: weights of the worker
+        :param int base: version of the global model the weights were trained from
+        :param int step_value: current step
+        :return: version and weights of the newest global model, and seconds the exchange took
+        """
+        start = time.time()
+        with self._metrics.timer('serialize'):
+            arrays, description = self._quantizer.quantize(weights)
+        metadata = {'base': base}
+        if self._quantizer.mode != 'none':
+            metadata['quantization'] = description
+        size = self._send_np_array(arrays, self._session, step_value, self.num_workers, self._name,
+                                   self._private_key, self._chief_name, self._domain, self._ip,
+                                   metrics=self._metrics, channel=self._channel(self._session), **metadata)
+        self._count_traffic('sent', size, self._chief_name)
+        _, weights, metadata = self._get_np_array(self._session, SEND_RECEIVE_CONF.timeout)
+        return metadata['iteration'], weights, time.time() - start
+
+    def _exchange_with_chief(self, value, step_value, count=1):
+        """
+        Send the weights of the worker to the chief and receive the averaged weights. With sparsification the
+        worker sends the sparse difference with the last averaged weights it received.
+
+        :param value: weights of the worker
+        :param int step_value: current step
+        :param int,optional count: number of nodes averaged in the weights, more than one for an aggregator
+        :return: name of the chief and averaged weights, or the own weights if the chief had already closed the round
+        """
+        metadata = {}
+        if count > 1:
+            metadata['count'] = count
+        if self._group_divergence() is not None:
+            metadata['divergence'] = self._group_divergence()
+        with self._metrics.timer('serialize'):
+            if self._sparsifier.mode != 'none' and self._reference is not None:
+                arrays, metadata['sparsification'] = self._sparsifier.sparsify(value, self._reference[1])
+                metadata['base'] = self._reference[0]
+            else:
+                self._sparsifier.reset()
+                arrays, description = self._quantizer.quantize(value)
+                if self._quantizer.mode != 'none':
+                    metadata['quantization'] = description
+        size = self._send_np_array(arrays, self._session, step_value, self.num_workers, self._name,
+                                   self._private_key, self._chief_name, self._domain, self._ip,
+                                   metrics=self._metrics, channel=self._channel(self._session), **metadata)
+        self._count_traffic('sent', size, self._chief_name)
+        name, weights, metadata = self._get_np_array(self._session)
+        if metadata.get('stale'):
+            print('The round of iteration {} was closed, continuing with the own weights'.format(step_value))
+            self._follow(metadata)
+            return name, value
+        self._reference = (metadata.get('iteration'), weights)
+        self._follow(metadata)
+        return name, weights
 
     def end(self, session):
         """
          Session end
         """
-        if self._is_chief:
-            self._server_socket.close()
\ No newline at end of file
+        self._stopped.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._broadcaster is not None:
+            # the averaged weights of the last round still have to reach the workers
+            self._broadcaster.shutdown(wait=True)
+        if self._checkpointer is not None:
+            # the checkpoint of the last round is complete when the training ends
+            self._checkpointer.shutdown(wait=True)
+        self._metrics.close()
+        if self._ring is not None:
+            self._ring.close()
+        if self._ring_next is not None:
+            self._ring_next.close()
+        if self._server is not None:
+            self._server.stop()
+        if not self._is_chief:
+            self._leave()
+            self._session.close()
+        with self._channels_lock:
+            for channel in self._channels.values():
+                channel.close()
+            self._channels.clear()
+        # the records of the last rounds are written before the training ends, with the snapshots they point to
+        _flush_background()
+        default_store().flush()
+        flush_journals(LEDGER_CONF.exit_timeout)
+        print('TLS statistics: {}'.format(tls_statistics()))
@@ -0,0 +1,94 @@
+"""
+.. _Framing:
+
+Framing
+=======
+Length prefixed frames for the sockets of the BSMD. A frame is the length of its body (8 bytes, big endian) followed
+by the body. The receiver allocates a buffer of the exact size of the body and fills it with ``recv_into``, so there
+are no timeouts to detect the end of a message and no copies while the message arrives. The sender writes the parts
+of the body one after the other, so they do not need to be joined in memory first. The length comes from the peer,
+so a frame longer than ``FRAME_CONF.max_size`` is refused before its buffer is allocated.
+
+:Example:
+>>> send_frame(connection_socket, signature, payload)
+>>> # on the other side
+>>> body = recv_frame(connection_socket)
+
+"""
+import struct
+
+FRAME_CONF = lambda x: x
+# bytes of the largest frame accepted
+FRAME_CONF.max_size = 64 * 1024 * 1024
+
+FRAME_HEADER = struct.Struct('!Q')
+
+
+class FrameTooLarge(ConnectionError):
+    """
+    The peer announced a frame or a message longer than the receiver accepts
+    """
+
+
+def recv_into_exactly(sock, view):
+    """
+    Fill a buffer with data of the socket
+
+    :param sock: a socket with a connection already established
+    :param memoryview view: buffer to be filled
+    :return: False if the connection was closed before any byte was received
+    :rtype: bool
+
+    """
+    received = 0
+    size = len(view)
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            if received == 0:
+                return False
+            raise ConnectionResetError('connection closed in the middle of a frame')
+        received += n
+    return True
+
+
+def send_frame(sock, *parts):
+    """
+    Send a frame made of the given parts
+
+    :param sock: a socket with a connection already established
+    :param parts: bytes-like objects that form the body of the frame
+    :return: size of the body
+    :rtype: int
+
+    """
+    views = [memoryview(part).cast('B') for part in parts]
+    size = sum(len(view) for view in views)
+    sock.sendall(FRAME_HEADER.pack(size))
+    for view in views:
+        if len(view):
+            sock.sendall(view)
+    return size
+
+
+def recv_frame(sock, max_size=None):
+    """
+    Receive a frame
+
+    :param sock: a socket with a connection already established
+    :param int,optional max_size: bytes of the largest frame accepted, FRAME_CONF.max_size by default
+    :return: body of the frame
+    :rtype: bytearray
+    :raises FrameTooLarge: if the frame is longer than max_size, nothing is allocated for it
+
+    """
+    header = bytearray(FRAME_HEADER.size)
+    if not recv_into_exactly(sock, memoryview(header)):
+        raise ConnectionResetError('connection closed before the frame')
+    size = FRAME_HEADER.unpack(header)[0]
+    max_size = FRAME_CONF.max_size if max_size is None else max_size
+    if size > max_size:
+        raise FrameTooLarge('frame of {} bytes, at most {} are accepted'.format(size, max_size))
+    body = bytearray(size)
+    recv_into_exactly(sock, memoryview(body))
+    return body
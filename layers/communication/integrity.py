@@ -0,0 +1,256 @@
+"""
+.. _Integrity:
+
+Integrity
+=========
+Integrity of the weights exchanged in the federated processes of the BSMD, checked while they arrive. The message is
+split in segments of ``INTEGRITY_CONF.segment_size`` bytes and every segment gets its own tag, a BLAKE2b hash keyed
+with the key shared by the nodes and salted with the number of the message (nonce) and of the segment. The tags are
+sent in a table in front of the message, so the receiver checks every segment as soon as its last byte lands (see
+the inspectors of :ref:`Mux`) and the check of the message ends with the transfer.
+
+When some segments are corrupted the receiver asks for them only, and the sender answers with a repair message that
+carries the corrupted segments again. A repair message that is not well formed raises :class:`IntegrityError`.
+
+The tags are computed on the bytes that go on the wire, so the streams that carry tagged messages are not compressed
+(see the ``compressed`` attribute of the streams of :ref:`Mux`).
+
+:On the sender run:
+>>> table = tag_table(parts, key)
+>>> stream.send([table] + parts)
+>>> # the receiver asks for the segments 3 and 7
+>>> stream.send(repair_message(table, parts, [3, 7]))
+
+:On the receiver run:
+>>> verifier = SegmentVerifier(key)
+>>> verifier.update(message, 0, len(message))
+>>> print(verifier.valid, verifier.bad)
+True [3, 7]
+>>> verifier.repair(message, repair)
+>>> payload = verifier.payload(message)
+
+"""
+import hashlib
+import hmac
+import os
+import struct
+
+INTEGRITY_CONF = lambda x: x
+INTEGRITY_CONF.segment_size = 1024 * 1024
+INTEGRITY_CONF.digest_size = 16
+INTEGRITY_CONF.person = b'bsmd-weights'
+
+# magic, nonce, bytes of the message after the table, bytes of a segment, number of segments
+_TABLE = struct.Struct('!4sQQII')
+_TABLE_MAGIC = b'BTAG'
+# magic, nonce, number of segments
+_REPAIR = struct.Struct('!4sQI')
+_REPAIR_MAGIC = b'BFIX'
+# salt of the tag of the table itself, never the number of a segment
+_HEADER_INDEX = 2 ** 64 - 1
+
+
+class IntegrityError(ValueError):
+    """
+    A repair message is not well formed, e.g., it was truncated
+    """
+
+
+def _tag(key, nonce, index, data):
+    """
+    Tag of a segment, or of the header of the table
+    """
+    tag = hashlib.blake2b(key=key, digest_size=INTEGRITY_CONF.digest_size, person=INTEGRITY_CONF.person,
+                          salt=struct.pack('!QQ', nonce, index))
+    for piece in data:
+        tag.update(piece)
+    return tag.digest()
+
+
+def _segments(parts, size):
+    """
+    Pieces of every segment of a message made of several buffers, without joining them
+    """
+    pieces, filled = [], 0
+    for part in parts:
+        view = memoryview(part).cast('B')
+        while len(view):
+            piece = view[:size - filled]
+            pieces.append(piece)
+            filled += len(piece)
+            view = view[len(piece):]
+            if filled == size:
+                yield pieces
+                pieces, filled = [], 0
+    if pieces:
+        yield pieces
+
+
+def tag_table(parts, key, nonce=None):
+    """
+    Table of the tags of the segments of a message, to be sent in front of it
+
+    :param list parts: buffers of the message
+    :param bytes key: key shared by the nodes
+    :param int,optional nonce: number of the message, random by default
+    :return: the table
+    :rtype: bytes
+
+    """
+    if nonce is None:
+        nonce = struct.unpack('!Q', os.urandom(8))[0]
+    size = INTEGRITY_CONF.segment_size
+    total = sum(memoryview(part).nbytes for part in parts)
+    tags = [_tag(key, nonce, index, pieces) for index, pieces in enumerate(_segments(parts, size))]
+    header = _TABLE.pack(_TABLE_MAGIC, nonce, total, size, len(tags))
+    return header + _tag(key, nonce, _HEADER_INDEX, [header]) + b''.join(tags)
+
+
+def repair_message(table, parts, indices):
+    """
+    Message carrying again some segments of a message
+
+    :param bytes table: table sent in front of the message
+    :param list parts: buffers of the message, without the table
+    :param list[int] indices: numbers of the segments
+    :return: buffers of the repair message
+    :rtype: list
+
+    """
+    _, nonce, _, size, count = _TABLE.unpack_from(table)
+    indices = sorted(set(index for index in indices if 0 <= index < count))
+    wanted = set(indices)
+    repair = [_REPAIR.pack(_REPAIR_MAGIC, nonce, len(indices)), struct.pack('!' + 'I' * len(indices), *indices)]
+    for index, pieces in enumerate(_segments(parts, size)):
+        if index in wanted:
+            repair += pieces
+    return repair
+
+
+class SegmentVerifier:
+    """
+    Checks the segments of a message received with its table in front. It is fed with the bytes of the message as
+    they arrive and never raises an exception, a message without a valid table is just not valid
+
+    :param bytes key: key shared by the nodes
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.valid = None
+        self.nonce = None
+        self.total = None
+        self.segment_size = None
+        self.bad = []
+        self._start = None
+        self._tags = None
+        self._checked = 0
+
+    def _parse(self, buffer, end):
+        """
+        Read the table once it has arrived
+        """
+        if end < _TABLE.size:
+            return
+        magic, nonce, total, size, count = _TABLE.unpack_from(buffer)
+        start = _TABLE.size + INTEGRITY_CONF.digest_size * (count + 1)
+        if magic != _TABLE_MAGIC or size == 0 or count != -(-total // size):
+            self.valid = False
+            return
+        if end < start:
+            return
+        header_tag = bytes(buffer[_TABLE.size:_TABLE.size + INTEGRITY_CONF.digest_size])
+        if not hmac.compare_digest(header_tag, _tag(self.key, nonce, _HEADER_INDEX, [buffer[:_TABLE.size]])):
+            self.valid = False
+            return
+        self.nonce, self.total, self.segment_size = nonce, total, size
+        self._tags = buffer[_TABLE.size + INTEGRITY_CONF.digest_size:start].tobytes()
+        self._start = start
+        self.valid = True
+
+    def _check(self, buffer, index):
+        start = self._start + index * self.segment_size
+        data = buffer[start:min(start + self.segment_size, self._start + self.total)]
+        expected = self._tags[index * INTEGRITY_CONF.digest_size:(index + 1) * INTEGRITY_CONF.digest_size]
+        return hmac.compare_digest(expected, _tag(self.key, self.nonce, index, [data]))
+
+    def update(self, buffer, start, end):
+        """
+        Check the segments completed by some bytes that just arrived
+
+        :param memoryview buffer: buffer the message is received in
+        :param int start: position of the first byte that arrived
+        :param int end: position after the last byte that arrived, the bytes before it have all arrived
+        """
+        try:
+            buffer = memoryview(buffer).cast('B')
+            if self.valid is None:
+                self._parse(buffer, end)
+            if not self.valid:
+                return
+            if end > self._start + self.total:
+                self.valid = False
+                return
+            count = len(self._tags) // INTEGRITY_CONF.digest_size
+            while self._checked < count and \
+                    min(self._start + (self._checked + 1) * self.segment_size, self._start + self.total) <= end:
+                if not self._check(buffer, self._checked):
+                    self.bad.append(self._checked)
+                self._checked += 1
+        except (ValueError, TypeError, struct.error):
+            self.valid = False
+
+    @property
+    def complete(self):
+        """
+        Whether all the segments were checked
+        """
+        return bool(self.valid) and self._checked * INTEGRITY_CONF.digest_size == len(self._tags)
+
+    def payload(self, buffer):
+        """
+        The message without its table
+
+        :param memoryview buffer: buffer the message was received in
+        :rtype: memoryview
+
+        """
+        return memoryview(buffer).cast('B')[self._start:self._start + self.total]
+
+    def repair(self, buffer, message):
+        """
+        Copy into the message the segments of a repair message that are correct. The segments still corrupted stay
+        in ``bad``
+
+        :param memoryview buffer: buffer the message was received in, it must be writable
+        :param message: the repair message, a repair message of another message is ignored
+        :raises IntegrityError: if the repair message is not well formed
+        """
+        view = memoryview(message).cast('B')
+        if len(view) < _REPAIR.size:
+            raise IntegrityError('repair message of {} bytes'.format(len(view)))
+        magic, nonce, count = _REPAIR.unpack_from(view)
+        if magic != _REPAIR_MAGIC:
+            raise IntegrityError('not a repair message')
+        if nonce != self.nonce:
+            return
+        position = _REPAIR.size + 4 * count
+        if position > len(view):
+            raise IntegrityError('repair message of {} bytes with {} segments'.format(len(view), count))
+        indices = struct.unpack_from('!' + 'I' * count, view, _REPAIR.size)
+        segments = len(self._tags) // INTEGRITY_CONF.digest_size
+        if any(index >= segments for index in indices):
+            raise IntegrityError('repair of a segment beyond the {} of the message'.format(segments))
+        buffer = memoryview(buffer).cast('B')
+        bad = set(self.bad)
+        for index in indices:
+            start = self._start + index * self.segment_size
+            length = min(self.segment_size, self._start + self.total - start)
+            segment = view[position:position + length]
+            position += length
+            if index in bad and len(segment) == length and hmac.compare_digest(
+                    self._tags[index * INTEGRITY_CONF.digest_size:(index + 1) * INTEGRITY_CONF.digest_size],
+                    _tag(self.key, self.nonce, index, [segment])):
+                buffer[start:start + length] = segment
+                bad.discard(index)
+        self.bad = sorted(bad)
@@ -0,0 +1,98 @@
+"""
+.. _Interval:
+
+Interval
+========
+Adaptive number of training steps between two synchronizations of a federated process. Averaging the weights every
+few steps costs the full communication of the model even when the local models barely move apart, and averaging them
+rarely lets them drift when they do. After every synchronization :class:`AdaptiveInterval` looks at:
+
+* divergence: distance between the weights of the nodes and the averaged weights, relative to the norm of the
+  averaged weights
+* the time spent communicating in the synchronization against the time spent training since the previous one
+
+and widens the interval when the models stay close or the communication takes too long compared to the training,
+and narrows it when the models diverge. The interval is multiplied or divided by ``INTERVAL_CONF.factor`` and kept
+between ``min_steps`` and ``max_steps``.
+
+:Example:
+>>> interval = AdaptiveInterval(10, min_steps=1, max_steps=1000)
+>>> steps = interval.update(divergence=1e-4, communication=2.0, computation=8.0)
+>>> print(steps)
+20
+
+"""
+import numpy as np
+
+INTERVAL_CONF = lambda x: x
+INTERVAL_CONF.min_steps = 1
+INTERVAL_CONF.max_steps = 1000
+# relative divergence under which the interval is widened
+INTERVAL_CONF.divergence_low = 1e-3
+# relative divergence over which the interval is narrowed
+INTERVAL_CONF.divergence_high = 1e-2
+# communication time over training time above which the interval is widened
+INTERVAL_CONF.ratio_high = 0.5
+INTERVAL_CONF.factor = 2
+
+
+def relative_divergence(local, averaged):
+    """
+    Distance between the weights of a node and the averaged weights, relative to the norm of the averaged weights
+
+    :param list local: weights of the node
+    :param list averaged: averaged weights, with the same shapes
+    :rtype: float
+
+    """
+    distance, norm = 0.0, 0.0
+    for weight, average in zip(local, averaged):
+        average = np.asarray(average).ravel()
+        difference = np.asarray(weight).ravel() - average
+        distance += float(np.dot(difference, difference))
+        norm += float(np.dot(average, average))
+    return (distance / norm) ** 0.5 if norm > 0 else 0.0
+
+
+class AdaptiveInterval:
+    """
+    Steps between two synchronizations, adapted after every synchronization
+
+    :param int steps: initial number of steps
+    :param int,optional min_steps: minimum number of steps
+    :param int,optional max_steps: maximum number of steps
+    """
+
+    def __init__(self, steps, min_steps=None, max_steps=None):
+        self.min_steps = INTERVAL_CONF.min_steps if min_steps is None else min_steps
+        self.max_steps = INTERVAL_CONF.max_steps if max_steps is None else max_steps
+        if not 1 <= self.min_steps <= self.max_steps:
+            raise ValueError('the interval must be between 1 <= {} <= {} steps'.format(self.min_steps,
+                                                                                    self.max_steps))
+        self.steps = min(max(steps, self.min_steps), self.max_steps)
+        self.last_divergence = None
+        self.last_ratio = None
+
+    def update(self, divergence, communication, computation):
+        """
+        Choose the number of steps until the next synchronization
+
+        :param float divergence: relative divergence of the nodes in the last synchronization, None if unknown
+        :param float communication: seconds spent in the last synchronization
+        :param float computation: seconds spent training since the synchronization before
+        :return: number of steps until the next synchronization
+        :rtype: int
+
+        """
+        ratio = communication / computation if computation > 0 else 0.0
+        self.last_divergence = divergence
+        self.last_ratio = ratio
+        if divergence is not None and divergence > INTERVAL_CONF.divergence_high:
+            steps = self.steps // INTERVAL_CONF.factor
+        elif (divergence is not None and divergence < INTERVAL_CONF.divergence_low) \
+                or ratio > INTERVAL_CONF.ratio_high:
+            steps = self.steps * INTERVAL_CONF.factor
+        else:
+            steps = self.steps
+        self.steps = min(max(steps, self.min_steps), self.max_steps)
+        return self.steps
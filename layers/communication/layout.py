@@ -0,0 +1,83 @@
+"""
+.. _Layout:
+
+Layout
+======
+Layout of the weights of a model in a single flat float32 vector. The variables are placed one after the other in the
+order of tf.trainable_variables(), which is the same in every node that builds the same graph, so the weights can be
+read, sent, averaged and assigned as one contiguous buffer instead of one array per variable. :meth:`Layout.unflatten`
+returns views of the vector, the weights are not copied to split them.
+
+:Example:
+>>> layout = Layout([(3, 3), (5,)])
+>>> flat = layout.flatten([np.ones((3, 3)), np.zeros(5)])
+>>> print(flat.shape)
+(14,)
+>>> print([array.shape for array in layout.unflatten([flat])])
+[(3, 3), (5,)]
+
+"""
+import numpy as np
+
+LAYOUT_CONF = lambda x: x
+LAYOUT_CONF.dtype = np.float32
+
+
+class Layout:
+    """
+    Position of every variable of a model in the flat vector
+
+    :param list shapes: shapes of the variables, in the order of the vector
+    """
+
+    def __init__(self, shapes):
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape, dtype=np.int64)) for shape in self.shapes]
+        self.offsets = [int(offset) for offset in np.cumsum([0] + self.sizes)]
+        self.size = self.offsets[-1]
+
+    def is_flat(self, arrays):
+        """
+        Whether some weights are already the flat vector of the model
+
+        :param list arrays: numpy arrays
+        :rtype: bool
+
+        """
+        return len(arrays) == 1 and np.ndim(arrays[0]) == 1 and np.size(arrays[0]) == self.size
+
+    def flatten(self, arrays):
+        """
+        Flat vector of some weights
+
+        :param list arrays: numpy arrays of the variables, or the flat vector itself
+        :return: the flat vector, the given one if the weights were already a flat float32 vector
+        :rtype: numpy.ndarray
+
+        """
+        if self.is_flat(arrays):
+            return np.asarray(arrays[0], dtype=LAYOUT_CONF.dtype)
+        if len(arrays) != len(self.shapes):
+            raise ValueError('expected the weights of {} variables, got {} arrays'.format(len(self.shapes),
+                                                                                      len(arrays)))
+        flat = np.empty(self.size, dtype=LAYOUT_CONF.dtype)
+        for array, offset, size in zip(arrays, self.offsets, self.sizes):
+            flat[offset:offset + size] = np.ravel(array)
+        return flat
+
+    def unflatten(self, arrays):
+        """
+        Weights of every variable of a flat vector
+
+        :param list arrays: the flat vector in a list, or the arrays of the variables
+        :return: views of the vector with the shapes of the variables, the given arrays if they were not flat
+        :rtype: list
+
+        """
+        if len(arrays) == len(self.shapes) and not self.is_flat(arrays):
+            return arrays
+        if len(arrays) != 1 or np.size(arrays[0]) != self.size:
+            raise ValueError('expected a flat vector of {} values'.format(self.size))
+        flat = np.ravel(arrays[0])
+        return [flat[offset:offset + size].reshape(shape)
+                for shape, offset, size in zip(self.shapes, self.offsets, self.sizes)]
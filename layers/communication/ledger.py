@@ -0,0 +1,242 @@
+"""
+.. _Ledger:
+
+Ledger
+======
+Background journal of the records that the federated processes write in the BSMD. Writing a record is a
+transaction with its own channel, signature and wait for its status, so the nodes do not write them while they
+train. The records are queued by a :class:`LedgerJournal` instead, the same record of a round is queued only once,
+and a background thread commits them packed in transactions of up to ``LEDGER_CONF.batch_size`` commands.
+
+Failed transactions are retried ``LEDGER_CONF.attempts`` times. The queued records are committed before the program
+exits, or when :func:`flush_journals` is called.
+
+:Example:
+>>> journal = get_journal('worker1', private_key, 'federated', ip)
+>>> journal.record(iteration, ['chief'], 'worker1_weight', transaction)
+>>> print(journal.queue_depth())
+1
+>>> journal.flush()
+
+"""
+import atexit
+import collections
+import threading
+import time
+from utils.iroha import set_details_to_nodes
+
+LEDGER_CONF = lambda x: x
+# commands packed in a transaction
+LEDGER_CONF.batch_size = 50
+# seconds to wait for more records before writing a transaction that is not full
+LEDGER_CONF.flush_interval = 1
+LEDGER_CONF.attempts = 5
+# seconds before retrying a failed transaction, doubled after every failure
+LEDGER_CONF.retry_delay = 1
+# seconds to wait for the queued records when the program ends
+LEDGER_CONF.exit_timeout = 60
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+class LedgerJournal:
+    """
+    Queue of the records of a node, written in the BSMD in the background
+
+    :param str sender: name of the node writing the records
+    :param str private_key: private key of the node
+    :param str domain: name of the domain
+    :param str ip: ip address for connecting to the BSMD
+    """
+
+    def __init__(self, sender, private_key, domain, ip):
+        self.sender = sender
+        self.private_key = private_key
+        self.domain = domain
+        self.ip = ip
+        # (iteration, receiver, detail key) -> detail value, in the order they were recorded
+        self._pending = collections.OrderedDict()
+        # records of the last rounds already taken from the queue, by round
+        self._taken = {}
+        self._condition = threading.Condition()
+        self._writing = 0
+        self._closed = False
+        self.statistics = {'recorded': 0, 'duplicated': 0, 'committed': 0, 'transactions': 0, 'failures': 0,
+                           'dropped': 0, 'seconds': 0.0}
+        self._thread = threading.Thread(target=self._run, name='ledger_journal', daemon=True)
+        self._thread.start()
+
+    def record(self, iteration, receivers, detail_key, detail_value):
+        """
+        Queue a record for some nodes. A record already queued for the same round and node is not written twice
+
+        :param int iteration: round of the record
+        :param list[str] receivers: names of the nodes in which the detail is written
+        :param str detail_key: name of the detail
+        :param str detail_value: value of the detail
+        """
+        with self._condition:
+            for receiver in receivers:
+                key = (iteration, receiver, detail_key)
+                if key in self._pending or key in self._taken.get(iteration, ()):
+                    self.statistics['duplicated'] += 1
+                    continue
+                self._pending[key] = detail_value
+                self.statistics['recorded'] += 1
+            self._condition.notify_all()
+
+    def queue_depth(self):
+        """
+        Records waiting to be written, including those being written
+
+        :rtype: int
+
+        """
+        with self._condition:
+            return len(self._pending) + self._writing
+
+    def _next_batch(self):
+        """
+        Wait for records and take the next batch, None when the journal is closed and empty
+        """
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if not self._pending:
+                return None
+            # give the records of the round some time to arrive, so the transaction is full
+            deadline = time.time() + LEDGER_CONF.flush_interval
+            while len(self._pending) < LEDGER_CONF.batch_size and not self._closed and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+            batch = []
+            while self._pending and len(batch) < LEDGER_CONF.batch_size:
+                batch.append(self._pending.popitem(last=False))
+                self._taken.setdefault(batch[-1][0][0], set()).add(batch[-1][0])
+            # only the rounds that can still be recorded again are remembered
+            for iteration in sorted(self._taken)[:-2]:
+                del self._taken[iteration]
+            self._writing = len(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            details = [(receiver, detail_key, value) for (_, receiver, detail_key), value in batch]
+            delay = LEDGER_CONF.retry_delay
+            start = time.time()
+            for attempt in range(LEDGER_CONF.attempts):
+                try:
+                    set_details_to_nodes(self.sender, self.private_key, details, self.domain, self.ip)
+                    self.statistics['committed'] += len(details)
+                    self.statistics['transactions'] += 1
+                    break
+                except Exception as error:
+                    self.statistics['failures'] += 1
+                    print('Could not write {} records in the BSMD ({}), attempt {}'.format(len(details), error,
+                                                                                         attempt + 1))
+                    time.sleep(delay)
+                    delay *= 2
+            else:
+                self.statistics['dropped'] += len(details)
+            self.statistics['seconds'] += time.time() - start
+            with self._condition:
+                self._writing = 0
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued records are written
+
+        :param float,optional timeout: seconds to wait
+        :return: whether all the records were written
+        :rtype: bool
+
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self._condition:
+            self._condition.notify_all()
+            while self._pending or self._writing:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def close(self, timeout=None):
+        """
+        Write the queued records and stop the journal
+
+        :param float,optional timeout: seconds to wait for the records to be written
+        :return: whether all the records were written
+        :rtype: bool
+
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+
+def get_journal(sender, private_key, domain, ip):
+    """
+    Journal of a node, created the first time it is needed
+
+    :param str sender: name of the node writing the records
+    :param str private_key: private key of the node
+    :param str domain: name of the domain
+    :param str ip: ip address for connecting to the BSMD
+    :rtype: LedgerJournal
+
+    """
+    with _journals_lock:
+        journal = _journals.get((sender, domain, ip))
+        if journal is None:
+            journal = LedgerJournal(sender, private_key, domain, ip)
+            _journals[(sender, domain, ip)] = journal
+        return journal
+
+
+def queue_depth():
+    """
+    Records waiting to be written in all the journals
+
+    :rtype: int
+
+    """
+    with _journals_lock:
+        journals = list(_journals.values())
+    return sum(journal.queue_depth() for journal in journals)
+
+
+def write_seconds():
+    """
+    Seconds spent writing transactions in the BSMD by all the journals, with the retries
+
+    :rtype: float
+
+    """
+    with _journals_lock:
+        journals = list(_journals.values())
+    return sum(journal.statistics['seconds'] for journal in journals)
+
+
+def flush_journals(timeout=None):
+    """
+    Write the records queued in all the journals and stop them
+
+    :param float,optional timeout: seconds to wait for every journal
+    """
+    with _journals_lock:
+        journals = list(_journals.values())
+        _journals.clear()
+    for journal in journals:
+        if not journal.close(timeout):
+            print('{} records of {} were not written in the BSMD'.format(journal.queue_depth(), journal.sender))
+
+
+# the records of the last round are written even if the program ends without flushing them
+atexit.register(lambda: flush_journals(LEDGER_CONF.exit_timeout))
@@ -0,0 +1,344 @@
+"""
+.. _Metrics:
+
+Metrics
+=======
+Instrumentation of the rounds of the federated processes of the BSMD. A :class:`RoundMetrics` adds up the seconds
+spent in every phase of a round and the bytes exchanged, in total and by peer. When the round ends they are written
+as a line of a JSONL file, rotated when it grows over ``METRICS_CONF.max_bytes``, and added to the totals offered in
+the text format of Prometheus by :func:`start_endpoint`.
+
+The phases of a round are:
+
+* read: reading the weights from the graph with session.run
+* serialize: quantizing or sparsifying, encoding, storing (see :ref:`BlobStore`) and signing the weights
+* deserialize: decoding, dequantizing and densifying the weights received
+* wait: waiting for the stragglers, on the nodes that gather the weights of others
+* aggregate: averaging or mixing the weights
+* ledger: writing the records in the BSMD, done in the background (see :ref:`Ledger`)
+* assign: injecting the weights into the graph with session.run
+
+and, by peer:
+
+* send: sending the weights until the peer acknowledges them
+* write: writing the weights into the session or the shared memory, the part of send before the acknowledgement
+* receive: transfer of the weights received, from their first to their last byte
+* wait: waiting for the weights of the peer before they start arriving
+* sent, received: bytes on the wire, after compression and with the framing
+* message_sent, message_received: bytes of the messages, before compression and framing
+
+The transfers that end after the round, e.g., the averaged weights still being sent, are counted in the next round.
+
+:Example:
+>>> metrics = RoundMetrics('chief', 'chief.jsonl')
+>>> with metrics.timer('send', peer='worker1'):
+...     session.send(message)
+>>> record = metrics.end_round(12, connections=[('worker1', session.connection)])
+>>> print(record['peers']['worker1']['send'])
+0.0132
+>>> start_endpoint(9100)
+
+"""
+import contextlib
+import http.server
+import json
+import logging
+import logging.handlers
+import os
+import tempfile
+import threading
+import time
+import weakref
+
+METRICS_CONF = lambda x: x
+METRICS_CONF.directory = os.path.join(tempfile.gettempdir(), 'bsmd_metrics')
+# bytes of the JSONL file before it is rotated, and rotated files kept
+METRICS_CONF.max_bytes = 10 * 1024 * 1024
+METRICS_CONF.backups = 5
+METRICS_CONF.phases = ['read', 'serialize', 'deserialize', 'wait', 'aggregate', 'ledger', 'assign']
+METRICS_CONF.peer_phases = ['send', 'write', 'receive', 'wait']
+
+_registry = weakref.WeakSet()
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+def default_path(name):
+    """
+    Path of the JSONL file of a node
+
+    :param str name: name of the node in the BSMD
+    :rtype: str
+
+    """
+    return os.path.join(METRICS_CONF.directory, name.replace(os.sep, '_') + '.jsonl')
+
+
+def measure(metrics, phase, peer=None):
+    """
+    Timer of a phase in some metrics, that does nothing if there are no metrics
+
+    :param RoundMetrics metrics: metrics of the round, or None
+    :param str phase: name of the phase
+    :param str,optional peer: name of the peer, None for a phase of the round
+    """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.timer(phase, peer)
+
+
+class RoundMetrics:
+    """
+    Seconds and bytes of the rounds of a node. The phases can be timed from several threads at the same time
+
+    :param str name: name of the node
+    :param str,optional path: path of the JSONL file, None to not write the rounds
+    :param int,optional max_bytes: bytes of the file before it is rotated
+    :param int,optional backups: rotated files kept
+    """
+
+    def __init__(self, name, path=None, max_bytes=None, backups=None):
+        self.name = name
+        self.path = path
+        self._lock = threading.Lock()
+        self._round = None
+        self._peers = None
+        self._bytes = None
+        self._start = None
+        self._reset()
+        # totals of all the rounds, and the last round
+        self.rounds = 0
+        self.totals = dict((phase, 0.0) for phase in METRICS_CONF.phases + ['total'])
+        self.peer_totals = {}
+        self.byte_totals = {'sent': 0, 'received': 0}
+        self.last = None
+        # bytes on the wire of every connection when the last round ended
+        self._marks = {}
+        self._handler = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=METRICS_CONF.max_bytes if max_bytes is None else max_bytes,
+                backupCount=METRICS_CONF.backups if backups is None else backups)
+        _registry.add(self)
+
+    def _reset(self):
+        self._round = dict((phase, 0.0) for phase in METRICS_CONF.phases)
+        self._peers = {}
+        self._bytes = {'sent': 0, 'received': 0}
+        self._start = time.time()
+
+    def _peer(self, peer):
+        if peer not in self._peers:
+            self._peers[peer] = dict((phase, 0.0) for phase in METRICS_CONF.peer_phases)
+            self._peers[peer].update(sent=0, received=0, message_sent=0, message_received=0)
+        return self._peers[peer]
+
+    def add(self, phase, seconds, peer=None):
+        """
+        Add some seconds to a phase of the round
+
+        :param str phase: name of the phase
+        :param float seconds: seconds spent in the phase
+        :param str,optional peer: name of the peer, None for a phase of the round
+        """
+        with self._lock:
+            times = self._round if peer is None else self._peer(peer)
+            times[phase] = times.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, phase, peer=None):
+        """
+        Time a block of code as a phase of the round
+
+        :param str phase: name of the phase
+        :param str,optional peer: name of the peer, None for a phase of the round
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start, peer)
+
+    def call(self, phase, peer, function, *args):
+        """
+        Call a function timing it as a phase of the round, e.g., in a pool of threads
+
+        :param str phase: name of the phase
+        :param str peer: name of the peer, None for a phase of the round
+        :param function function: function to be called with the rest of the arguments
+        :return: what the function returns
+        """
+        with self.timer(phase, peer):
+            return function(*args)
+
+    def count(self, direction, size, peer=None):
+        """
+        Add the bytes of a message to the round, before compression and framing
+
+        :param str direction: sent or received
+        :param int size: bytes of the message
+        :param str,optional peer: name of the peer the message was exchanged with
+        """
+        with self._lock:
+            self._bytes[direction] += size
+            if peer is not None:
+                self._peer(peer)['message_' + direction] += size
+
+    def end_round(self, iteration, connections=None, **values):
+        """
+        Close the round: write it in the JSONL file, add it to the totals and start the next one
+
+        :param int iteration: iteration of the round
+        :param list,optional connections: name of the peer and connection with it, for every connection of the
+                                          node, to measure the bytes on the wire
+        :param values: other JSON serializable values of the round, e.g., the number of workers
+        :return: the record of the round
+        :rtype: dict
+
+        """
+        end = time.time()
+        with self._lock:
+            marks = {}
+            for peer, connection in connections or []:
+                if connection is None or connection in marks:
+                    continue
+                sent, received = self._marks.get(connection, (0, 0))
+                marks[connection] = (connection.bytes_sent, connection.bytes_received)
+                wire = self._peer(peer)
+                wire['sent'] += marks[connection][0] - sent
+                wire['received'] += marks[connection][1] - received
+            # the connections that were closed are forgotten
+            self._marks = marks
+            record = {'time': end, 'node': self.name, 'iteration': int(iteration), 'seconds': end - self._start}
+            record.update(values)
+            record['phases'] = self._round
+            record['bytes'] = self._bytes
+            record['peers'] = self._peers
+            self._reset()
+            self.rounds += 1
+            self.totals['total'] += record['seconds']
+            for phase, seconds in record['phases'].items():
+                self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+            for direction, size in record['bytes'].items():
+                self.byte_totals[direction] += size
+            for peer, times in record['peers'].items():
+                totals = self.peer_totals.setdefault(peer, {})
+                for phase, value in times.items():
+                    totals[phase] = totals.get(phase, 0) + value
+            self.last = record
+        if self._handler is not None:
+            self._handler.emit(logging.makeLogRecord({'msg': json.dumps(record)}))
+        return record
+
+    def exposition(self):
+        """
+        Totals of the rounds in the text format of Prometheus
+
+        :rtype: str
+
+        """
+        node = _label(self.name)
+        with self._lock:
+            lines = ['bsmd_rounds_total{{node="{}"}} {}'.format(node, self.rounds)]
+            for phase, seconds in self.totals.items():
+                lines.append('bsmd_phase_seconds_total{{node="{}",phase="{}"}} {}'.format(node, phase, seconds))
+            for direction, size in self.byte_totals.items():
+                lines.append('bsmd_bytes_total{{node="{}",direction="{}"}} {}'.format(node, direction, size))
+            for peer, totals in self.peer_totals.items():
+                for phase, value in totals.items():
+                    if phase in ('sent', 'received'):
+                        lines.append('bsmd_peer_wire_bytes_total{{node="{}",peer="{}",direction="{}"}} {}'.format(
+                            node, _label(peer), phase, value))
+                    elif phase.startswith('message_'):
+                        lines.append('bsmd_peer_message_bytes_total{{node="{}",peer="{}",direction="{}"}} {}'.format(
+                            node, _label(peer), phase[len('message_'):], value))
+                    else:
+                        lines.append('bsmd_peer_seconds_total{{node="{}",peer="{}",phase="{}"}} {}'.format(
+                            node, _label(peer), phase, value))
+            if self.last is not None:
+                lines.append('bsmd_last_round_iteration{{node="{}"}} {}'.format(node, self.last['iteration']))
+                lines.append('bsmd_last_round_seconds{{node="{}",phase="total"}} {}'.format(node,
+                                                                                          self.last['seconds']))
+                for phase, seconds in self.last['phases'].items():
+                    lines.append('bsmd_last_round_seconds{{node="{}",phase="{}"}} {}'.format(node, phase, seconds))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        """
+        Close the JSONL file
+        """
+        if self._handler is not None:
+            self._handler.close()
+            self._handler = None
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_HELP = [
+    ('bsmd_rounds_total', 'counter', 'Rounds finished by the node'),
+    ('bsmd_phase_seconds_total', 'counter', 'Seconds spent by the node in every phase of the rounds'),
+    ('bsmd_bytes_total', 'counter', 'Bytes of the weights exchanged by the node, before compression'),
+    ('bsmd_peer_seconds_total', 'counter', 'Seconds spent sending to, receiving from and waiting for every peer'),
+    ('bsmd_peer_wire_bytes_total', 'counter', 'Bytes on the wire exchanged with every peer'),
+    ('bsmd_peer_message_bytes_total', 'counter', 'Bytes of the messages exchanged with every peer, before compression'),
+    ('bsmd_last_round_iteration', 'gauge', 'Iteration of the last round'),
+    ('bsmd_last_round_seconds', 'gauge', 'Seconds spent in every phase of the last round'),
+]
+
+
+def exposition():
+    """
+    Metrics of all the nodes of this program in the text format of Prometheus
+
+    :rtype: str
+
+    """
+    samples = ''.join(metrics.exposition() for metrics in list(_registry))
+    lines = []
+    for name, kind, description in _HELP:
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines += [line for line in samples.splitlines() if line.startswith(name + '{')]
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the scrapes are not printed
+        pass
+
+
+def start_endpoint(port, host=''):
+    """
+    Offer the metrics of all the nodes of this program to Prometheus, at http://host:port/metrics. The endpoint is
+    started once by port
+
+    :param int port: port of the endpoint, 0 for any free port
+    :param str,optional host: local ip address, all of them by default
+    :return: the HTTP server of the endpoint
+    :rtype: http.server.ThreadingHTTPServer
+
+    """
+    with _endpoints_lock:
+        server = _endpoints.get((host, port))
+        if server is None:
+            server = http.server.ThreadingHTTPServer((host, port), _Handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='metrics_endpoint', daemon=True).start()
+            _endpoints[(host, port)] = server
+        return server
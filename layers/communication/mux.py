@@ -0,0 +1,721 @@
+"""
+.. _Mux:
+
+Mux
+===
+Multiplexing of many logical streams over a single connection between two nodes. Every message sent on a stream is
+split in chunks, and the chunks of all the streams are written by a single writer ordered by the priority of their
+stream, so a control message can overtake a bulk transfer that is already in progress. On the other end a reader
+puts the chunks back together in a buffer allocated with the size of the message and delivers complete messages to
+the stream they belong to. The size of a message comes from the peer, so a message larger than
+``MUX_CONF.max_message_size`` closes the connection before a buffer is allocated for it.
+
+Large messages, of at least ``MUX_CONF.chunk_size`` bytes, are only sent once the receiver granted them a buffer.
+The sender asks for it, and the receiver reserves it in the receive budget (see ``MUX_CONF.receive_budget``) in a
+thread of the connection other than the reader, so while the budget is used up only the large messages wait: the
+reader keeps delivering the control messages and the heartbeats of the connection. The messages sent on a stream after
+a large message that was not granted yet wait for it, so the messages of a stream are delivered in order.
+
+A stream can have an inspector, a function that returns an object with an ``update(buffer, start, end)`` method for
+every message. The reader calls it every time a chunk lands, so the message can be checked while it arrives (see
+:ref:`Integrity`), and :meth:`Stream.recv` leaves the object of the message in ``stream.inspection``. Compressed
+messages are not inspected, so the messages of a stream whose ``compressed`` attribute is False are never compressed.
+
+Compressed messages are decompressed by :meth:`Stream.recv`, in the thread of the receiver, and never beyond
+``MUX_CONF.max_message_size`` bytes. A connection whose peer is not authenticated yet (see :ref:`Session`) only
+accepts uncompressed messages, a compressed one closes it before anything is decompressed.
+
+Connections opened with :func:`get_connection` are shared: there is at most one connection per peer, no matter how
+many streams (jobs, chats, transfers) two nodes have open.
+
+:On node1 run:
+>>> def on_stream(stream):
+...     print(stream.label, stream.recv())
+>>> listener = MultiplexedListener('123.456.789', 5555, on_stream)
+>>> listener.start()
+>>> listener.wait_listening()
+
+:On node2 run:
+>>> connection = get_connection('123.456.789', 5555)
+>>> control = connection.open_stream('job1/control', MUX_CONF.priority_control)
+>>> weights = connection.open_stream('job1/weights', MUX_CONF.priority_bulk)
+>>> weights.send(large_payload, wait=False)
+>>> control.send(b'stop')  # it is delivered before the end of large_payload
+
+"""
+import collections
+import itertools
+import queue
+import socket
+import struct
+import threading
+import time
+import weakref
+import numpy as np
+from layers.communication.tls import wrap_server_socket, connect, remember_session
+from layers.communication.compression import CODECS, AdaptiveCompressor, negotiate, decompress
+from layers.communication.framing import FrameTooLarge, recv_into_exactly
+
+MUX_CONF = lambda x: x
+MUX_CONF.chunk_size = 64 * 1024
+# lower numbers are written first
+MUX_CONF.priority_control = 0
+MUX_CONF.priority_default = 4
+MUX_CONF.priority_bulk = 8
+# bytes of large messages that all the connections of the process can be receiving at the same time, None is no
+# limit. When the budget is used up the next large messages are not granted until a buffer is released, so the
+# peers wait instead of filling the memory, and the small messages keep flowing
+MUX_CONF.receive_budget = None
+# seconds a listener has to open its socket
+MUX_CONF.listen_timeout = 10
+# bytes of the largest message accepted from a peer, checked before its buffer is allocated. The weights of larger
+# models need a larger value
+MUX_CONF.max_message_size = 2 * 1024 * 1024 * 1024
+
+# stream id, flags, length of the chunk, length of the whole message
+_HEADER = struct.Struct('!IBIQ')
+_FLAG_OPEN = 1
+_FLAG_START = 2
+_FLAG_END = 4
+_FLAG_CLOSE = 8
+# the sender asks for a buffer for a large message, and the receiver grants it
+_FLAG_REQUEST = 16
+_FLAG_GRANT = 32
+
+
+class StreamClosed(ConnectionError):
+    """
+    The stream or its connection was closed
+    """
+
+
+_budget = threading.Condition()
+_budget_used = 0
+
+
+def _reserve(size, connection):
+    """
+    Wait until a message of the given size fits in the receive budget and reserve it
+
+    :raises StreamClosed: if the connection is closed while waiting
+    """
+    global _budget_used
+    with _budget:
+        while (MUX_CONF.receive_budget is not None and _budget_used > 0 and
+               _budget_used + size > MUX_CONF.receive_budget):
+            if connection.closed:
+                raise StreamClosed('connection closed while waiting for the receive budget')
+            _budget.wait(1)
+        _budget_used += size
+
+
+def _release(size):
+    global _budget_used
+    with _budget:
+        _budget_used -= size
+        _budget.notify_all()
+
+
+def receive_budget_used():
+    """
+    Bytes of the receive budget in use, see MUX_CONF.receive_budget
+
+    :rtype: int
+
+    """
+    with _budget:
+        return _budget_used
+
+
+class Stream:
+    """
+    Logical stream inside a :class:`MultiplexedConnection`. Messages are delivered complete and in order
+
+    :param MultiplexedConnection connection: connection carrying the stream
+    :param int stream_id: id of the stream in the connection
+    :param str label: name of the stream, e.g., job1/weights
+    :param int priority: priority of the messages sent on the stream, lower is first
+    """
+
+    def __init__(self, connection, stream_id, label, priority):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.label = label
+        self.priority = priority
+        self.closed = False
+        # whether the messages sent on the stream may be compressed
+        self.compressed = True
+        # function returning the inspector of every message, and the inspector of the last message received
+        self.inspector = None
+        self.inspection = None
+        # seconds from the first to the last chunk of the last message received
+        self.transfer = None
+        self._messages = queue.Queue()
+
+    def send(self, data, wait=True):
+        """
+        Send a message
+
+        :param bytes data: message to be sent, any object supporting the buffer protocol, or a list of them that
+                           is sent as a single message without joining the buffers
+        :param bool,optional wait: wait until the whole message was written to the connection. If False the
+                                   buffers must not be modified until they are written
+        """
+        if self.closed:
+            raise StreamClosed('stream {} is closed'.format(self.label))
+        self.connection._send(self, data, wait)
+
+    def recv(self, timeout=None):
+        """
+        Receive the next message of the stream
+
+        :param float,optional timeout: seconds to wait for the message
+        :return: the message, a view of the buffer it was received in
+        :rtype: memoryview
+
+        """
+        try:
+            message = self._messages.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout('no message in stream {}'.format(self.label))
+        if message is None:
+            self._messages.put(None)
+            raise StreamClosed('stream {} is closed'.format(self.label))
+        message, self.inspection, self.transfer = message
+        if self.connection.compressor is not None:
+            message = self.connection._decompress(message)
+        return message
+
+    def _end(self):
+        self.closed = True
+        self._messages.put(None)
+
+    def close(self):
+        """
+        Close the stream in both ends of the connection
+        """
+        if not self.closed:
+            self.closed = True
+            self.connection._close_stream(self)
+
+
+class MultiplexedConnection:
+    """
+    Carries many prioritized streams over one connection
+
+    :param socket.socket sock: a socket with a connection already established, plain or TLS
+    :param bool server_side: whether this end accepted the connection
+    :param function,optional on_stream: function called in a new thread with every stream opened by the peer. If
+                                        None the streams are available with :meth:`accept_stream`
+    :param bool,optional compression: negotiate the compression of the messages with the peer
+    :param bool,optional authenticated: whether the peer is trusted to send compressed messages. If False they are
+                                        refused until ``authenticated`` is set, e.g., by the session once the peer
+                                        proved who it is
+    """
+
+    def __init__(self, sock, server_side, on_stream=None, compression=False, authenticated=True):
+        self._sock = sock
+        self._on_stream = on_stream
+        # the ids of streams opened by each end never collide
+        self._next_id = 2 if server_side else 1
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._accepted = queue.Queue()
+        # messages waiting for the grant of a large message, by stream id, and buffers granted to the peer
+        self._waiting = {}
+        self._granted = {}
+        self._requests = queue.Queue()
+        self._granter = None
+        self.closed = False
+        self.authenticated = authenticated
+        self.last_activity = time.time()
+        # bytes written to and read from the socket, with the headers of the chunks
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        try:
+            self.address = sock.getpeername()
+            self.local_address = sock.getsockname()
+        except OSError:
+            self.address = None
+            self.local_address = None
+        self.compressor = None
+        if compression:
+            self.compressor = AdaptiveCompressor(negotiate(sock, server_side))
+        # the socket is closed by the last of the reader and the writer to end
+        self._loops = 2
+        self._writer = threading.Thread(target=self._write_loop, name='mux_writer', daemon=True)
+        self._reader = threading.Thread(target=self._read_loop, name='mux_reader', daemon=True)
+        self._writer.start()
+        self._reader.start()
+
+    def open_stream(self, label='', priority=MUX_CONF.priority_default):
+        """
+        Open a new stream
+
+        :param str,optional label: name of the stream, the peer can use it to route the stream
+        :param int,optional priority: priority of the messages of the stream in both ends, lower is first
+        :return: the stream
+        :rtype: Stream
+
+        """
+        with self._lock:
+            if self.closed:
+                raise StreamClosed('connection is closed')
+            stream_id = self._next_id
+            self._next_id += 2
+            stream = Stream(self, stream_id, label, priority)
+            self._streams[stream_id] = stream
+        self._enqueue(priority, stream_id, _FLAG_OPEN, bytes([priority]) + label.encode('utf-8'))
+        return stream
+
+    def accept_stream(self, timeout=None):
+        """
+        Wait for a stream opened by the peer
+
+        :param float,optional timeout: seconds to wait
+        :return: the stream
+        :rtype: Stream
+
+        """
+        try:
+            stream = self._accepted.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout('no stream was opened')
+        if stream is None:
+            self._accepted.put(None)
+            raise StreamClosed('connection is closed')
+        return stream
+
+    def _enqueue(self, priority, stream_id, flags, chunk, total=0, done=None):
+        self._queue.put((priority, next(self._sequence), (stream_id, flags, chunk, total, done)))
+
+    def _send(self, stream, data, wait):
+        if self.closed:
+            raise StreamClosed('connection is closed')
+        parts = list(data) if isinstance(data, (list, tuple)) else [data]
+        if self.compressor is not None:
+            if stream.compressed:
+                parts = self.compressor.compress_parts(parts)
+            else:
+                parts = [bytes([CODECS['none'][0]])] + parts
+        views = [view for view in (memoryview(part).cast('B') for part in parts) if len(view)] or [memoryview(b'')]
+        total = sum(len(view) for view in views)
+        done = threading.Event()
+        done.sent = False
+        done.started = time.perf_counter()
+        # a chunk never spans two buffers, so the buffers are never joined
+        chunks = [view[offset:offset + MUX_CONF.chunk_size] for view in views
+                  for offset in range(0, max(len(view), 1), MUX_CONF.chunk_size)]
+        message = (stream.priority, stream.stream_id, chunks, total, done)
+        large = total >= MUX_CONF.chunk_size
+        with self._lock:
+            waiting = self._waiting.get(stream.stream_id)
+            if large or waiting:
+                # the chunks are sent once the peer grants the buffer, after those of the earlier messages
+                self._waiting.setdefault(stream.stream_id, collections.deque()).append((large, message))
+            else:
+                self._enqueue_message(*message)
+            if large:
+                # the requests of a stream are granted in the order its messages wait
+                self._enqueue(MUX_CONF.priority_control, stream.stream_id, _FLAG_REQUEST, b'', total)
+        if wait:
+            # a message queued after the writer woke up the senders of a closed connection is never written
+            while not done.wait(1):
+                if self.closed and not self._writer.is_alive():
+                    break
+            if self.closed and not done.sent:
+                raise StreamClosed('connection closed before the message was sent')
+
+    def _enqueue_message(self, priority, stream_id, chunks, total, done):
+        """
+        Queue the chunks of a message for the writer, or the close of the stream if there are no chunks
+        """
+        if chunks is None:
+            self._enqueue(priority, stream_id, _FLAG_CLOSE, b'')
+            return
+        for index, chunk in enumerate(chunks):
+            flags = 0
+            if index == 0:
+                flags |= _FLAG_START
+            if index == len(chunks) - 1:
+                flags |= _FLAG_END
+            self._enqueue(priority, stream_id, flags, chunk, total, done if index == len(chunks) - 1 else None)
+
+    def _on_grant(self, stream_id):
+        """
+        Send the large message the peer granted a buffer to, and the messages of the stream that were waiting for it
+        """
+        with self._lock:
+            waiting = self._waiting.get(stream_id)
+            if not waiting:
+                raise ConnectionResetError('grant of a message that was not requested')
+            _, message = waiting.popleft()
+            self._enqueue_message(*message)
+            while waiting and not waiting[0][0]:
+                _, message = waiting.popleft()
+                self._enqueue_message(*message)
+            if not waiting:
+                del self._waiting[stream_id]
+
+    def _grant_loop(self):
+        """
+        Reserve the buffers of the large messages the peer asks for, in the order it asks for them, and grant them
+        """
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            stream_id, total = request
+            try:
+                buffer = self.allocate(total)
+            except StreamClosed:
+                break
+            with self._lock:
+                if self.closed:
+                    break
+                self._granted.setdefault(stream_id, collections.deque()).append(buffer)
+            self._enqueue(MUX_CONF.priority_control, stream_id, _FLAG_GRANT, b'', total)
+            # do not keep the last buffer alive while waiting for the next request
+            buffer = None
+
+    def _request(self, stream_id, total):
+        """
+        Pass the request of a buffer for a large message of the peer to the thread that grants them
+        """
+        if total > MUX_CONF.max_message_size:
+            raise FrameTooLarge('message of {} bytes, at most {} are accepted'.format(total, MUX_CONF.max_message_size))
+        if self._granter is None:
+            self._granter = threading.Thread(target=self._grant_loop, name='mux_granter', daemon=True)
+            self._granter.start()
+        self._requests.put((stream_id, total))
+
+    def _take_grant(self, stream_id, total):
+        """
+        Buffer granted to a large message of the peer when it starts to arrive
+        """
+        with self._lock:
+            granted = self._granted.get(stream_id)
+            buffer = granted.popleft() if granted else None
+            if granted is not None and not granted:
+                del self._granted[stream_id]
+        if buffer is None or len(buffer) != total:
+            raise ConnectionResetError('large message that was not granted')
+        return buffer
+
+    def _close_stream(self, stream):
+        with self._lock:
+            self._streams.pop(stream.stream_id, None)
+            waiting = self._waiting.get(stream.stream_id)
+            if waiting:
+                # the stream is closed after the messages that wait for a grant
+                waiting.append((False, (stream.priority, stream.stream_id, None, 0, None)))
+                return
+        if not self.closed:
+            self._enqueue(stream.priority, stream.stream_id, _FLAG_CLOSE, b'')
+
+    def _write_loop(self):
+        try:
+            while True:
+                _, _, item = self._queue.get()
+                if item is None:
+                    break
+                stream_id, flags, chunk, total, done = item
+                self._sock.sendall(_HEADER.pack(stream_id, flags, len(chunk), total))
+                if len(chunk):
+                    self._sock.sendall(chunk)
+                self.bytes_sent += _HEADER.size + len(chunk)
+                if done is not None:
+                    done.sent = True
+                    done.set()
+                    if self.compressor is not None:
+                        self.compressor.record_transfer(total, time.perf_counter() - done.started)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._shutdown()
+            # wake up the senders still waiting
+            while not self._queue.empty():
+                _, _, item = self._queue.get()
+                if item is not None and item[4] is not None:
+                    item[4].set()
+            self._loop_ended()
+
+    def _read_loop(self):
+        header = bytearray(_HEADER.size)
+        # messages being received, stream id: (buffer, bytes received, inspector, time of the first chunk)
+        partial = {}
+        remembered = False
+        try:
+            while recv_into_exactly(self._sock, memoryview(header)):
+                self.last_activity = time.time()
+                if not remembered:
+                    # with TLS 1.3 the ticket of a client connection arrives after the handshake, before the data of
+                    # the server, so the next connection with the peer resumes the session
+                    remember_session(self._sock)
+                    remembered = True
+                stream_id, flags, length, total = _HEADER.unpack(header)
+                self.bytes_received += _HEADER.size + length
+                if flags & _FLAG_OPEN:
+                    if length > MUX_CONF.chunk_size:
+                        raise FrameTooLarge('label of {} bytes'.format(length))
+                    payload = bytearray(length)
+                    recv_into_exactly(self._sock, memoryview(payload))
+                    stream = Stream(self, stream_id, payload[1:].decode('utf-8'), payload[0])
+                    with self._lock:
+                        self._streams[stream_id] = stream
+                    if self._on_stream is not None:
+                        threading.Thread(target=self._on_stream, args=(stream,), daemon=True).start()
+                    else:
+                        self._accepted.put(stream)
+                    continue
+                if flags & (_FLAG_REQUEST | _FLAG_GRANT):
+                    if length:
+                        raise ConnectionResetError('request or grant with a payload')
+                    if flags & _FLAG_REQUEST:
+                        self._request(stream_id, total)
+                    else:
+                        self._on_grant(stream_id)
+                    continue
+                with self._lock:
+                    stream = self._streams.get(stream_id)
+                if flags & _FLAG_CLOSE:
+                    with self._lock:
+                        self._granted.pop(stream_id, None)
+                    if stream is not None:
+                        stream._end()
+                        with self._lock:
+                            self._streams.pop(stream_id, None)
+                    continue
+                if flags & _FLAG_START:
+                    inspector = None
+                    if stream is not None and stream.inspector is not None:
+                        inspector = stream.inspector()
+                    if total < MUX_CONF.chunk_size:
+                        buffer = self.allocate(total)
+                    else:
+                        buffer = self._take_grant(stream_id, total)
+                    partial[stream_id] = (buffer, 0, inspector, time.perf_counter())
+                if stream_id not in partial:
+                    raise ConnectionResetError('chunk of a message that was not started')
+                buffer, received, inspector, started = partial[stream_id]
+                if received + length > len(buffer):
+                    raise FrameTooLarge('chunk beyond the end of the message')
+                recv_into_exactly(self._sock, buffer[received:received + length])
+                received += length
+                if inspector is not None:
+                    # the payload follows the id of the codec, only messages that are not compressed are inspected
+                    offset = 1 if self.compressor is not None else 0
+                    if offset and buffer[0] != CODECS['none'][0]:
+                        inspector = None
+                    elif received > offset:
+                        inspector.update(buffer[offset:], max(received - length - offset, 0), received - offset)
+                partial[stream_id] = (buffer, received, inspector, started)
+                if flags & _FLAG_END:
+                    del partial[stream_id]
+                    if stream is None:
+                        continue
+                    stream._messages.put((buffer, inspector, time.perf_counter() - started))
+                # do not keep the last message alive while waiting for the next frame
+                buffer = inspector = None
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._shutdown()
+            self._loop_ended()
+
+    def _decompress(self, message):
+        """
+        Decompress a message received on a connection with compression. A peer that sends a compressed message before
+        it is authenticated, or a message that decompresses beyond MUX_CONF.max_message_size, is disconnected
+        """
+        try:
+            if message[0] != CODECS['none'][0] and not self.authenticated:
+                raise ConnectionRefusedError('compressed message before the peer was authenticated')
+            return decompress(message, MUX_CONF.max_message_size)
+        except (OSError, ValueError, IndexError) as error:
+            print('Closing the connection with {} ({})'.format(self.address, error))
+            self.close()
+            raise StreamClosed('connection closed, the message could not be decompressed')
+
+    def allocate(self, size):
+        """
+        Buffer for a message being received. Large messages are counted in the receive budget until the buffer and
+        every view of it are released, and wait until they fit in it. Small messages, e.g., control messages, are
+        never held back by the budget
+
+        :param int size: bytes of the message
+        :rtype: memoryview
+        :raises FrameTooLarge: if the message is larger than MUX_CONF.max_message_size
+        :raises StreamClosed: if the connection is closed while waiting for the budget
+
+        """
+        if size > MUX_CONF.max_message_size:
+            raise FrameTooLarge('message of {} bytes, at most {} are accepted'.format(size, MUX_CONF.max_message_size))
+        if size < MUX_CONF.chunk_size:
+            return memoryview(bytearray(size))
+        _reserve(size, self)
+        # the buffer is filled by recv_into, there is no need to initialize it
+        buffer = np.empty(size, dtype=np.uint8)
+        weakref.finalize(buffer, _release, size)
+        return memoryview(buffer)
+
+    def _shutdown(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            streams = list(self._streams.values())
+            self._streams.clear()
+            # the buffers granted to the peer are released
+            self._granted.clear()
+        self._requests.put(None)
+        for stream in streams:
+            stream._end()
+        self._accepted.put(None)
+        self._queue.put((float('inf'), next(self._sequence), None))
+        # the reader and the writer may still be using the socket: it is only shut down here, closing it would
+        # free its descriptor for another connection while they write to it. The shutdown of socket.socket is used
+        # because the one of ssl.SSLSocket drops the TLS state the other threads are using
+        try:
+            socket.socket.shutdown(self._sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _loop_ended(self):
+        with self._lock:
+            self._loops -= 1
+            last = self._loops == 0
+        if last:
+            self._sock.close()
+
+    def close(self):
+        """
+        Close the connection and all its streams
+        """
+        self._shutdown()
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(host, port, tls=False, compression=False):
+    """
+    Get the connection with a peer. The connection is opened the first time and shared by all the streams with
+    the same peer
+
+    :param str host: ip address of the peer
+    :param int port: port of the peer
+    :param bool,optional tls: protect the connection with TLS
+    :param bool,optional compression: negotiate the compression of the messages
+    :return: the connection with the peer
+    :rtype: MultiplexedConnection
+
+    """
+    with _connections_lock:
+        connection = _connections.get((host, port))
+        if connection is None or connection.closed:
+            if tls:
+                sock = connect(host, port)
+            else:
+                sock = socket.create_connection((host, port))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = MultiplexedConnection(sock, server_side=False, compression=compression)
+            _connections[(host, port)] = connection
+        return connection
+
+
+def connection_count():
+    """
+    Number of open connections in the pool
+
+    :rtype: int
+
+    """
+    with _connections_lock:
+        return sum(1 for connection in _connections.values() if not connection.closed)
+
+
+class MultiplexedListener(threading.Thread):
+    """
+    Accepts multiplexed connections and passes every stream opened by the peers to on_stream
+
+    :param str host: my local ip address
+    :param int port: my local port, 0 lets the OS choose one
+    :param function on_stream: function called in a new thread with every stream opened by a peer
+    :param bool,optional tls: protect the connections with TLS
+    :param bool,optional compression: negotiate the compression of the messages
+    :param bool,optional authenticated: whether the peers are trusted to send compressed messages as soon as they
+                                        connect, see :class:`MultiplexedConnection`
+    """
+
+    def __init__(self, host, port, on_stream, tls=False, compression=False, authenticated=True):
+        threading.Thread.__init__(self, name='mux_listener', daemon=True)
+        self.host = host
+        self.port = port
+        self.on_stream = on_stream
+        self.tls = tls
+        self.compression = compression
+        self.authenticated = authenticated
+        self.connections = []
+        self.listening = threading.Event()
+        # error that prevented the listener from opening its socket
+        self.error = None
+        self._stop_listening = False
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, self.port))
+            self.port = sock.getsockname()[1]
+            sock.listen(10)
+            sock.settimeout(1)
+        except OSError as e:
+            sock.close()
+            self.error = e
+            return
+        finally:
+            # the thread that waits for the listener is woken up even if the socket could not be opened
+            self.listening.set()
+        try:
+            while not self._stop_listening:
+                try:
+                    connection, _ = sock.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    if self.tls:
+                        connection = wrap_server_socket(connection)
+                    self.connections.append(MultiplexedConnection(connection, True, self.on_stream, self.compression,
+                                                                  self.authenticated))
+                except OSError:
+                    connection.close()
+        finally:
+            sock.close()
+
+    def wait_listening(self, timeout=None):
+        """
+        Wait until the listener accepts connections
+
+        :param float,optional timeout: seconds to wait, MUX_CONF.listen_timeout by default
+        :raises OSError: if the socket could not be opened, e.g., the port is in use
+        :raises TimeoutError: if the listener did not open its socket in time
+
+        """
+        if not self.listening.wait(MUX_CONF.listen_timeout if timeout is None else timeout):
+            raise TimeoutError('the listener on {}:{} did not start in time'.format(self.host, self.port))
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        """
+        Stop accepting connections and close the accepted ones
+        """
+        self._stop_listening = True
+        for connection in self.connections:
+            connection.close()
@@ -0,0 +1,248 @@
+"""
+.. _PeerDirectory:
+
+Peer directory
+==============
+
+Nodes publish the endpoint (host:port) of their p2p services as a detail of their own account in the BSMD. Other nodes
+resolve an account into an endpoint with a :class:`PeerDirectory`, which keeps a local cache so a connection does not
+cost a query to the ledger. Entries expire after a time to live and the cache is refreshed incrementally: each call to
+:meth:`PeerDirectory.refresh` only consults the ledger for the entries that are stale, oldest first. A background
+thread calls it every ``DIRECTORY_CONF.refresh_interval`` seconds, refreshing the entries that would expire before the
+next call, so the endpoints of the peers are resolved from the cache for the whole training.
+
+The queries are signed by the account of the node consulting the BSMD, in its own domain, also when the endpoint
+belongs to a node of another domain.
+
+:On the node publishing the endpoint run:
+>>> publish_endpoint('worker1', 'private key of worker1', '123.456.789', 5555, 'federated', 'ip')
+
+:On the node looking for the endpoint run:
+>>> directory = PeerDirectory('chief', 'private key of chief', 'federated', 'ip')
+>>> host, port = directory.resolve('worker1')
+>>> directory.close()
+
+"""
+import json
+import threading
+import time
+from utils.iroha import set_detail_to_node, get_a_detail_from_node
+
+DIRECTORY_CONF = lambda x: x
+DIRECTORY_CONF.detail_key = 'p2p_endpoint'
+DIRECTORY_CONF.ttl = 300
+# seconds between the refreshes of the cache in the background, None to refresh it only with PeerDirectory.refresh
+DIRECTORY_CONF.refresh_interval = 60
+
+
+def format_endpoint(host, port):
+    """
+    Format a host and a port as the endpoint string stored in the BSMD
+
+    :param str host: ip address or host name of the node
+    :param int port: port of the node
+    :return: endpoint in the form host:port
+    :rtype: str
+
+    """
+    return '{}:{}'.format(host, int(port))
+
+
+def parse_endpoint(endpoint):
+    """
+    Split an endpoint string into host and port
+
+    :param str endpoint: endpoint in the form host:port
+    :return: host and port of the endpoint
+    :rtype: tuple(str, int)
+
+    """
+    host, port = endpoint.rsplit(':', 1)
+    return host, int(port)
+
+
+def publish_endpoint(name, private_key, host, port, domain, ip, detail_key=DIRECTORY_CONF.detail_key):
+    """
+    Publish the p2p endpoint of the node as a detail of its own account in the BSMD
+
+    :param str name: name of the node publishing the endpoint
+    :param str private_key: private key of the node
+    :param str host: ip address or host name where the node listens
+    :param int port: port where the node listens
+    :param str domain: name of the domain
+    :param str ip: address for connecting to the BSMD
+    :param str,optional detail_key: name of the detail holding the endpoint
+
+    """
+    set_detail_to_node(name, name, private_key, detail_key, format_endpoint(host, port), domain, ip)
+
+
+class PeerDirectory:
+    """
+    Resolves account ids of nodes into the p2p endpoints they published in the BSMD. Resolved endpoints are cached for
+    ttl seconds. Use :meth:`invalidate` when a connection to a cached endpoint fails, so the next resolution
+    consults the ledger again.
+
+    :param str name: name of the node consulting the BSMD
+    :param str private_key: private key of the node for signing the queries
+    :param str domain: name of the domain of the nodes
+    :param str ip: address for connecting to the BSMD
+    :param int,optional ttl: seconds an endpoint is kept in the cache before it is consulted again
+    :param str,optional detail_key: name of the detail holding the endpoint
+    :param float,optional refresh_interval: seconds between the refreshes of the cache in the background,
+                                            DIRECTORY_CONF.refresh_interval by default, 0 to not refresh it
+
+    """
+
+    def __init__(self, name, private_key, domain, ip, ttl=DIRECTORY_CONF.ttl, detail_key=DIRECTORY_CONF.detail_key,
+                 refresh_interval=None):
+        self._name = name
+        self._private_key = private_key
+        self._domain = domain
+        self._ip = ip
+        self._ttl = ttl
+        self._detail_key = detail_key
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._refresh_interval = DIRECTORY_CONF.refresh_interval if refresh_interval is None else refresh_interval
+        self._closed = threading.Event()
+        if self._refresh_interval:
+            threading.Thread(target=self._refresh_loop, name='peer_directory', daemon=True).start()
+
+    def _split_account(self, account):
+        """
+        Accept account ids (node@domain) or plain node names
+
+        :param str account: account id or name of the node
+        :return: name and domain of the node
+        :rtype: tuple(str, str)
+
+        """
+        if '@' in account:
+            node, domain = account.split('@', 1)
+            return node, domain
+        return account, self._domain
+
+    def _query(self, account):
+        """
+        Consult the endpoint of a node in the BSMD
+
+        :param str account: account id or name of the node
+        :return: host and port published by the node
+        :rtype: tuple(str, int)
+
+        """
+        node, domain = self._split_account(account)
+        # the query is signed by the account of this node, which is in its own domain
+        detail = get_a_detail_from_node(self._name, node, self._private_key, self._detail_key, self._domain, self._ip,
+                                        node_domain=domain)
+        account_id = node + '@' + domain
+        try:
+            endpoint = json.loads(detail)[account_id][self._detail_key]
+        except (ValueError, KeyError, TypeError):
+            raise LookupError('{} has not published a p2p endpoint'.format(account_id))
+        return parse_endpoint(endpoint)
+
+    def resolve(self, account):
+        """
+        Get the endpoint of a node. The ledger is only consulted when the endpoint is not cached or has expired
+
+        :param str account: account id or name of the node
+        :return: host and port of the node
+        :rtype: tuple(str, int)
+
+        """
+        key = '@'.join(self._split_account(account))
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and time.time() - entry[1] < self._ttl:
+                return entry[0]
+        endpoint = self._query(key)
+        with self._lock:
+            self._cache[key] = (endpoint, time.time())
+        return endpoint
+
+    def resolve_address(self, account):
+        """
+        Get the endpoint of a node in the host:port form used by :class:`_FederatedHook`
+
+        :param str account: account id or name of the node
+        :return: endpoint of the node
+        :rtype: str
+
+        """
+        return format_endpoint(*self.resolve(account))
+
+    def prefetch(self, accounts):
+        """
+        Resolve a list of nodes so later connections are served from the cache. Nodes without a published endpoint
+        are skipped
+
+        :param list[str] accounts: account ids or names of the nodes
+        :return: the accounts that could not be resolved
+        :rtype: list[str]
+
+        """
+        missing = []
+        for account in accounts:
+            try:
+                self.resolve(account)
+            except LookupError:
+                missing.append(account)
+        return missing
+
+    def refresh(self, max_queries=None, ahead=0):
+        """
+        Incrementally refresh the cache. Only expired entries are consulted in the BSMD, the oldest ones first
+
+        :param int,optional max_queries: maximum number of queries sent to the BSMD in this call
+        :param float,optional ahead: seconds before they expire at which the entries are already refreshed
+        :return: number of entries refreshed
+        :rtype: int
+
+        """
+        now = time.time()
+        with self._lock:
+            stale = sorted((entry[1], key) for key, entry in self._cache.items()
+                           if now - entry[1] >= self._ttl - ahead)
+        if max_queries is not None:
+            stale = stale[:max_queries]
+        refreshed = 0
+        for _, key in stale:
+            try:
+                endpoint = self._query(key)
+            except LookupError:
+                self.invalidate(key)
+                continue
+            with self._lock:
+                self._cache[key] = (endpoint, time.time())
+            refreshed += 1
+        return refreshed
+
+    def invalidate(self, account):
+        """
+        Remove a node from the cache, e.g., after a failed connection to its endpoint
+
+        :param str account: account id or name of the node
+
+        """
+        key = '@'.join(self._split_account(account))
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def _refresh_loop(self):
+        """
+        Refresh the cache every refresh_interval seconds until the directory is closed
+        """
+        while not self._closed.wait(self._refresh_interval):
+            try:
+                self.refresh(ahead=self._refresh_interval)
+            except Exception as error:
+                # the BSMD may be unreachable for a while, the expired entries are consulted again when resolved
+                print('Could not refresh the peer directory ({})'.format(error))
+
+    def close(self):
+        """
+        Stop refreshing the cache in the background
+        """
+        self._closed.set()
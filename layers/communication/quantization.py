@@ -0,0 +1,172 @@
+"""
+.. _Quantization:
+
+Quantization
+============
+Lossy codecs for the weights exchanged in the federated processes of the BSMD. The modes are:
+
+* none: the weights are sent as they are
+* float16: half precision, half of the bytes of float32
+* int8: 8-bit linear quantization between the minimum and the maximum of each tensor, a quarter of the bytes. The
+  flat vector of a model (see :ref:`Layout`) is quantized by segments, each variable with its own minimum and
+  maximum, when the quantizer knows the ``segments`` of the vector
+* stochastic: as int8 but rounding up or down at random with the probability given by the distance to each level,
+  so the quantization is unbiased
+
+A :class:`Quantizer` keeps the error of the last quantization of every tensor (error feedback) and adds it to the
+next weights it quantizes, so the quantization error does not accumulate over the rounds. The description returned
+with the quantized arrays is sent in the metadata of the message (see :ref:`Tensors`) and is all the receiver needs
+to restore the weights with :func:`dequantize`.
+
+:Example:
+>>> quantizer = Quantizer('int8')
+>>> arrays, description = quantizer.quantize(weights)
+>>> parts = encode(arrays, sender='worker1', quantization=description)
+>>> # on the other side
+>>> metadata, arrays = decode(message)
+>>> weights = dequantize(arrays, metadata['quantization'])
+
+"""
+import numpy as np
+
+QUANTIZATION_MODES = ['none', 'float16', 'int8', 'stochastic']
+# levels of the 8-bit modes
+_LEVELS = 255
+
+
+def dequantize(arrays, description):
+    """
+    Restore the weights quantized by :meth:`Quantizer.quantize`
+
+    :param list arrays: quantized arrays
+    :param dict description: description returned with the quantized arrays
+    :return: the weights
+    :rtype: list
+
+    """
+    weights = []
+    for array, tensor in zip(arrays, description['tensors']):
+        dtype = np.dtype(tensor['dtype'])
+        if 'segments' in tensor:
+            restored = array.astype(dtype)
+            offset = 0
+            for size, minimum, scale in zip(tensor['segments'], tensor['minimum'], tensor['scale']):
+                segment = restored[offset:offset + size]
+                segment *= scale
+                segment += minimum
+                offset += size
+            weights.append(restored)
+        elif 'scale' in tensor:
+            restored = array.astype(dtype)
+            restored *= tensor['scale']
+            restored += tensor['minimum']
+            weights.append(restored)
+        else:
+            weights.append(array.astype(dtype, copy=False))
+    return weights
+
+
+class Quantizer:
+    """
+    Quantizes the weights sent by a node, with error feedback
+
+    :param str,optional mode: one of QUANTIZATION_MODES
+    :param bool,optional error_feedback: add the error of the last quantization to the next weights
+    :param int,optional seed: seed of the random rounding of the stochastic mode
+    """
+
+    def __init__(self, mode='none', error_feedback=True, seed=None):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError('unknown quantization mode {}, use one of {}'.format(mode, QUANTIZATION_MODES))
+        self.mode = mode
+        self.error_feedback = error_feedback
+        self.last_error = 0.0
+        # sizes of the variables of a flat vector of weights, each one is quantized with its own scale
+        self.segments = None
+        self._residuals = None
+        self._random = np.random.RandomState(seed)
+
+    def _levels(self, array, out):
+        """
+        Quantize an array into 8-bit levels between its minimum and its maximum
+
+        :param numpy.ndarray array: floating point array
+        :param numpy.ndarray out: uint8 array with the shape of the array, where the levels are written
+        :return: minimum and scale of the levels
+        :rtype: tuple(float, float)
+        """
+        minimum, maximum = float(array.min()), float(array.max())
+        scale = (maximum - minimum) / _LEVELS or 1.0
+        levels = array - minimum
+        levels /= scale
+        if self.mode == 'stochastic':
+            levels += self._random.random_sample(levels.shape).astype(levels.dtype)
+            np.floor(levels, out=levels)
+        else:
+            np.rint(levels, out=levels)
+        np.clip(levels, 0, _LEVELS, out=levels)
+        out[...] = levels
+        return minimum, scale
+
+    def _quantize_tensor(self, array):
+        """
+        Quantize one tensor, by segments if it is the flat vector of the weights
+
+        :return: quantized array and its description
+        """
+        if self.mode == 'float16':
+            return array.astype(np.float16), {'dtype': array.dtype.str}
+        quantized = np.empty(array.shape, dtype=np.uint8)
+        if self.segments is None or array.ndim != 1 or sum(self.segments) != array.size:
+            minimum, scale = self._levels(array, quantized)
+            return quantized, {'dtype': array.dtype.str, 'minimum': minimum, 'scale': scale}
+        minimums, scales = [], []
+        offset = 0
+        for size in self.segments:
+            if size:
+                minimum, scale = self._levels(array[offset:offset + size], quantized[offset:offset + size])
+            else:
+                minimum, scale = 0.0, 1.0
+            minimums.append(minimum)
+            scales.append(scale)
+            offset += size
+        return quantized, {'dtype': array.dtype.str, 'minimum': minimums, 'scale': scales,
+                           'segments': list(self.segments)}
+
+    def quantize(self, weights):
+        """
+        Quantize the weights of the node. Tensors that are not floating point, or empty, are sent as they are
+
+        :param list weights: numpy arrays to be sent
+        :return: quantized arrays and their description
+        :rtype: tuple(list, dict)
+
+        """
+        if self.mode == 'none':
+            return list(weights), {'mode': 'none', 'tensors': [{'dtype': np.asarray(w).dtype.str} for w in weights]}
+        if self._residuals is None or len(self._residuals) != len(weights):
+            self._residuals = [None] * len(weights)
+        arrays, tensors = [], []
+        error, norm = 0.0, 0.0
+        for i, weight in enumerate(weights):
+            weight = np.asarray(weight)
+            if not np.issubdtype(weight.dtype, np.floating) or weight.size == 0:
+                arrays.append(weight)
+                tensors.append({'dtype': weight.dtype.str})
+                continue
+            corrected = weight.astype(weight.dtype, copy=True)
+            if self.error_feedback and self._residuals[i] is not None and self._residuals[i].shape == weight.shape:
+                corrected += self._residuals[i]
+            quantized, tensor = self._quantize_tensor(corrected)
+            # what the receiver will not see is sent in the next round
+            residual = corrected
+            residual -= dequantize([quantized], {'tensors': [tensor]})[0]
+            if self.error_feedback:
+                self._residuals[i] = residual
+            error += float(np.dot(residual.ravel(), residual.ravel()))
+            norm += float(np.dot(weight.ravel(), weight.ravel()))
+            arrays.append(quantized)
+            tensors.append(tensor)
+        # relative error of this quantization, residuals included
+        self.last_error = (error / norm) ** 0.5 if norm else 0.0
+        return arrays, {'mode': self.mode, 'tensors': tensors}
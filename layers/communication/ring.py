@@ -0,0 +1,105 @@
+"""
+.. _Ring:
+
+Ring
+====
+Ring all-reduce of the weights of the nodes of a federated process. The nodes form a ring, each one only sends to
+the next node and only receives from the previous one. The weights are flattened and split into one chunk per node,
+and the average is computed in two phases of N - 1 steps each:
+
+* reduce-scatter: in every step a node sends one chunk to the next node and adds the chunk it receives to its own.
+  At the end every node has the sum of all the nodes for one chunk
+* all-gather: the summed chunks go once more around the ring, so every node ends with all of them
+
+Every node sends and receives 2 (N - 1) / N times the size of the model, whatever the number of nodes, and no node
+carries the traffic of the others. The sending of a chunk and the receiving of the next one overlap.
+
+:Example:
+>>> ring = RingAllReduce(rank, size)
+>>> averaged = ring.all_reduce(weights, send, receive)
+
+where ``send(chunk, step)`` sends a numpy array to the next node and ``receive(step)`` returns the array sent by the
+previous node in the same step.
+
+"""
+import concurrent.futures
+import numpy as np
+
+
+class RingAllReduce:
+    """
+    Average of the weights of the nodes of a ring
+
+    :param int rank: position of the node in the ring
+    :param int size: number of nodes in the ring
+    """
+
+    def __init__(self, rank, size):
+        if not 0 <= rank < size:
+            raise ValueError('rank {} is not in a ring of {} nodes'.format(rank, size))
+        self.rank = rank
+        self.size = size
+        self._sender = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ring')
+
+    def _exchange(self, send, receive, outgoing, step):
+        """
+        Send a chunk and receive the chunk of the previous node at the same time
+        """
+        sending = self._sender.submit(send, outgoing, step)
+        try:
+            incoming = receive(step)
+        finally:
+            # a failed receive must not leave the chunk half sent for the next round
+            sending.result()
+        return incoming
+
+    def all_reduce(self, weights, send, receive):
+        """
+        Average the weights with the other nodes of the ring
+
+        :param list weights: numpy arrays of this node, with the same shapes in every node
+        :param send: function that sends a chunk to the next node, called as send(chunk, step)
+        :param receive: function that returns the chunk of the previous node, called as receive(step)
+        :return: averaged weights, with the shapes and dtypes of the given ones
+        :rtype: list
+
+        """
+        weights = [np.asarray(weight) for weight in weights]
+        if self.size == 1:
+            return weights
+        dtype = np.result_type(np.float32, *[weight.dtype for weight in weights])
+        flat = np.concatenate([weight.astype(dtype).ravel() for weight in weights])
+        bounds = np.linspace(0, flat.size, self.size + 1).astype(np.int64)
+        chunks = [flat[bounds[i]:bounds[i + 1]] for i in range(self.size)]
+        step = 0
+        for i in range(self.size - 1):
+            outgoing = (self.rank - i) % self.size
+            incoming = (self.rank - i - 1) % self.size
+            received = self._exchange(send, receive, chunks[outgoing], step)
+            if received.shape != chunks[incoming].shape:
+                raise ValueError('expected a chunk of {} values, received {}'.format(chunks[incoming].size,
+                                                                                  received.size))
+            chunks[incoming] += received
+            step += 1
+        for i in range(self.size - 1):
+            outgoing = (self.rank - i + 1) % self.size
+            incoming = (self.rank - i) % self.size
+            received = self._exchange(send, receive, chunks[outgoing], step)
+            if received.shape != chunks[incoming].shape:
+                raise ValueError('expected a chunk of {} values, received {}'.format(chunks[incoming].size,
+                                                                                  received.size))
+            chunks[incoming][...] = received
+            step += 1
+        flat /= self.size
+        averaged = []
+        position = 0
+        for weight in weights:
+            averaged.append(flat[position:position + weight.size].reshape(weight.shape).astype(weight.dtype))
+            position += weight.size
+        return averaged
+
+    def close(self):
+        """
+        Stop the thread that sends the chunks
+        """
+        self._sender.shutdown(wait=False)
@@ -0,0 +1,479 @@
+"""
+.. _Session:
+
+Session
+=======
+Long-lived authenticated sessions between the chief and the workers of a federated process. A session is a single
+TLS connection (see :ref:`TLS`) kept for the whole training run and carries two streams of a
+:class:`layers.communication.mux.MultiplexedConnection`:
+
+* control: authentication, heartbeats, task indexes and signals. Its messages overtake the weights
+* weights: the weights exchanged in every averaging round. With an inspector they are never compressed, so they are
+  checked while they arrive (see :ref:`Integrity`)
+
+When a worker connects it sends its name signed with the shared key, and the chief answers with a welcome message.
+The hello carries the time it was signed at, the chief rejects hellos older than ``SESSION_CONF.hello_window`` seconds
+and hellos it already accepted, so a recorded hello cannot be replayed to open a session.
+Both ends send a heartbeat every ``SESSION_CONF.heartbeat_interval`` seconds and close the session if nothing is
+heard from the peer in ``SESSION_CONF.heartbeat_timeout`` seconds. A worker that loses its session reconnects with
+the same name and the chief replaces the old session, so rounds only cost the transfer of the weights.
+
+:On the chief run:
+>>> server = SessionServer('172.134.65.123', 7777, key)
+>>> server.start()
+>>> session = server.session('worker1')
+>>> session.send_control(b'1:2')
+
+:On the worker run:
+>>> session = WorkerSession('172.134.65.123', 7777, 'worker1', key)
+>>> session.connect()
+>>> print(bytes(session.recv_control()))
+b'1:2'
+
+"""
+import hashlib
+import hmac
+import json
+import queue
+import socket
+import threading
+import time
+from layers.communication.tls import connect, remember_session
+from layers.communication.mux import MUX_CONF, MultiplexedConnection, MultiplexedListener, StreamClosed
+
+SESSION_CONF = lambda x: x
+SESSION_CONF.heartbeat_interval = 5
+SESSION_CONF.heartbeat_timeout = 30
+SESSION_CONF.reconnect_attempts = 10
+# seconds before the first reconnection, doubled after every failed attempt
+SESSION_CONF.reconnect_delay = 0.5
+SESSION_CONF.max_reconnect_delay = 8
+SESSION_CONF.hashfunction = hashlib.sha256
+SESSION_CONF.heartbeat = b'ping'
+SESSION_CONF.welcome = b'welcome'
+# seconds a hello is valid for, also the clock difference allowed between the nodes
+SESSION_CONF.hello_window = 60
+
+# signatures of the hellos accepted in the last window, by the time they were signed at
+_accepted_hellos = {}
+_accepted_hellos_lock = threading.Lock()
+
+
+def _sign_hello(name, key, info=None):
+    hello = json.dumps({'name': name, 'time': time.time(), 'info': info or {}}).encode('utf-8')
+    return hmac.new(key, hello, SESSION_CONF.hashfunction).digest() + hello
+
+
+def _check_hello(message, key):
+    """
+    Name and information of the node that sent a hello message, None if the signature is wrong, the hello is out of
+    the window or it was already accepted
+    """
+    size = SESSION_CONF.hashfunction().digest_size
+    signature, hello = bytes(message[:size]), bytes(message[size:])
+    if not hmac.compare_digest(signature, hmac.new(key, hello, SESSION_CONF.hashfunction).digest()):
+        return None
+    hello = json.loads(hello.decode('utf-8'))
+    now = time.time()
+    signed = float(hello['time'])
+    if abs(now - signed) > SESSION_CONF.hello_window:
+        return None
+    with _accepted_hellos_lock:
+        for accepted, accepted_time in list(_accepted_hellos.items()):
+            if now - accepted_time > SESSION_CONF.hello_window:
+                del _accepted_hellos[accepted]
+        if signature in _accepted_hellos:
+            return None
+        _accepted_hellos[signature] = signed
+    return hello['name'], dict(hello.get('info', {}))
+
+
+class Session:
+    """
+    One end of an established session
+
+    :param str name: name of the node at the other end
+    :param MultiplexedConnection connection: connection carrying the session
+    :param Stream control: control stream
+    :param Stream weights: weights stream
+    :param dict,optional info: what the node at the other end told about itself when the session was opened
+    :param function,optional inspector: inspector of the messages of the weights stream (see :ref:`Mux`)
+    """
+
+    def __init__(self, name, connection, control, weights, info=None, inspector=None):
+        self.name = name
+        self.info = info or {}
+        self.connection = connection
+        self.address = connection.address
+        self.last_seen = time.time()
+        self._control = control
+        self._weights = weights
+        if inspector is not None:
+            weights.inspector = inspector
+        # the weights are checked while they arrive only if they are not compressed
+        weights.compressed = weights.inspector is None
+        self._control_messages = queue.Queue()
+        threading.Thread(target=self._control_loop, name='session_control', daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, name='session_heartbeat', daemon=True).start()
+
+    @property
+    def closed(self):
+        return self.connection.closed
+
+    @property
+    def inspection(self):
+        return self._weights.inspection
+
+    @property
+    def transfer(self):
+        return self._weights.transfer
+
+    def _control_loop(self):
+        try:
+            while True:
+                message = self._control.recv()
+                self.last_seen = time.time()
+                if message != SESSION_CONF.heartbeat:
+                    self._control_messages.put(message)
+        except StreamClosed:
+            self._control_messages.put(None)
+
+    def _heartbeat_loop(self):
+        while not self.closed:
+            time.sleep(SESSION_CONF.heartbeat_interval)
+            if time.time() - max(self.last_seen, self.connection.last_activity) > SESSION_CONF.heartbeat_timeout:
+                print('No heartbeat from ' + self.name + ', closing the session')
+                self.close()
+                break
+            try:
+                self._control.send(SESSION_CONF.heartbeat)
+            except StreamClosed:
+                break
+
+    def send_control(self, data):
+        """
+        Send a control message
+
+        :param bytes data: message to be sent
+        """
+        self._control.send(data)
+
+    def recv_control(self, timeout=None):
+        """
+        Receive the next control message, heartbeats are not returned
+
+        :param float,optional timeout: seconds to wait for the message
+        :return: the message
+        :rtype: memoryview
+
+        """
+        try:
+            message = self._control_messages.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout('no control message from ' + self.name)
+        if message is None:
+            self._control_messages.put(None)
+            raise StreamClosed('session with ' + self.name + ' is closed')
+        return message
+
+    def send(self, data):
+        """
+        Send a message on the weights stream
+
+        :param bytes data: message to be sent, any object supporting the buffer protocol
+        """
+        self._weights.send(data)
+
+    def recv(self, timeout=None):
+        """
+        Receive the next message of the weights stream
+
+        :param float,optional timeout: seconds to wait for the message
+        :return: the message
+        :rtype: memoryview
+
+        """
+        message = self._weights.recv(timeout)
+        self.last_seen = time.time()
+        return message
+
+    def close(self):
+        """
+        Close the session
+        """
+        self.connection.close()
+
+
+class WorkerSession:
+    """
+    Session of a worker with the chief. It is opened with :meth:`connect` and opened again, with the same name, by
+    :meth:`reconnect` when it is lost
+
+    :param str host: ip address of the chief
+    :param int port: port of the chief
+    :param str name: name of the worker in the BSMD
+    :param bytes key: key shared by the nodes to authenticate the sessions
+    :param bool,optional tls: protect the connection with TLS
+    :param bool,optional compression: negotiate the compression of the messages
+    :param dict,optional info: JSON serializable information sent to the chief with the name, e.g., the role of
+                               the worker
+    :param function,optional inspector: inspector of the messages of the weights stream (see :ref:`Mux`)
+    """
+
+    def __init__(self, host, port, name, key, tls=True, compression=True, info=None, inspector=None):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.key = key
+        self.info = info
+        self.inspector = inspector
+        self.tls = tls
+        self.compression = compression
+        self.reconnections = 0
+        self._session = None
+
+    @property
+    def closed(self):
+        return self._session is None or self._session.closed
+
+    @property
+    def connection(self):
+        return None if self._session is None else self._session.connection
+
+    @property
+    def inspection(self):
+        return self._session.inspection
+
+    @property
+    def transfer(self):
+        return self._session.transfer
+
+    def connect(self):
+        """
+        Open the session and wait for the welcome of the chief
+        """
+        if self.tls:
+            sock = connect(self.host, self.port)
+        else:
+            sock = socket.create_connection((self.host, self.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # the chief is trusted with compressed messages once it welcomed the worker
+        connection = MultiplexedConnection(sock, server_side=False, compression=self.compression, authenticated=False)
+        control = connection.open_stream('control', MUX_CONF.priority_control)
+        weights = connection.open_stream('weights', MUX_CONF.priority_bulk)
+        weights.inspector = self.inspector
+        control.send(_sign_hello(self.name, self.key, self.info))
+        try:
+            welcome = control.recv(SESSION_CONF.heartbeat_timeout)
+        except (StreamClosed, socket.timeout):
+            connection.close()
+            raise ConnectionRefusedError('the chief did not accept the session of ' + self.name)
+        if welcome != SESSION_CONF.welcome:
+            connection.close()
+            raise ConnectionRefusedError('unexpected answer of the chief: {}'.format(bytes(welcome)))
+        connection.authenticated = True
+        if self.tls:
+            # with TLS 1.3 the ticket of the session arrives after the handshake, it is there once the chief answered
+            remember_session(sock)
+        self._session = Session('chief', connection, control, weights)
+
+    def reconnect(self):
+        """
+        Close the session if it is still open and open it again. Failed attempts are retried with an exponential
+        backoff
+        """
+        if self._session is not None:
+            self._session.close()
+        delay = SESSION_CONF.reconnect_delay
+        for attempt in range(SESSION_CONF.reconnect_attempts):
+            try:
+                self.connect()
+                self.reconnections += 1
+                print('Session with the chief opened again')
+                return
+            except OSError as error:
+                print('Could not reconnect with the chief ({}), attempt {}'.format(error, attempt + 1))
+                time.sleep(delay)
+                delay = min(delay * 2, SESSION_CONF.max_reconnect_delay)
+        raise ConnectionError('could not reconnect with the chief')
+
+    def ensure(self):
+        """
+        Reconnect if the session was lost
+        """
+        if self.closed:
+            self.reconnect()
+
+    def send_control(self, data):
+        self._session.send_control(data)
+
+    def recv_control(self, timeout=None):
+        return self._session.recv_control(timeout)
+
+    def send(self, data):
+        self._session.send(data)
+
+    def recv(self, timeout=None):
+        return self._session.recv(timeout)
+
+    def close(self):
+        """
+        Close the session
+        """
+        if self._session is not None:
+            self._session.close()
+
+
+class SessionServer:
+    """
+    Accepts the sessions of the workers. A worker that connects again replaces its previous session. The other
+    streams opened by a worker with a session are given to the function registered with their label in ``handlers``
+
+    :param str host: my local ip address
+    :param int port: my local port
+    :param bytes key: key shared by the nodes to authenticate the sessions
+    :param bool,optional tls: protect the connections with TLS
+    :param bool,optional compression: negotiate the compression of the messages
+    :param function,optional inspector: inspector of the messages of the weights streams (see :ref:`Mux`)
+    """
+
+    def __init__(self, host, port, key, tls=True, compression=True, inspector=None):
+        self.key = key
+        self.inspector = inspector
+        # a worker cannot send compressed messages, which could inflate to more than they weigh, until its hello
+        # is accepted
+        self._listener = MultiplexedListener(host, port, self._on_stream, tls, compression, authenticated=False)
+        self._lock = threading.Condition()
+        self._pending = {}
+        self._sessions = {}
+        self._stopped = False
+        # label -> function called with the streams of that label
+        self.handlers = {}
+
+    @property
+    def port(self):
+        return self._listener.port
+
+    def start(self):
+        """
+        Start accepting sessions
+
+        :raises OSError: if the listener could not open its socket, e.g., the port is in use
+        :raises TimeoutError: if the listener did not start in MUX_CONF.listen_timeout seconds
+
+        """
+        self._listener.start()
+        self._listener.wait_listening()
+
+    def _on_stream(self, stream):
+        if stream.label not in ('control', 'weights'):
+            handler = self.handlers.get(stream.label)
+            end = time.time() + SESSION_CONF.heartbeat_timeout
+            with self._lock:
+                # the welcome can reach the worker before its session is registered
+                while not any(session.connection is stream.connection for session in self._sessions.values()) \
+                        and not stream.connection.closed and time.time() < end:
+                    self._lock.wait(min(end - time.time(), 1))
+                authenticated = any(session.connection is stream.connection for session in self._sessions.values())
+            if handler is None or not authenticated:
+                stream.close()
+                return
+            handler(stream)
+            return
+        # the control and weights streams of a connection can arrive in any order
+        with self._lock:
+            streams = self._pending.setdefault(stream.connection, {})
+            streams[stream.label] = stream
+            if 'control' not in streams or 'weights' not in streams:
+                return
+            del self._pending[stream.connection]
+        control, weights = streams['control'], streams['weights']
+        try:
+            hello = _check_hello(control.recv(SESSION_CONF.heartbeat_timeout), self.key)
+        except (StreamClosed, socket.timeout, ValueError, KeyError, TypeError):
+            hello = None
+        if hello is None:
+            print('Rejected a session from {}'.format(stream.connection.address))
+            stream.connection.close()
+            return
+        name, info = hello
+        stream.connection.authenticated = True
+        session = Session(name, stream.connection, control, weights, info, self.inspector)
+        control.send(SESSION_CONF.welcome)
+        with self._lock:
+            # a worker connecting while the server stops must not keep a session nobody answers
+            if self._stopped:
+                stream.connection.close()
+                return
+            previous = self._sessions.get(name)
+            self._sessions[name] = session
+            self._lock.notify_all()
+        if previous is not None:
+            print('Session of ' + name + ' opened again')
+            previous.close()
+
+    def sessions(self):
+        """
+        Open sessions in the order the workers joined
+
+        :rtype: list[Session]
+
+        """
+        with self._lock:
+            return [session for session in self._sessions.values() if not session.closed]
+
+    def session(self, name, timeout=0):
+        """
+        Session of a worker
+
+        :param str name: name of the worker
+        :param float,optional timeout: seconds to wait for the worker to open (again) its session
+        :return: the open session of the worker or None
+        :rtype: Session
+
+        """
+        end = time.time() + timeout
+        with self._lock:
+            while True:
+                session = self._sessions.get(name)
+                if session is not None and not session.closed:
+                    return session
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(min(remaining, 1))
+
+    def wait_sessions(self, names, count=None, timeout=0):
+        """
+        Wait until all the workers of a list, or a number of workers, have opened their sessions
+
+        :param list[str] names: names of the workers expected, the wait lasts the whole timeout if there are none
+        :param int,optional count: number of open sessions after which the rest of the workers are not waited for
+        :param float,optional timeout: seconds to wait
+        :return: open sessions in the order the workers joined
+        :rtype: list[Session]
+
+        """
+        end = time.time() + timeout
+        with self._lock:
+            while True:
+                opened = [session for session in self._sessions.values() if not session.closed]
+                present = set(session.name for session in opened)
+                if (names and all(name in present for name in names)) or \
+                        (count is not None and len(opened) >= count):
+                    return opened
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return opened
+                self._lock.wait(min(remaining, 1))
+
+    def stop(self):
+        """
+        Close all the sessions and stop accepting new ones
+        """
+        with self._lock:
+            self._stopped = True
+        self._listener.stop()
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
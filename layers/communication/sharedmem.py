@@ -0,0 +1,202 @@
+"""
+.. _SharedMemory:
+
+Shared memory
+=============
+Transport of the weights between nodes of a federated process that run on the same host. Through the session the
+weights are framed, maybe compressed or encrypted, written into a socket and read back from it by the kernel, even
+when both ends are on the same machine. A :class:`SharedChannel` writes the message into a segment of shared memory
+that it keeps for the peer instead, and only a small descriptor, with the name of the segment and the size of the
+message, is sent through the session. The receiver copies the message out of the segment with :func:`read` before
+acknowledging it, so the sender reuses the same segment for its next message.
+
+Both ends of a connection are on the same host when they have the same ip address or the peer is a loopback address
+(see :func:`colocated`). If the receiver cannot open the segment, e.g., it runs in another container, the message is
+sent through the session and the channel is closed. Shared memory needs Python 3.8 or newer, with older versions
+the weights always go through the session.
+
+:On the sender run:
+>>> channel = SharedChannel()
+>>> if colocated(session.connection) and channel.accepts(message):
+...     session.send(channel.write(message))
+
+:On the receiver run:
+>>> message = session.recv()
+>>> if is_descriptor(message):
+...     message = read(message, session.connection)
+
+"""
+import ipaddress
+import struct
+import threading
+import weakref
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+    resource_tracker = None
+
+SHM_CONF = lambda x: x
+# messages smaller than this are sent through the session, the descriptor would not save anything
+SHM_CONF.min_size = 1024 * 1024
+# a segment that is too small for a message is replaced by one with this much more room
+SHM_CONF.growth = 1.25
+
+# magic, bytes of the message, followed by the name of the segment
+_DESCRIPTOR = struct.Struct('!4sQ')
+_DESCRIPTOR_MAGIC = b'BSHM'
+
+# segments of the peers open in this process, by connection, only the last segment of every connection is kept
+_opened = weakref.WeakKeyDictionary()
+_opened_lock = threading.Lock()
+# names of the segments created by this process
+_created = set()
+
+
+def colocated(connection):
+    """
+    Whether the peer of a connection runs on the same host
+
+    :param MultiplexedConnection connection: connection with the peer, see :ref:`Mux`
+    :rtype: bool
+
+    """
+    if shared_memory is None or connection is None:
+        return False
+    peer, local = connection.address, getattr(connection, 'local_address', None)
+    if not peer or not local:
+        return False
+    try:
+        return peer[0] == local[0] or ipaddress.ip_address(peer[0].split('%')[0]).is_loopback
+    except ValueError:
+        return False
+
+
+def is_descriptor(message):
+    """
+    Whether a message received through a session is the descriptor of a message in shared memory
+
+    :param message: message received
+    :rtype: bool
+
+    """
+    view = memoryview(message).cast('B')
+    return len(view) > _DESCRIPTOR.size and view[:len(_DESCRIPTOR_MAGIC)] == _DESCRIPTOR_MAGIC
+
+
+def _attach(name):
+    """
+    Open a segment created by another process without taking ownership of it
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name)
+        # before Python 3.13 the segment would be removed when this process ends, it belongs to the sender
+        if segment.name not in _created:
+            resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+def read(descriptor, connection):
+    """
+    Copy a message out of the segment of shared memory of a descriptor. The copy is counted in the receive budget of
+    the connection like a message received through it (see MUX_CONF.receive_budget)
+
+    :param descriptor: the descriptor received through the session
+    :param MultiplexedConnection connection: connection with the sender
+    :return: the message
+    :rtype: memoryview
+    :raises OSError: if the segment cannot be opened
+    :raises ValueError: if the descriptor is not correct
+
+    """
+    view = memoryview(descriptor).cast('B')
+    magic, size = _DESCRIPTOR.unpack_from(view)
+    name = str(view[_DESCRIPTOR.size:], 'utf-8')
+    if magic != _DESCRIPTOR_MAGIC:
+        raise ValueError('not a descriptor of shared memory')
+    message = connection.allocate(size)
+    with _opened_lock:
+        segment = _opened.get(connection)
+        if segment is None or segment.name.lstrip('/') != name.lstrip('/'):
+            if segment is not None:
+                # the sender replaced its segment by a larger one
+                segment.close()
+                del _opened[connection]
+            segment = _attach(name)
+            _opened[connection] = segment
+        if size > segment.size:
+            raise ValueError('the message has {} bytes but the segment {} has {}'.format(size, name, segment.size))
+        message[:] = segment.buf[:size]
+    return message
+
+
+class SharedChannel:
+    """
+    Segment of shared memory through which a node sends its messages to a peer on the same host. The segment is
+    created with the first message and grows with the messages, and only one message at a time can be in it: the
+    sender holds ``lock`` from writing a message until the receiver acknowledges it. Once closed the channel is not
+    used again
+    """
+
+    def __init__(self):
+        self.segment = None
+        self.closed = shared_memory is None
+        self.lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def accepts(self, parts):
+        """
+        Whether a message is sent through the channel
+
+        :param list parts: buffers of the message
+        :rtype: bool
+
+        """
+        return not self.closed and sum(memoryview(part).nbytes for part in parts) >= SHM_CONF.min_size
+
+    def write(self, parts):
+        """
+        Write a message into the segment, replacing the previous one
+
+        :param list parts: buffers of the message
+        :return: descriptor of the message, to be sent through the session, None if the channel was closed
+        :rtype: bytes
+
+        """
+        size = sum(memoryview(part).nbytes for part in parts)
+        with self._lock:
+            if self.closed:
+                return None
+            if self.segment is None or self.segment.size < size:
+                self._remove()
+                self.segment = shared_memory.SharedMemory(create=True, size=max(int(size * SHM_CONF.growth), 1))
+                _created.add(self.segment.name)
+            position = 0
+            for part in parts:
+                view = memoryview(part).cast('B')
+                self.segment.buf[position:position + len(view)] = view
+                position += len(view)
+            return _DESCRIPTOR.pack(_DESCRIPTOR_MAGIC, size) + self.segment.name.encode('utf-8')
+
+    def _remove(self):
+        if self.segment is not None:
+            segment, self.segment = self.segment, None
+            _created.discard(segment.name)
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """
+        Remove the segment and send the next messages through the session, e.g., because the receiver cannot open
+        the segment or the training ended. A receiver that did not open the segment yet asks for the message again
+        """
+        with self._lock:
+            self.closed = True
+            self._remove()
@@ -0,0 +1,167 @@
+"""
+.. _Sparsification:
+
+Sparsification
+==============
+Sparse updates for the weights that the workers send to the chief in the federated processes of the BSMD. Instead of
+its absolute weights a worker sends the difference (delta) with the last model it received from the chief, and only
+the largest entries of it:
+
+* topk: the ``ratio`` entries of every tensor with the largest magnitude
+* threshold: the entries of every tensor whose magnitude is at least ``threshold``
+
+Every selected entry is sent as its position in the flattened tensor and its value. The entries that are not sent are
+kept by the :class:`Sparsifier` (residual) and added to the delta of the next round, so no update is lost, only
+delayed. The values can also be quantized (see :ref:`Quantization`), the quantization error goes to the residual too.
+
+The chief restores the weights of the worker with :func:`densify` and the same model the delta was computed against.
+Tensors that are not floating point are sent as they are.
+
+:Example:
+>>> sparsifier = Sparsifier('topk', ratio=0.01)
+>>> arrays, description = sparsifier.sparsify(weights, global_weights)
+>>> parts = encode(arrays, sender='worker1', sparsification=description)
+>>> # on the chief
+>>> metadata, arrays = decode(message)
+>>> weights = densify(arrays, metadata['sparsification'], global_weights)
+
+"""
+import math
+import numpy as np
+from layers.communication.quantization import Quantizer, dequantize
+
+SPARSIFICATION_MODES = ['none', 'topk', 'threshold']
+
+SPARSE_CONF = lambda x: x
+# fraction of the entries of every tensor sent in topk mode
+SPARSE_CONF.ratio = 0.01
+# minimum magnitude of the entries sent in threshold mode
+SPARSE_CONF.threshold = 1e-3
+
+
+def _index_dtype(size):
+    return np.uint32 if size <= np.iinfo(np.uint32).max else np.uint64
+
+
+def densify(arrays, description, reference):
+    """
+    Restore the weights sparsified by :meth:`Sparsifier.sparsify`
+
+    :param list arrays: received arrays
+    :param dict description: description returned with the arrays
+    :param list reference: model the delta was computed against
+    :return: the weights
+    :rtype: list
+
+    """
+    if 'quantization' in description:
+        arrays = dequantize(arrays, description['quantization'])
+    if len(description['tensors']) != len(reference):
+        raise ValueError('expected {} tensors, received {}'.format(len(reference), len(description['tensors'])))
+    weights = []
+    position = 0
+    for tensor, base in zip(description['tensors'], reference):
+        base = np.asarray(base)
+        if not tensor['sparse']:
+            weights.append(arrays[position].reshape(base.shape))
+            position += 1
+            continue
+        indices, values = arrays[position], arrays[position + 1]
+        position += 2
+        if len(indices) != len(values) or (len(indices) and int(indices.max()) >= base.size):
+            raise ValueError('malformed sparse tensor of shape {}'.format(base.shape))
+        restored = np.array(base, dtype=base.dtype, copy=True)
+        restored.reshape(-1)[indices] += values.astype(base.dtype, copy=False)
+        weights.append(restored)
+    return weights
+
+
+class Sparsifier:
+    """
+    Sparsifies the updates sent by a worker, with residual accumulation
+
+    :param str,optional mode: one of SPARSIFICATION_MODES
+    :param float,optional ratio: fraction of the entries of every tensor sent in topk mode
+    :param float,optional threshold: minimum magnitude of the entries sent in threshold mode
+    :param str,optional quantization: quantization of the values sent, see :ref:`Quantization`
+    """
+
+    def __init__(self, mode='none', ratio=SPARSE_CONF.ratio, threshold=SPARSE_CONF.threshold, quantization='none'):
+        if mode not in SPARSIFICATION_MODES:
+            raise ValueError('unknown sparsification mode {}, use one of {}'.format(mode, SPARSIFICATION_MODES))
+        self.mode = mode
+        self.ratio = ratio
+        self.threshold = threshold
+        # the residuals feed the quantization error back, not the quantizer
+        self._quantizer = Quantizer(quantization, error_feedback=False)
+        self._residuals = None
+        self.last_density = 1.0
+
+    def reset(self):
+        """
+        Forget the residuals, e.g., after the absolute weights were sent
+        """
+        self._residuals = None
+
+    def _select(self, delta):
+        """
+        Positions of the entries of a flattened delta that are sent
+        """
+        magnitude = np.abs(delta)
+        if self.mode == 'threshold':
+            return np.flatnonzero(magnitude >= self.threshold)
+        k = min(max(int(math.ceil(self.ratio * delta.size)), 1), delta.size)
+        if k == delta.size:
+            return np.arange(delta.size)
+        return np.sort(np.argpartition(magnitude, delta.size - k)[delta.size - k:])
+
+    def sparsify(self, weights, reference):
+        """
+        Sparse delta between the weights of the worker and the model it received
+
+        :param list weights: numpy arrays of the worker
+        :param list reference: model received from the chief, with the same shapes
+        :return: arrays to be sent and their description
+        :rtype: tuple(list, dict)
+
+        """
+        if len(weights) != len(reference):
+            raise ValueError('expected {} tensors, received {}'.format(len(reference), len(weights)))
+        if self._residuals is None or len(self._residuals) != len(weights):
+            self._residuals = [None] * len(weights)
+        arrays, tensors, deltas = [], [], []
+        sent, total = 0, 0
+        for i, (weight, base) in enumerate(zip(weights, reference)):
+            weight = np.asarray(weight)
+            if not np.issubdtype(weight.dtype, np.floating) or weight.size == 0:
+                arrays.append(weight)
+                tensors.append({'sparse': False})
+                deltas.append(None)
+                continue
+            delta = (weight - np.asarray(base)).reshape(-1)
+            if self._residuals[i] is not None and self._residuals[i].size == delta.size:
+                delta += self._residuals[i]
+            indices = self._select(delta)
+            arrays.append(indices.astype(_index_dtype(delta.size)))
+            arrays.append(delta[indices])
+            tensors.append({'sparse': True})
+            deltas.append((delta, indices))
+            sent += len(indices)
+            total += delta.size
+        arrays, quantization = self._quantizer.quantize(arrays)
+        received = dequantize(arrays, quantization)
+        # what the chief will not see is sent in the next rounds
+        position = 0
+        for i, tensor in enumerate(tensors):
+            if not tensor['sparse']:
+                position += 1
+                continue
+            delta, indices = deltas[i]
+            delta[indices] -= received[position + 1]
+            self._residuals[i] = delta
+            position += 2
+        self.last_density = sent / total if total else 1.0
+        description = {'mode': self.mode, 'tensors': tensors}
+        if quantization['mode'] != 'none':
+            description['quantization'] = quantization
+        return arrays, description
@@ -0,0 +1,129 @@
+"""
+.. _Tensors:
+
+Tensors
+=======
+Wire format of the numpy arrays exchanged in the federated processes of the BSMD. A message is made of:
+
+* a fixed header: magic bytes, version and length of the description
+* the description, a JSON object with the metadata of the message (e.g., the sender) and the name, dtype, shape,
+  offset and size of every array
+* the raw buffers of the arrays, each one aligned to ``TENSOR_CONF.alignment`` bytes
+
+:func:`encode` returns the message as a list of buffers that point to the memory of the arrays, so the message can be
+sent scatter/gather without copying the weights. :func:`decode` returns arrays that are views of the received
+buffer, so the weights are not copied either. Unlike pickle, decoding a message never runs code: only numeric dtypes
+are accepted and every array must be inside the message.
+
+:Example:
+>>> parts = encode([np.ones((3, 3)), np.zeros(5)], sender='worker1')
+>>> stream.send(parts)
+>>> # on the other side
+>>> metadata, arrays = decode(stream.recv())
+>>> print(metadata['sender'], arrays[0].shape)
+worker1 (3, 3)
+
+"""
+import json
+import struct
+import numpy as np
+
+TENSOR_CONF = lambda x: x
+TENSOR_CONF.magic = b'BSMT'
+TENSOR_CONF.version = 1
+TENSOR_CONF.alignment = 64
+
+# magic bytes, version, length of the description
+_HEADER = struct.Struct('!4sBI')
+_PADDING = bytes(TENSOR_CONF.alignment)
+
+
+def _aligned(offset):
+    return -(-offset // TENSOR_CONF.alignment) * TENSOR_CONF.alignment
+
+
+def encode(arrays, names=None, **metadata):
+    """
+    Encode numpy arrays. The arrays are not copied unless they are not contiguous in memory
+
+    :param list arrays: numpy arrays to be sent
+    :param list[str],optional names: names of the arrays, by default their position
+    :param metadata: JSON serializable values sent with the arrays, e.g., sender='worker1'
+    :return: buffers of the message, to be sent one after the other
+    :rtype: list
+
+    """
+    arrays = [np.asarray(array) for array in arrays]
+    arrays = [array if array.flags.c_contiguous else np.ascontiguousarray(array) for array in arrays]
+    if names is None:
+        names = [str(i) for i in range(len(arrays))]
+    tensors = []
+    offset = 0
+    for name, array in zip(names, arrays):
+        if array.dtype.hasobject:
+            raise TypeError('array {} has dtype {} which can not be sent'.format(name, array.dtype))
+        tensors.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset,
+                        'nbytes': array.nbytes})
+        offset = _aligned(offset + array.nbytes)
+    description = json.dumps({'metadata': metadata, 'tensors': tensors}).encode('utf-8')
+    start = _aligned(_HEADER.size + len(description))
+    parts = [_HEADER.pack(TENSOR_CONF.magic, TENSOR_CONF.version, len(description)), description,
+             _PADDING[:start - _HEADER.size - len(description)]]
+    position = 0
+    for tensor, array in zip(tensors, arrays):
+        parts.append(_PADDING[:tensor['offset'] - position])
+        parts.append(array.reshape(-1).view(np.uint8) if array.nbytes else b'')
+        position = tensor['offset'] + tensor['nbytes']
+    return [part for part in parts if len(part)]
+
+
+def message_size(parts):
+    """
+    Size in bytes of an encoded message
+
+    :param list parts: buffers returned by :func:`encode`
+    :rtype: int
+
+    """
+    return sum(memoryview(part).nbytes for part in parts)
+
+
+def decode(message):
+    """
+    Decode a message produced by :func:`encode`. The arrays are views of the message, which must not be reused
+    while the arrays are in use
+
+    :param message: the received message, any object supporting the buffer protocol
+    :return: metadata of the message and the arrays. The names of the arrays are in metadata['names']
+    :rtype: tuple(dict, list)
+
+    """
+    view = memoryview(message).cast('B')
+    if len(view) < _HEADER.size:
+        raise ValueError('message too short for a tensor header')
+    magic, version, length = _HEADER.unpack(view[:_HEADER.size])
+    if magic != TENSOR_CONF.magic or version != TENSOR_CONF.version:
+        raise ValueError('not a tensor message of version {}'.format(TENSOR_CONF.version))
+    try:
+        description = json.loads(str(view[_HEADER.size:_HEADER.size + length], 'utf-8'))
+        start = _aligned(_HEADER.size + length)
+        metadata = dict(description['metadata'])
+        metadata['names'] = []
+        arrays = []
+        for tensor in description['tensors']:
+            dtype = np.dtype(tensor['dtype'])
+            if dtype.hasobject:
+                raise ValueError('tensor {} has dtype {} which can not be received'.format(tensor['name'], dtype))
+            shape = tuple(int(dim) for dim in tensor['shape'])
+            if any(dim < 0 for dim in shape):
+                raise ValueError('tensor {} has a negative dimension'.format(tensor['name']))
+            count = int(np.prod(shape, dtype=np.int64))
+            begin = start + int(tensor['offset'])
+            end = begin + count * dtype.itemsize
+            if begin < start or end > len(view):
+                raise ValueError('tensor {} is outside of the message'.format(tensor['name']))
+            arrays.append(np.frombuffer(view[begin:end], dtype=dtype, count=count).reshape(shape))
+            metadata['names'].append(tensor['name'])
+    except (KeyError, TypeError, UnicodeDecodeError, json.JSONDecodeError) as error:
+        raise ValueError('malformed tensor description: {}'.format(error))
+    return metadata, arrays
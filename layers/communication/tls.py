@@ -0,0 +1,195 @@
+"""
+.. _TLS:
+
+TLS
+===
+TLS configuration shared by all the sockets of the BSMD. Each role has a single long-lived ``ssl.SSLContext``: the
+server context loads the certificate once and issues session tickets, and the client context keeps the last session
+of every peer so the next connection resumes it instead of running a full handshake. Resumption statistics are
+kept per role and can be consulted with :func:`tls_statistics`.
+
+In a shell generate a private key and certificate with:
+
+.. code-block:: bash
+
+    openssl req -new -x509 -days 365 -nodes -out server.pem -keyout server.key
+
+and set ``SSL_CONF.key_path`` and ``SSL_CONF.cert_path``. If ``SSL_CONF.ca_path`` is set, clients verify the
+certificate of the server against it.
+
+:Example:
+>>> sock = connect('123.456.789', 7777)
+>>> sock.sendall(b'hello')
+>>> release(sock)
+>>> print(tls_statistics())
+{'client': {'handshakes': 1, 'resumed': 0, 'resumption_rate': 0.0}, 'server': {...}}
+
+"""
+import socket
+import ssl
+import threading
+
+SSL_CONF = lambda x: x
+SSL_CONF.key_path = 'layers/communication/server.key'
+SSL_CONF.cert_path = 'layers/communication/server.pem'
+SSL_CONF.ca_path = None
+SSL_CONF.ciphers = 'EECDH+AESGCM:EDH+AESGCM:AES256+EECDH:AES256+EDH'
+SSL_CONF.num_tickets = 4
+
+_lock = threading.Lock()
+_contexts = {}
+_sessions = {}
+_statistics = {'server': {'handshakes': 0, 'resumed': 0}, 'client': {'handshakes': 0, 'resumed': 0}}
+
+
+def server_context():
+    """
+    Long-lived context used to accept TLS connections. The certificate is loaded only once
+
+    :return: the server context
+    :rtype: ssl.SSLContext
+
+    """
+    with _lock:
+        if 'server' not in _contexts:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            context.set_ciphers(SSL_CONF.ciphers)
+            context.load_cert_chain(certfile=SSL_CONF.cert_path, keyfile=SSL_CONF.key_path)
+            # session tickets let returning clients skip the full handshake
+            context.options &= ~ssl.OP_NO_TICKET
+            if hasattr(context, 'num_tickets'):
+                context.num_tickets = SSL_CONF.num_tickets
+            _contexts['server'] = context
+        return _contexts['server']
+
+
+def client_context():
+    """
+    Long-lived context used to open TLS connections
+
+    :return: the client context
+    :rtype: ssl.SSLContext
+
+    """
+    with _lock:
+        if 'client' not in _contexts:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            context.set_ciphers(SSL_CONF.ciphers)
+            if SSL_CONF.ca_path is not None:
+                context.load_verify_locations(cafile=SSL_CONF.ca_path)
+            else:
+                # the nodes use self signed certificates, the peers are identified in the BSMD
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            _contexts['client'] = context
+        return _contexts['client']
+
+
+def reset_contexts():
+    """
+    Forget the contexts and the cached sessions, e.g., after changing SSL_CONF
+    """
+    with _lock:
+        _contexts.clear()
+        _sessions.clear()
+
+
+def _count(role, ssl_socket):
+    with _lock:
+        _statistics[role]['handshakes'] += 1
+        if ssl_socket.session_reused:
+            _statistics[role]['resumed'] += 1
+
+
+def wrap_server_socket(sock):
+    """
+    Run the server side of the TLS handshake on an accepted connection
+
+    :param socket.socket sock: connection returned by accept
+    :return: TLS protected connection
+    :rtype: ssl.SSLSocket
+
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    ssl_socket = server_context().wrap_socket(sock, server_side=True)
+    _count('server', ssl_socket)
+    return ssl_socket
+
+
+def connect(host, port, timeout=None):
+    """
+    Open a TLS connection. If there was a previous connection with the same peer its session is resumed
+
+    :param str host: ip address of the peer
+    :param int port: port of the peer
+    :param float,optional timeout: timeout of the connection in seconds
+    :return: TLS protected connection
+    :rtype: ssl.SSLSocket
+
+    """
+    sock = socket.create_connection((host, port), timeout=timeout)
+    # the protocols of the BSMD write headers and payloads separately, do not let Nagle delay them
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    with _lock:
+        session = _sessions.get((host, port))
+    try:
+        ssl_socket = client_context().wrap_socket(sock, server_hostname=host, session=session)
+    except ssl.SSLError:
+        if session is None:
+            raise
+        # the server does not know the session any more, fall back to a full handshake
+        sock.close()
+        with _lock:
+            _sessions.pop((host, port), None)
+        return connect(host, port, timeout)
+    ssl_socket.peer_endpoint = (host, port)
+    _count('client', ssl_socket)
+    remember_session(ssl_socket)
+    return ssl_socket
+
+
+def remember_session(ssl_socket):
+    """
+    Keep the session of a client connection for the next connection with the same peer. With TLS 1.3 the session
+    ticket arrives after the handshake, so call this again once data has been received
+
+    :param ssl.SSLSocket ssl_socket: client connection opened with :func:`connect`
+
+    """
+    endpoint = getattr(ssl_socket, 'peer_endpoint', None)
+    try:
+        session = ssl_socket.session
+    except (ValueError, AttributeError):
+        return
+    if endpoint is not None and session is not None and (session.has_ticket or not session.ticket_lifetime_hint):
+        with _lock:
+            _sessions[endpoint] = session
+
+
+def release(ssl_socket):
+    """
+    Keep the session of a client connection and close it
+
+    :param ssl.SSLSocket ssl_socket: client connection opened with :func:`connect`
+
+    """
+    remember_session(ssl_socket)
+    ssl_socket.close()
+
+
+def tls_statistics():
+    """
+    Number of handshakes, resumed sessions and resumption rate per role
+
+    :return: statistics of the server and client roles
+    :rtype: dict
+
+    """
+    with _lock:
+        statistics = {}
+        for role, counts in _statistics.items():
+            rate = counts['resumed'] / counts['handshakes'] if counts['handshakes'] else 0.0
+            statistics[role] = dict(counts, resumption_rate=rate)
+        return statistics
@@ -0,0 +1,61 @@
+"""
+.. _Topology:
+
+Topology
+========
+Tree of the nodes of a federated process. The chief is the root, the aggregators are the inner nodes and the workers
+are the leaves. An aggregator receives and averages the weights of its children, as the chief does, and sends
+upstream a single partial average with the number of nodes it includes. The averaged weights flow down the same tree.
+With aggregators the chief only terminates the sessions of its own children, so the number of workers is not limited
+by the network and CPU of a single node.
+
+The tree is complete: the chief and every aggregator have at most ``fanout`` children, the aggregators are placed
+first, closest to the chief, and then the workers, level by level. By default the chief has the aggregators as
+children and the workers are split evenly among them.
+
+:Example:
+>>> assign('chief', ['aggregator1', 'aggregator2'], ['worker1', 'worker2', 'worker3', 'worker4'])
+{'chief': {'parent': None, 'children': ['aggregator1', 'aggregator2'], 'level': 0},
+ 'aggregator1': {'parent': 'chief', 'children': ['worker1', 'worker2'], 'level': 1},
+ 'aggregator2': {'parent': 'chief', 'children': ['worker3', 'worker4'], 'level': 1},
+ 'worker1': {'parent': 'aggregator1', 'children': [], 'level': 2},
+ ...}
+
+"""
+import collections
+import math
+
+
+def assign(chief, aggregators, workers, fanout=None):
+    """
+    Place the nodes of a federated process in a tree
+
+    :param str chief: name of the chief
+    :param list[str] aggregators: names of the nodes that can aggregate the weights of other nodes
+    :param list[str] workers: names of the other nodes
+    :param int,optional fanout: maximum number of children of the chief and of every aggregator. By default the
+                                children of the chief are the aggregators and the workers are split evenly among them
+    :return: parent, children and depth of every node, by name
+    :rtype: dict
+
+    """
+    if fanout is None:
+        root_fanout = len(aggregators) or max(len(workers), 1)
+        fanout = max(int(math.ceil(len(workers) / len(aggregators))), 1) if aggregators else root_fanout
+    else:
+        root_fanout = fanout
+    if fanout < 1:
+        raise ValueError('the fanout of the tree must be at least 1')
+    tree = {chief: {'parent': None, 'children': [], 'level': 0}}
+    parents = collections.deque([chief])
+    for name in list(aggregators) + list(workers):
+        # the last aggregator takes the nodes that do not fit in the tree
+        while len(parents) > 1 and len(tree[parents[0]]['children']) >= (root_fanout if parents[0] == chief
+                                                                           else fanout):
+            parents.popleft()
+        parent = parents[0]
+        tree[parent]['children'].append(name)
+        tree[name] = {'parent': parent, 'children': [], 'level': tree[parent]['level'] + 1}
+        if name in aggregators:
+            parents.append(name)
+    return tree
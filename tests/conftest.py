@@ -0,0 +1,63 @@
+import os
+import shutil
+import subprocess
+import sys
+import types
+import pytest
+
+# the tests import the layers from the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def certificate(tmp_path_factory):
+    """
+    Self-signed certificate and private key for the TLS connections of the tests
+    """
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is needed to create the certificate of the tests')
+    directory = tmp_path_factory.mktemp('tls')
+    cert_path, key_path = str(directory / 'server.pem'), str(directory / 'server.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', key_path, '-out', cert_path], check=True, capture_output=True)
+    return cert_path, key_path
+
+
+@pytest.fixture
+def tls(certificate, monkeypatch):
+    """
+    Use the certificate of the tests in the shared TLS contexts
+    """
+    from layers.communication import tls as tls_module
+    monkeypatch.setattr(tls_module.SSL_CONF, 'cert_path', certificate[0])
+    monkeypatch.setattr(tls_module.SSL_CONF, 'key_path', certificate[1])
+    tls_module.reset_contexts()
+    yield certificate
+    tls_module.reset_contexts()
+
+
+@pytest.fixture(scope='session')
+def federated_hook():
+    """
+    Module of the federated hook. Its exchanges do not use tensorflow, which only gives the hook its base class, so a
+    stand-in replaces tensorflow while the module is imported if the graph API is not installed
+    """
+    pytest.importorskip('iroha')
+    try:
+        import tensorflow
+        graph_api = hasattr(tensorflow, 'placeholder')
+    except ImportError:
+        graph_api = False
+    if graph_api or 'layers.communication.federated_hook' in sys.modules:
+        from layers.communication import federated_hook
+        return federated_hook
+    installed = sys.modules.get('tensorflow')
+    sys.modules['tensorflow'] = types.SimpleNamespace(train=types.SimpleNamespace(SessionRunHook=object))
+    try:
+        from layers.communication import federated_hook
+    finally:
+        if installed is None:
+            sys.modules.pop('tensorflow')
+        else:
+            sys.modules['tensorflow'] = installed
+    return federated_hook
@@ -0,0 +1,75 @@
+import threading
+import numpy as np
+import pytest
+from layers.communication.aggregation import StreamingAverage
+
+TEMPLATES = [np.zeros((3, 2), dtype=np.float32), np.zeros(4, dtype=np.float32)]
+
+
+def weights(value):
+    return [np.full((3, 2), value, dtype=np.float32), np.full(4, value, dtype=np.float32)]
+
+
+def test_average_of_a_round():
+    average = StreamingAverage(TEMPLATES)
+    average.start_round(1)
+    for name, value in [('chief', 1.0), ('worker1', 2.0), ('worker2', 6.0)]:
+        assert average.add(weights(value), 1, name)
+    assert average.close() == ['chief', 'worker1', 'worker2']
+    averaged = average.average()
+    assert all(value.dtype == np.float32 for value in averaged)
+    assert np.allclose(averaged[0], 3.0) and np.allclose(averaged[1], 3.0)
+
+
+def test_weights_of_an_aggregator():
+    # the aggregator sends the average of three nodes
+    average = StreamingAverage(TEMPLATES)
+    average.start_round(1)
+    average.add(weights(0.0), 1, 'chief')
+    average.add(weights(4.0), 1, 'aggregator', weight=3)
+    assert average.count == 4
+    assert np.allclose(average.average()[0], 3.0)
+    with pytest.raises(ValueError):
+        average.add(weights(1.0), 1, 'aggregator', weight=0)
+
+
+def test_late_and_stale_weights_are_ignored():
+    average = StreamingAverage(TEMPLATES)
+    average.start_round(2)
+    average.add(weights(1.0), 2, 'chief')
+    assert not average.add(weights(9.0), 1, 'worker1')
+    average.close()
+    assert not average.add(weights(9.0), 2, 'worker2')
+    assert np.allclose(average.average()[1], 1.0)
+
+
+def test_new_round_clears_the_accumulators():
+    average = StreamingAverage(TEMPLATES)
+    average.start_round(1)
+    average.add(weights(5.0), 1, 'chief')
+    average.start_round(2)
+    with pytest.raises(ValueError):
+        average.average()
+    average.add(weights(1.0), 2, 'chief')
+    assert np.allclose(average.average()[0], 1.0)
+
+
+def test_wrong_shapes():
+    average = StreamingAverage(TEMPLATES)
+    average.start_round(1)
+    with pytest.raises(ValueError):
+        average.add(weights(1.0)[:1], 1)
+    with pytest.raises(ValueError):
+        average.add([np.zeros((2, 3)), np.zeros(4)], 1)
+
+
+def test_concurrent_workers():
+    average = StreamingAverage(TEMPLATES)
+    average.start_round(1)
+    threads = [threading.Thread(target=average.add, args=(weights(float(i)), 1, i)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert sorted(average.close()) == list(range(20))
+    assert np.allclose(average.average()[0], 9.5)
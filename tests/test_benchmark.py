@@ -0,0 +1,29 @@
+import pytest
+from layers.communication.benchmark import run_case
+
+
+@pytest.mark.parametrize('options', [{}, {'compression': True}, {'multiplexed': True}],
+                         ids=['plain', 'compression', 'multiplexed'])
+def test_p2p(options):
+    result = run_case('p2p', 1000, 2, 3, 4, **options)
+    assert result['messages'] == 12
+    assert result['messages_per_second'] > 0
+    assert 0 < result['latency_p50'] <= result['latency_p99'] <= result['latency_max']
+    assert 'tls' not in result
+
+
+def test_p2p_with_tls(tls):
+    from layers.communication.tls import tls_statistics
+    before = tls_statistics()
+    result = run_case('p2p', 1000, 1, 2, 3, tls=tls)
+    assert result['messages'] == 6
+    # the p2p senders connect for every message, all but the first connection of each sender resume the session
+    for role in ('client', 'server'):
+        assert result['tls'][role]['handshakes'] - before[role]['handshakes'] == 6
+        assert result['tls'][role]['resumed'] - before[role]['resumed'] >= 4
+
+
+def test_federated(federated_hook):
+    result = run_case('federated', 4000, 1, 2, 3, compression=True)
+    assert result['messages'] == 6
+    assert result['mb_per_second'] > 0
@@ -0,0 +1,92 @@
+import os
+import socket
+import numpy as np
+import pytest
+from layers.communication.blobstore import BlobStore, address_of
+from layers.communication.mux import MultiplexedConnection
+from layers.communication.tensors import decode, encode
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = BlobStore(root=str(tmp_path / 'blobs'))
+    yield store
+    store.flush()
+
+
+def files_in(root):
+    return [name for _, _, names in os.walk(root) for name in names]
+
+
+def test_address_does_not_depend_on_the_parts():
+    parts = encode([np.arange(10, dtype=np.float32)])
+    assert address_of(parts) == address_of([b''.join(memoryview(part).cast('B') for part in parts)])
+
+
+def test_put_and_get(store):
+    weights = [np.arange(6, dtype=np.float32).reshape(2, 3), np.ones(4, dtype=np.float32)]
+    address = store.put(encode(weights))
+    assert address in store
+    _, arrays = decode(store.get(address))
+    assert all(np.array_equal(a, b) for a, b in zip(arrays, weights))
+    # the same snapshot is stored once
+    assert store.put(encode(weights)) == address
+    assert len(files_in(store.root)) == 1
+
+
+def test_background_put_is_readable_before_and_after_the_write(tmp_path):
+    store = BlobStore(root=str(tmp_path / 'blobs'), memory_capacity=0)
+    weights = np.arange(1000, dtype=np.float32)
+    address = store.put(encode([weights]), wait=False)
+    # the snapshot is not kept in memory, it is read from the pending writes or from disk
+    assert np.array_equal(decode(store.get(address))[1][0], weights)
+    store.flush()
+    assert len(files_in(store.root)) == 1
+    assert np.array_equal(decode(store.get(address))[1][0], weights)
+
+
+def test_background_put_copies_the_buffers(store):
+    weights = np.zeros(100, dtype=np.float32)
+    address = store.put(encode([weights]), wait=False)
+    weights += 1
+    store.flush()
+    assert np.array_equal(decode(store.get(address))[1][0], np.zeros(100, dtype=np.float32))
+
+
+def test_disk_capacity(tmp_path):
+    store = BlobStore(root=str(tmp_path / 'blobs'), memory_capacity=0, disk_capacity=3000)
+    for value in range(5):
+        store.put(encode([np.full(250, value, dtype=np.float32)]))
+    assert len(files_in(store.root)) < 5
+    assert sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(store.root)
+               for name in names) <= 3000
+
+
+def test_corrupted_snapshot_is_removed(tmp_path):
+    store = BlobStore(root=str(tmp_path / 'blobs'), memory_capacity=0)
+    address = store.put(b'snapshot')
+    with open(store._path(address), 'wb') as file:
+        file.write(b'tampered')
+    assert store.get(address) is None
+    assert address not in store
+
+
+def test_invalid_address(store):
+    with pytest.raises(ValueError):
+        store.get('../etc/passwd')
+
+
+def test_fetch_from_a_peer(tmp_path):
+    owner = BlobStore(root=str(tmp_path / 'owner'))
+    other = BlobStore(root=str(tmp_path / 'other'))
+    address = owner.put(b'weights of the round')
+    left, right = socket.socketpair()
+    server = MultiplexedConnection(left, True, lambda stream: owner.serve(stream))
+    client = MultiplexedConnection(right, False)
+    try:
+        assert other.fetch(address, [client], timeout=5) == b'weights of the round'
+        assert address in other
+        assert other.fetch(address_of([b'missing']), [client], timeout=5) is None
+    finally:
+        client.close()
+        server.close()
@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import pytest
+from layers.communication.checkpoint import CHECKPOINT_CONF, default_path, load, save
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'chief.ckpt')
+    weights = [np.arange(12, dtype=np.float32).reshape(3, 4), np.arange(3, dtype=np.int64)]
+    save(path, weights, iteration=120, workers=['worker1', 'worker2'], ring=None)
+    state, restored = load(path)
+    assert state['iteration'] == 120
+    assert state['workers'] == ['worker1', 'worker2']
+    assert state['ring'] is None
+    assert 'names' not in state
+    for weight, value in zip(weights, restored):
+        assert value.dtype == weight.dtype and np.array_equal(value, weight)
+    # the weights are copied out of the file, which is closed
+    assert restored[0].flags.owndata and restored[0].flags.writeable
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/maps'), reason='the memory maps of the process are not listed')
+def test_load_closes_the_file(tmp_path):
+    path = str(tmp_path / 'chief.ckpt')
+    save(path, [np.ones(4096, dtype=np.float32)], iteration=1)
+    state, restored = load(path)
+    with open('/proc/self/maps') as maps:
+        assert path not in maps.read()
+
+
+def test_save_replaces_the_previous_checkpoint(tmp_path):
+    path = str(tmp_path / 'chief.ckpt')
+    save(path, [np.zeros(100, dtype=np.float32)], iteration=1)
+    save(path, [np.ones(3, dtype=np.float32)], iteration=2)
+    state, restored = load(path)
+    assert state['iteration'] == 2 and restored[0].tolist() == [1, 1, 1]
+    # no temporary file is left
+    assert os.listdir(str(tmp_path)) == ['chief.ckpt']
+
+
+def test_missing_checkpoint(tmp_path):
+    assert load(str(tmp_path / 'missing.ckpt')) is None
+    (tmp_path / 'empty.ckpt').write_bytes(b'')
+    assert load(str(tmp_path / 'empty.ckpt')) is None
+
+
+def test_corrupted_checkpoint(tmp_path):
+    path = tmp_path / 'chief.ckpt'
+    save(str(path), [np.zeros(10, dtype=np.float32)], iteration=1)
+    path.write_bytes(path.read_bytes()[:20])
+    assert load(str(path)) is None
+
+
+def test_default_path(monkeypatch, tmp_path):
+    monkeypatch.setattr(CHECKPOINT_CONF, 'directory', str(tmp_path))
+    path = default_path('chief' + os.sep + 'one')
+    assert os.path.dirname(path) == str(tmp_path)
+    assert os.path.basename(path) == 'chief_one.ckpt'
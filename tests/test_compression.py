@@ -0,0 +1,76 @@
+import socket
+import threading
+import pytest
+from layers.communication.compression import (COMPRESSION_CONF, AdaptiveCompressor, available_codecs, compress,
+                                              decompress, negotiate)
+from layers.communication.framing import FrameTooLarge
+
+COMPRESSIBLE = b'weights of the model ' * 100000
+
+
+@pytest.mark.parametrize('codec', available_codecs())
+def test_round_trip(codec):
+    payload = compress(COMPRESSIBLE, codec)
+    assert bytes(decompress(payload, len(COMPRESSIBLE))) == COMPRESSIBLE
+    if codec != 'none':
+        assert len(payload) < len(COMPRESSIBLE)
+
+
+@pytest.mark.parametrize('codec', available_codecs())
+def test_bomb_is_rejected(codec):
+    # a few KB that would inflate to 64 MB
+    payload = compress(bytes(64 * 1024 * 1024), codec)
+    with pytest.raises(FrameTooLarge):
+        decompress(payload, 1024 * 1024)
+
+
+def test_unknown_and_corrupted_payloads():
+    with pytest.raises(ValueError):
+        decompress(b'\x7fdata', 1024)
+    with pytest.raises(ValueError):
+        decompress(compress(COMPRESSIBLE, 'zlib')[:100], len(COMPRESSIBLE))
+
+
+def test_negotiation():
+    client, server = socket.socketpair()
+    agreed = {}
+    thread = threading.Thread(target=lambda: agreed.update(server=negotiate(server, True, ['none', 'zlib'])))
+    thread.start()
+    agreed['client'] = negotiate(client, False, ['zstd', 'zlib', 'none'])
+    thread.join(10)
+    client.close()
+    server.close()
+    assert agreed == {'client': ['zlib', 'none'], 'server': ['zlib', 'none']}
+
+
+def test_small_payloads_are_not_compressed():
+    compressor = AdaptiveCompressor(['none', 'zlib'])
+    assert compressor.choose(b'x' * (COMPRESSION_CONF.min_size - 1)) == 'none'
+
+
+def test_first_large_payload_measures_the_link():
+    compressor = AdaptiveCompressor(['none', 'zlib'])
+    assert compressor.choose(COMPRESSIBLE) == 'none'
+    compressor.record_transfer(len(COMPRESSIBLE), 1.0)
+    assert compressor.throughput == len(COMPRESSIBLE)
+
+
+def test_slow_link_compresses_and_fast_link_does_not():
+    slow = AdaptiveCompressor(['none', 'zlib'])
+    slow.record_transfer(COMPRESSION_CONF.min_transfer, 1.0)
+    assert slow.choose(COMPRESSIBLE) == 'zlib'
+    fast = AdaptiveCompressor(['none', 'zlib'])
+    fast.record_transfer(COMPRESSION_CONF.min_transfer, 1e-9)
+    assert fast.choose(COMPRESSIBLE) == 'none'
+
+
+def test_uncompressed_parts_are_not_copied():
+    compressor = AdaptiveCompressor(['none'])
+    part = bytearray(b'x' * 10000)
+    parts = compressor.compress_parts([b'header', part])
+    assert parts[0] == b'\x00' and parts[2].obj is part
+    compressor = AdaptiveCompressor(['none', 'zlib'])
+    compressor.record_transfer(COMPRESSION_CONF.min_transfer, 1.0)
+    parts = compressor.compress_parts([b'header', COMPRESSIBLE])
+    assert compressor.last_codec == 'zlib'
+    assert bytes(decompress(b''.join(parts), len(COMPRESSIBLE) + 6)) == b'header' + COMPRESSIBLE
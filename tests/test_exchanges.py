@@ -0,0 +1,229 @@
+"""
+Exchanges of the weights between the chief of the federated hook and workers with a session on the loopback. They
+run without the graph API of tensorflow, see the federated_hook fixture
+"""
+import queue
+import socket
+import threading
+import numpy as np
+import pytest
+from layers.communication.session import SESSION_CONF, WorkerSession
+from layers.communication.tensors import decode, encode
+
+
+@pytest.fixture
+def records(federated_hook, monkeypatch):
+    """
+    Senders and iterations of the snapshots recorded in the BSMD, once the background thread has recorded them
+    """
+    recorded = []
+    monkeypatch.setattr(federated_hook._FederatedHook, '_record_snapshot',
+                        staticmethod(lambda arrays, iteration, tot_workers, sender, *args, **kwargs:
+                                     recorded.append((sender, iteration))))
+    yield recorded
+
+
+@pytest.fixture
+def chief(federated_hook, tls, monkeypatch):
+    """
+    Create chiefs that serve their sessions on the loopback without waiting for the workers of the list
+    """
+    monkeypatch.setattr(federated_hook._FederatedHook, '_get_task_index', lambda self: (0, 1))
+    # the loops of the chief wake up often, so they end soon after the tests
+    monkeypatch.setattr(SESSION_CONF, 'heartbeat_interval', 0.2)
+    hooks = []
+
+    def create(**options):
+        hook = federated_hook._FederatedHook(True, 'chief', '127.0.0.1:0', '127.0.0.1:0', 'key', [], 'domain', 'ip',
+                                 shared_memory=False, **options)
+        hook._start_server('127.0.0.1', 0)
+        hooks.append(hook)
+        return hook
+
+    yield create
+    for hook in hooks:
+        hook._stopped.set()
+        if hook._executor is not None:
+            hook._executor.shutdown(wait=True)
+        hook._server.stop()
+    federated_hook._flush_background()
+
+
+
+class FakeSession:
+    """
+    Session of a worker whose messages are put in a queue by the test
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = queue.Queue()
+        self.answers = []
+
+    def recv(self, timeout=None):
+        try:
+            message = self.messages.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout('no message from ' + self.name)
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def send_control(self, message):
+        self.answers.append(message)
+
+
+class FakeServer:
+    """
+    Sessions of the workers, a worker with a session in reconnections opens it when the chief waits for it
+    """
+
+    def __init__(self, names):
+        self.sessions = {name: FakeSession(name) for name in names}
+        self.reconnections = {}
+
+    def session(self, name, timeout=None):
+        if timeout is not None and name in self.reconnections:
+            self.sessions[name] = self.reconnections.pop(name)
+        return self.sessions.get(name)
+
+
+@pytest.fixture
+def gathering(federated_hook, monkeypatch):
+    """
+    Chief that gathers the weights of worker1 and worker2 through fake sessions
+    """
+    monkeypatch.setattr(federated_hook._FederatedHook, '_get_task_index', lambda self: (0, 1))
+    monkeypatch.setattr(federated_hook.SEND_RECEIVE_CONF, 'round_timeout', 2)
+    monkeypatch.setattr(federated_hook.SEND_RECEIVE_CONF, 'timeout', 1)
+    hook = federated_hook._FederatedHook(True, 'chief', '127.0.0.1:0', '127.0.0.1:0', 'key', ['worker1', 'worker2'],
+                                         'domain', 'ip', shared_memory=False)
+    hook._workers = ['worker1', 'worker2']
+    hook._server = FakeServer(hook._workers)
+    yield hook
+    if hook._executor is not None:
+        hook._executor.shutdown(wait=True)
+
+
+def weights(hook, sender, value, iteration):
+    parts = encode([np.full(3, value, np.float32)], sender=sender, iteration=iteration)
+    return b''.join([bytes(part) for part in [hook._sign(parts)] + parts])
+
+def connect(hook, name):
+    worker = WorkerSession('127.0.0.1', hook._server.port, name, hook._server.key, inspector=hook._new_verifier)
+    worker.connect()
+    assert hook._server.session(name, 5) is not None
+    hook._workers.append(name)
+    return worker
+
+
+def push(hook, worker, value, iteration, **metadata):
+    hook._send_np_array([np.full(3, value, np.float32)], worker, iteration, 2, worker.name, 'key', 'chief', 'domain',
+                        'ip', **metadata)
+
+
+def answer(hook, worker):
+    metadata, arrays = decode(hook._receiving_subroutine(worker, 5))
+    return metadata, [np.array(array) for array in arrays]
+
+
+def test_async_pushes_are_weighted_by_their_staleness(federated_hook, chief, records):
+    hook = chief(synchronization='async', max_staleness=2)
+    worker = connect(hook, 'worker1')
+    # the global model is at version 4, which was recorded
+    hook._version = hook._recorded = 4
+    hook._start_serving([np.zeros(3, np.float32)])
+    mixing = federated_hook.SEND_RECEIVE_CONF.mixing
+
+    push(hook, worker, 1.0, 10, base=4)
+    metadata, (weights,) = answer(hook, worker)
+    assert metadata['iteration'] == 5
+    assert np.allclose(weights, mixing)
+
+    # two versions old
+    push(hook, worker, 3.0, 11, base=3)
+    metadata, (weights,) = answer(hook, worker)
+    alpha = mixing / 3 ** 0.5
+    assert metadata['iteration'] == 6
+    assert np.allclose(weights, (1 - alpha) * mixing + alpha * 3.0, atol=1e-6)
+
+    # staler than max_staleness, the worker gets the global model unchanged
+    push(hook, worker, 100.0, 12, base=0)
+    metadata, discarded = answer(hook, worker)
+    assert metadata['iteration'] == 6
+    assert np.allclose(discarded[0], weights)
+    assert hook._version == 6
+
+    worker.close()
+    federated_hook._flush_background()
+    # one snapshot every as many mixes as nodes, not one per push
+    assert [iteration for sender, iteration in records if sender == 'chief'] == [6]
+
+
+def test_weights_of_another_round_are_not_averaged(chief, records):
+    hook = chief()
+    workers = [connect(hook, name) for name in ('worker1', 'worker2')]
+    answers = {}
+
+    def late(worker):
+        # the worker kept training while the chief was resumed from an older round
+        push(hook, worker, 1.0, 12)
+        answers[worker.name] = answer(hook, worker)
+
+    senders = [threading.Thread(target=push, args=(hook, workers[0], 1.0, 10)),
+               threading.Thread(target=late, args=(workers[1],))]
+    for sender in senders:
+        sender.start()
+    average, users, stragglers = hook._gather([np.zeros(3, np.float32)], 10)
+    for sender in senders:
+        sender.join(5)
+    assert np.allclose(average[0], 0.5)
+    assert [user.name for user in users] == ['worker1'] and stragglers == []
+    metadata, arrays = answers['worker2']
+    assert metadata['stale'] and metadata['iteration'] == 10 and arrays == []
+    for worker in workers:
+        worker.close()
+
+
+def test_weights_are_gathered_at_the_same_time(federated_hook, gathering):
+    hook = gathering
+    sessions = hook._server.sessions
+
+    def received(message):
+        # worker1 only sends its weights once those of worker2 were received
+        sessions['worker2'].answers.append(message)
+        sessions['worker1'].messages.put(weights(hook, 'worker1', 2.0, 10))
+
+    sessions['worker2'].send_control = received
+    sessions['worker2'].messages.put(weights(hook, 'worker2', 6.0, 10))
+    average, users, stragglers = hook._gather([np.full(3, 1.0, np.float32)], 10)
+    assert np.allclose(average[0], 3.0) and average[0].dtype == np.float32
+    assert [user.name for user in users] == ['worker2', 'worker1'] and stragglers == []
+    assert all(session.answers == [federated_hook.SEND_RECEIVE_CONF.recv] for session in sessions.values())
+
+
+def test_worker_that_lost_its_session_resends_its_weights(gathering):
+    hook = gathering
+    sessions = hook._server.sessions
+    sessions['worker1'].messages.put(ConnectionResetError('lost'))
+    hook._server.reconnections['worker1'] = FakeSession('worker1')
+    hook._server.reconnections['worker1'].messages.put(weights(hook, 'worker1', 4.0, 10))
+    sessions['worker2'].messages.put(weights(hook, 'worker2', 4.0, 10))
+    average, users, stragglers = hook._gather([np.full(3, 1.0, np.float32)], 10)
+    assert np.allclose(average[0], 3.0)
+    # the average keeps the new session of the worker, on which it gets the averaged weights
+    assert sessions['worker1'] in users and len(users) == 2
+
+
+def test_straggler_is_received_after_the_round(federated_hook, gathering, monkeypatch):
+    monkeypatch.setattr(federated_hook.SEND_RECEIVE_CONF, 'round_timeout', 0.5)
+    hook = gathering
+    sessions = hook._server.sessions
+    sessions['worker1'].messages.put(weights(hook, 'worker1', 2.0, 10))
+    average, users, stragglers = hook._gather([np.full(3, 1.0, np.float32)], 10)
+    assert np.allclose(average[0], 1.5)
+    assert [user.name for user in users] == ['worker1'] and stragglers == [sessions['worker2']]
+    # the weights of the straggler are still received, so its stream stays in order, but not averaged
+    sessions['worker2'].messages.put(weights(hook, 'worker2', 100.0, 10))
+    assert hook._gathering['worker2'].result(5) is False
+    assert sessions['worker2'].answers == [federated_hook.SEND_RECEIVE_CONF.recv]
@@ -0,0 +1,141 @@
+"""
+Rounds of the federated hook between nodes that run in their own processes, with their own graphs and global steps.
+The nodes train a model whose weights grow by one in every step, so after the last synchronization all of them have
+the initial weights of the chief plus the number of steps
+"""
+import multiprocessing
+import socket
+import time
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('iroha')
+if not hasattr(tf, 'placeholder'):
+    pytest.skip('the hook needs the graph API of tensorflow 1', allow_module_level=True)
+
+STEPS = 8
+INTERVAL = 2
+ROUND_TIMEOUT = 30
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_node(results, certificate, name, is_chief, address, workers, start, options, steps=STEPS, step_seconds=0.0,
+             wait_for=None, progress=None):
+    """
+    Train a node with the federated hook and put its name, first step and final weights in the results
+
+    :param multiprocessing.Queue results: queue of the results of the nodes
+    :param tuple certificate: certificate and private key of the TLS connections
+    :param float start: initial value of the weights
+    :param dict options: other arguments of the hook
+    :param float,optional step_seconds: seconds every step takes
+    :param multiprocessing.Event,optional wait_for: event after which the node starts
+    :param multiprocessing.Event,optional progress: event set once the node is half way through the training
+    """
+    import tensorflow as tf
+    from layers.communication import ledger
+    from layers.communication.federated_hook import _FederatedHook, SEND_RECEIVE_CONF
+    from layers.communication.tls import SSL_CONF
+    # the records of the rounds are not written in a BSMD
+    ledger.set_details_to_nodes = lambda *args, **kwargs: None
+    SSL_CONF.cert_path, SSL_CONF.key_path = certificate
+    SEND_RECEIVE_CONF.round_timeout = ROUND_TIMEOUT
+    if wait_for is not None:
+        wait_for.wait(120)
+    global_step = tf.train.get_or_create_global_step()
+    weights = tf.Variable(tf.fill([4, 3], float(start)), name='weights')
+    bias = tf.Variable(tf.fill([3], float(start)), name='bias')
+    train_op = tf.group(tf.assign_add(weights, tf.ones_like(weights)), tf.assign_add(bias, tf.ones_like(bias)),
+                        tf.assign_add(global_step, 1))
+    hook = _FederatedHook(is_chief, name, address, address, 'key', workers, 'domain', 'ip', wait_time=60,
+                          interval_steps=INTERVAL, **options)
+
+    def read(values):
+        # read without running the hooks
+        return session.run_step_fn(lambda context: context.session.run(values))
+
+    with tf.train.MonitoredTrainingSession(hooks=[hook, tf.train.StopAtStepHook(last_step=steps)]) as session:
+        first = read(global_step)
+        while not session.should_stop():
+            session.run(train_op)
+            time.sleep(step_seconds)
+            if progress is not None and read(global_step) >= steps // 2:
+                progress.set()
+        final = read([weights, bias])
+    results.put((name, int(first), [value.tolist() for value in final]))
+
+
+def run_training(certificate, nodes, timeout=120):
+    """
+    Run the nodes, each one in its own process, and collect their results
+
+    :param tuple certificate: certificate and private key of the TLS connections
+    :param list nodes: arguments and keyword arguments of run_node for every node, without the queue of the results
+                       and the certificate
+    :return: first step and final weights by name, and seconds the training took
+    :rtype: tuple(dict, float)
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = []
+    start = time.time()
+    for args, kwargs in nodes:
+        process = context.Process(target=run_node, args=(results, certificate) + tuple(args), kwargs=kwargs)
+        process.start()
+        processes.append(process)
+    collected = {}
+    try:
+        for _ in processes:
+            name, first, final = results.get(timeout=timeout)
+            collected[name] = (first, final)
+    finally:
+        for process in processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+    return collected, time.time() - start
+
+
+def assert_synchronized(collected, steps=STEPS):
+    for name, (_, (weights, bias)) in collected.items():
+        assert weights == pytest.approx([[float(steps)] * 3] * 4, abs=0.1), name
+        assert bias == pytest.approx([float(steps)] * 3, abs=0.1), name
+
+
+@pytest.mark.parametrize('options', [{}, {'flat': True}, {'quantization': 'int8'}])
+def test_star_round(certificate, options):
+    # the step of the rounds comes from a real global_step tensor
+    address = '127.0.0.1:{}'.format(free_port())
+    workers = ['worker1', 'worker2']
+    nodes = [(('chief', True, address, workers, 0.0, dict(options)), {})]
+    nodes += [((name, False, address, workers, 10.0 * (i + 1), dict(options)), {}) for i, name in enumerate(workers)]
+    collected, _ = run_training(certificate, nodes)
+    assert sorted(collected) == ['chief', 'worker1', 'worker2']
+    assert all(first == 0 for first, _ in collected.values())
+    assert_synchronized(collected)
+
+
+def test_worker_joins_mid_run(certificate):
+    # the chief starts with a quorum of one worker and the second one joins half way through the training
+    steps = 20
+    address = '127.0.0.1:{}'.format(free_port())
+    workers = ['worker1', 'worker2']
+    context = multiprocessing.get_context('spawn')
+    progress = context.Event()
+    options = {'quorum': 1}
+    nodes = [(('chief', True, address, workers, 0.0, dict(options)),
+              {'steps': steps, 'step_seconds': 0.25, 'progress': progress}),
+             (('worker1', False, address, workers, 10.0, dict(options)), {'steps': steps, 'step_seconds': 0.25}),
+             (('worker2', False, address, workers, 20.0, dict(options)), {'steps': steps, 'wait_for': progress})]
+    collected, seconds = run_training(certificate, nodes)
+    assert sorted(collected) == ['chief', 'worker1', 'worker2']
+    # the joiner starts from the step of the chief instead of 0
+    assert collected['worker2'][0] > 0
+    assert_synchronized(collected, steps)
+    # no round waits for the message of a worker that will never send it
+    assert seconds < ROUND_TIMEOUT
@@ -0,0 +1,43 @@
+import socket
+import pytest
+from layers.communication.framing import FRAME_HEADER, FrameTooLarge, recv_frame, recv_into_exactly, send_frame
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_frame_round_trip(pair):
+    left, right = pair
+    assert send_frame(left, b'signature', memoryview(b'payload'), b'') == 16
+    assert recv_frame(right) == bytearray(b'signaturepayload')
+
+
+def test_empty_frame(pair):
+    left, right = pair
+    send_frame(left)
+    assert recv_frame(right) == bytearray()
+
+
+def test_frame_longer_than_the_maximum_is_refused(pair):
+    left, right = pair
+    # only the header is sent, the body is never allocated
+    left.sendall(FRAME_HEADER.pack(2 ** 62))
+    with pytest.raises(FrameTooLarge):
+        recv_frame(right)
+    send_frame(left, b'x' * 100)
+    with pytest.raises(FrameTooLarge):
+        recv_frame(right, max_size=10)
+
+
+def test_connection_closed(pair):
+    left, right = pair
+    left.sendall(FRAME_HEADER.pack(10) + b'abc')
+    left.close()
+    with pytest.raises(ConnectionResetError):
+        recv_frame(right)
+    assert not recv_into_exactly(right, memoryview(bytearray(1)))
@@ -0,0 +1,93 @@
+import struct
+import numpy as np
+import pytest
+from layers.communication.integrity import (INTEGRITY_CONF, IntegrityError, SegmentVerifier, repair_message,
+                                            tag_table)
+
+KEY = b'shared key'
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(INTEGRITY_CONF, 'segment_size', 1000)
+
+
+def message(size=4500):
+    return [b'header', np.arange(size, dtype=np.uint8)]
+
+
+def receive(table, parts, chunk=None, corrupt=()):
+    """
+    Buffer of the message with its table in front, fed to a verifier as it arrives in chunks
+    """
+    buffer = bytearray(table + b''.join(memoryview(part).cast('B') for part in parts))
+    for position in corrupt:
+        buffer[len(table) + position] ^= 0xff
+    verifier = SegmentVerifier(KEY)
+    chunk = chunk or len(buffer)
+    for start in range(0, len(buffer), chunk):
+        verifier.update(buffer, start, min(start + chunk, len(buffer)))
+    return verifier, buffer
+
+
+@pytest.mark.parametrize('chunk', [None, 1, 333, 1000])
+def test_valid_message(chunk):
+    parts = message()
+    verifier, buffer = receive(tag_table(parts, KEY), parts, chunk)
+    assert verifier.valid and verifier.complete and verifier.bad == []
+    assert bytes(verifier.payload(buffer)) == b''.join(bytes(memoryview(part).cast('B')) for part in parts)
+
+
+def test_corrupted_segments_are_repaired():
+    parts = message()
+    table = tag_table(parts, KEY)
+    verifier, buffer = receive(table, parts, corrupt=[10, 2500, 2600])
+    assert verifier.valid and verifier.bad == [0, 2]
+    repair = b''.join(memoryview(part).cast('B') for part in repair_message(table, parts, verifier.bad))
+    verifier.repair(buffer, repair)
+    assert verifier.bad == []
+    assert bytes(verifier.payload(buffer)) == b''.join(bytes(memoryview(part).cast('B')) for part in parts)
+
+
+def test_repair_of_another_message_is_ignored():
+    parts = message()
+    verifier, buffer = receive(tag_table(parts, KEY), parts, corrupt=[10])
+    other = tag_table(parts, KEY)
+    verifier.repair(buffer, b''.join(memoryview(part).cast('B') for part in repair_message(other, parts, [0])))
+    assert verifier.bad == [0]
+
+
+def test_malformed_repair_is_refused():
+    parts = message()
+    table = tag_table(parts, KEY)
+    verifier, buffer = receive(table, parts, corrupt=[10])
+    repair = b''.join(memoryview(part).cast('B') for part in repair_message(table, parts, verifier.bad))
+    nonce = verifier.nonce
+    for malformed in [repair[:10], b'XXXX' + repair[4:], struct.pack('!4sQI', b'BFIX', nonce, 1000) + bytes(8),
+                      struct.pack('!4sQII', b'BFIX', nonce, 1, 5) + bytes(1000)]:
+        with pytest.raises(IntegrityError):
+            verifier.repair(buffer, malformed)
+    assert verifier.bad == [0]
+
+
+def test_wrong_key():
+    parts = message()
+    verifier, _ = receive(tag_table(parts, b'other key'), parts)
+    assert verifier.valid is False
+
+
+@pytest.mark.parametrize('table', [b'', b'garbage' * 10])
+def test_message_without_a_valid_table(table):
+    verifier, _ = receive(table, message())
+    assert not verifier.valid and not verifier.complete
+
+
+def test_message_longer_than_its_table():
+    parts = message()
+    verifier, _ = receive(tag_table(parts, KEY), parts + [b'extra'])
+    assert verifier.valid is False
+
+
+def test_empty_message():
+    verifier, _ = receive(tag_table([], KEY), [])
+    assert verifier.valid and verifier.complete
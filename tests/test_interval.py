@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from layers.communication.interval import AdaptiveInterval, relative_divergence
+
+
+def test_relative_divergence():
+    averaged = [np.array([3.0, 0.0]), np.array([4.0])]
+    assert relative_divergence(averaged, averaged) == 0.0
+    assert relative_divergence([np.array([3.0, 0.5]), np.array([4.0])], averaged) == pytest.approx(0.1)
+    assert relative_divergence([np.ones(2)], [np.zeros(2)]) == 0.0
+
+
+def test_close_models_widen_the_interval():
+    interval = AdaptiveInterval(10, min_steps=1, max_steps=1000)
+    assert interval.update(divergence=1e-4, communication=2.0, computation=8.0) == 20
+
+
+def test_diverging_models_narrow_the_interval():
+    interval = AdaptiveInterval(10, min_steps=1, max_steps=1000)
+    assert interval.update(divergence=0.5, communication=100.0, computation=1.0) == 5
+
+
+def test_slow_communication_widens_the_interval():
+    interval = AdaptiveInterval(10, min_steps=1, max_steps=1000)
+    assert interval.update(divergence=5e-3, communication=1.0, computation=10.0) == 10
+    assert interval.update(divergence=None, communication=6.0, computation=10.0) == 20
+    assert interval.last_ratio == pytest.approx(0.6)
+
+
+def test_limits():
+    interval = AdaptiveInterval(10, min_steps=4, max_steps=16)
+    assert interval.update(1e-5, 0.0, 1.0) == 16
+    assert interval.update(1e-5, 0.0, 1.0) == 16
+    for _ in range(4):
+        interval.update(1.0, 0.0, 1.0)
+    assert interval.steps == 4
+    assert AdaptiveInterval(100, min_steps=1, max_steps=50).steps == 50
+    with pytest.raises(ValueError):
+        AdaptiveInterval(10, min_steps=0)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from layers.communication.layout import LAYOUT_CONF, Layout
+
+
+def test_offsets_and_sizes():
+    layout = Layout([(3, 3), (5,), [2, 1, 2]])
+    assert layout.sizes == [9, 5, 4]
+    assert layout.offsets == [0, 9, 14, 18]
+    assert layout.size == 18
+
+
+def test_flatten_and_unflatten():
+    layout = Layout([(3, 3), (5,), ()])
+    arrays = [np.arange(9).reshape(3, 3), np.ones(5, dtype=np.float64), np.array(7.0)]
+    flat = layout.flatten(arrays)
+    assert flat.dtype == LAYOUT_CONF.dtype and flat.shape == (15,)
+    restored = layout.unflatten([flat])
+    assert [array.shape for array in restored] == [(3, 3), (5,), ()]
+    assert all(np.array_equal(a, b) for a, b in zip(restored, arrays))
+    # the arrays are views of the vector
+    assert all(np.shares_memory(array, flat) for array in restored)
+
+
+def test_flat_vectors_are_not_copied():
+    layout = Layout([(2, 2), (2,)])
+    flat = np.arange(6, dtype=LAYOUT_CONF.dtype)
+    assert layout.is_flat([flat])
+    assert layout.flatten([flat]) is flat
+    arrays = [np.zeros((2, 2)), np.zeros(2)]
+    assert not layout.is_flat(arrays)
+    assert layout.unflatten(arrays) is arrays
+
+
+def test_wrong_number_of_values():
+    layout = Layout([(2, 2), (2,)])
+    with pytest.raises(ValueError):
+        layout.flatten([np.zeros((2, 2))])
+    with pytest.raises(ValueError):
+        layout.unflatten([np.zeros(5)])
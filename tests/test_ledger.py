@@ -0,0 +1,111 @@
+import threading
+import pytest
+
+pytest.importorskip('iroha')
+from layers.communication import ledger
+from layers.communication.ledger import LEDGER_CONF, LedgerJournal
+
+
+@pytest.fixture
+def transactions(monkeypatch):
+    """
+    Details written in a fake BSMD, one list per transaction
+    """
+    written = []
+    failures = []
+
+    def set_details_to_nodes(sender, private_key, details, domain, ip):
+        if failures:
+            failures.pop()
+            raise ConnectionError('the node is not reachable')
+        written.append(list(details))
+
+    monkeypatch.setattr(ledger, 'set_details_to_nodes', set_details_to_nodes)
+    monkeypatch.setattr(LEDGER_CONF, 'flush_interval', 0.05)
+    monkeypatch.setattr(LEDGER_CONF, 'retry_delay', 0.01)
+    return written, failures
+
+
+@pytest.fixture
+def journal(transactions):
+    journal = LedgerJournal('worker1', 'key', 'federated', 'ip')
+    yield journal
+    journal.close(10)
+
+
+def test_records_are_written_in_the_background(transactions, journal):
+    written, _ = transactions
+    journal.record(1, ['chief', 'worker2'], 'worker1_weight', 'transaction')
+    assert journal.flush(10)
+    assert written == [[('chief', 'worker1_weight', 'transaction'), ('worker2', 'worker1_weight', 'transaction')]]
+    assert journal.queue_depth() == 0
+    assert journal.statistics['committed'] == 2 and journal.statistics['transactions'] == 1
+
+
+def test_records_are_packed_in_transactions(transactions, journal, monkeypatch):
+    written, _ = transactions
+    monkeypatch.setattr(LEDGER_CONF, 'batch_size', 3)
+    for iteration in range(4):
+        journal.record(iteration, ['chief', 'worker2'], 'worker1_weight', str(iteration))
+    assert journal.flush(10)
+    assert sum(len(details) for details in written) == 8
+    assert all(len(details) <= 3 for details in written)
+
+
+def test_duplicated_records(transactions, journal):
+    written, _ = transactions
+    journal.record(1, ['chief'], 'worker1_weight', 'first')
+    journal.record(1, ['chief'], 'worker1_weight', 'second')
+    assert journal.flush(10)
+    # the record was already written
+    journal.record(1, ['chief'], 'worker1_weight', 'third')
+    assert journal.flush(10)
+    assert written == [[('chief', 'worker1_weight', 'first')]]
+    assert journal.statistics['duplicated'] == 2
+
+
+def test_failed_transactions_are_retried(transactions, journal):
+    written, failures = transactions
+    failures.extend([True, True])
+    journal.record(1, ['chief'], 'worker1_weight', 'transaction')
+    assert journal.flush(10)
+    assert written == [[('chief', 'worker1_weight', 'transaction')]]
+    assert journal.statistics['failures'] == 2 and journal.statistics['dropped'] == 0
+
+
+def test_records_are_dropped_after_the_last_attempt(transactions, journal, monkeypatch):
+    written, failures = transactions
+    monkeypatch.setattr(LEDGER_CONF, 'attempts', 2)
+    failures.extend([True, True])
+    journal.record(1, ['chief'], 'worker1_weight', 'transaction')
+    assert journal.flush(10)
+    assert written == []
+    assert journal.statistics['dropped'] == 1
+
+
+def test_close_writes_the_queued_records(transactions):
+    written, _ = transactions
+    journal = LedgerJournal('worker1', 'key', 'federated', 'ip')
+    journal.record(1, ['chief'], 'worker1_weight', 'transaction')
+    assert journal.close(10)
+    assert written == [[('chief', 'worker1_weight', 'transaction')]]
+
+
+def test_flush_timeout(monkeypatch, journal):
+    release = threading.Event()
+    monkeypatch.setattr(ledger, 'set_details_to_nodes', lambda *args: release.wait(10))
+    journal.record(1, ['chief'], 'worker1_weight', 'transaction')
+    assert not journal.flush(0.2)
+    assert journal.queue_depth() == 1
+    release.set()
+    assert journal.flush(10)
+
+
+def test_journals_by_node(transactions):
+    first = ledger.get_journal('worker1', 'key', 'federated', 'ip')
+    assert ledger.get_journal('worker1', 'key', 'federated', 'ip') is first
+    assert ledger.get_journal('worker2', 'key', 'federated', 'ip') is not first
+    first.record(1, ['chief'], 'worker1_weight', 'transaction')
+    ledger.flush_journals(10)
+    assert ledger.queue_depth() == 0
+    assert transactions[0] == [[('chief', 'worker1_weight', 'transaction')]]
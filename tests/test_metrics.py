@@ -0,0 +1,74 @@
+import json
+import urllib.request
+from layers.communication.metrics import RoundMetrics, exposition, measure, start_endpoint
+
+
+def test_round_record(tmp_path):
+    path = str(tmp_path / 'chief.jsonl')
+    metrics = RoundMetrics('chief', path)
+    metrics.add('aggregate', 0.5)
+    metrics.add('send', 0.25, peer='worker1')
+    metrics.add('write', 0.125, peer='worker1')
+    metrics.count('sent', 100, peer='worker1')
+    metrics.count('received', 40)
+    record = metrics.end_round(12, workers=2)
+    metrics.close()
+    assert record['iteration'] == 12 and record['workers'] == 2
+    assert record['phases']['aggregate'] == 0.5
+    assert record['bytes'] == {'sent': 100, 'received': 40}
+    peer = record['peers']['worker1']
+    assert peer['send'] == 0.25 and peer['write'] == 0.125
+    assert peer['message_sent'] == 100 and peer['message_received'] == 0
+    with open(path) as file:
+        assert json.loads(file.readline()) == json.loads(json.dumps(record))
+    # the next round starts from zero
+    assert metrics.end_round(14)['bytes'] == {'sent': 0, 'received': 0}
+    assert metrics.totals['aggregate'] == 0.5 and metrics.rounds == 2
+
+
+def test_measure_without_metrics():
+    with measure(None, 'send', 'worker1'):
+        pass
+
+
+def test_timer_and_call():
+    metrics = RoundMetrics('worker1')
+    with metrics.timer('serialize'):
+        pass
+    assert metrics.call('send', 'chief', lambda a, b: a + b, 1, 2) == 3
+    record = metrics.end_round(1)
+    assert record['phases']['serialize'] >= 0 and 'chief' in record['peers']
+
+
+def test_rotation(tmp_path):
+    path = str(tmp_path / 'node.jsonl')
+    metrics = RoundMetrics('node', path, max_bytes=300, backups=2)
+    for iteration in range(20):
+        metrics.end_round(iteration)
+    metrics.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['node.jsonl', 'node.jsonl.1', 'node.jsonl.2']
+
+
+def test_exposition():
+    metrics = RoundMetrics('node "a"')
+    metrics.add('write', 1.0, peer='worker1')
+    metrics.count('sent', 10, peer='worker1')
+    metrics.end_round(3)
+    text = exposition()
+    assert '# TYPE bsmd_rounds_total counter' in text
+    assert 'bsmd_rounds_total{node="node \\"a\\""} 1' in text
+    assert 'bsmd_peer_seconds_total{node="node \\"a\\"",peer="worker1",phase="write"} 1.0' in text
+    assert 'bsmd_peer_message_bytes_total{node="node \\"a\\"",peer="worker1",direction="sent"} 10' in text
+    assert 'bsmd_last_round_iteration{node="node \\"a\\""} 3' in text
+
+
+def test_endpoint():
+    metrics = RoundMetrics('endpoint')
+    metrics.end_round(1)
+    server = start_endpoint(0, '127.0.0.1')
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert 'bsmd_rounds_total{node="endpoint"} 1' in response.read().decode('utf-8')
+    finally:
+        server.shutdown()
@@ -0,0 +1,277 @@
+import gc
+import queue
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+from layers.communication import mux
+from layers.communication.compression import AdaptiveCompressor, compress
+from layers.communication.framing import FrameTooLarge
+from layers.communication.mux import (MUX_CONF, MultiplexedConnection, MultiplexedListener, StreamClosed,
+                                      get_connection, receive_budget_used)
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    server = MultiplexedConnection(left, True)
+    client = MultiplexedConnection(right, False)
+    yield server, client
+    client.close()
+    server.close()
+
+
+def test_messages_are_delivered_complete_and_in_order(pair):
+    server, client = pair
+    stream = client.open_stream('job1/weights', MUX_CONF.priority_bulk)
+    accepted = server.accept_stream(5)
+    assert accepted.label == 'job1/weights' and accepted.priority == MUX_CONF.priority_bulk
+    payload = np.arange(200000, dtype=np.float32)
+    stream.send([b'header', payload])
+    stream.send(b'')
+    stream.send(b'last')
+    assert bytes(accepted.recv(5)) == b'header' + payload.tobytes()
+    assert bytes(accepted.recv(5)) == b''
+    assert bytes(accepted.recv(5)) == b'last'
+    assert server.bytes_received == client.bytes_sent
+
+
+def test_streams_in_both_directions(pair):
+    server, client = pair
+    up = client.open_stream('up')
+    down = server.open_stream('down')
+    assert server.accept_stream(5).label == 'up'
+    client_side = client.accept_stream(5)
+    down.send(b'from the server')
+    up.send(b'from the client')
+    assert bytes(client_side.recv(5)) == b'from the server'
+
+
+def test_control_overtakes_bulk(pair):
+    server, client = pair
+    bulk = client.open_stream('bulk', MUX_CONF.priority_bulk)
+    control = client.open_stream('control', MUX_CONF.priority_control)
+    streams = dict((stream.label, stream) for stream in [server.accept_stream(5), server.accept_stream(5)])
+    bulk.send(bytes(64 * MUX_CONF.chunk_size), wait=False)
+    control.send(b'stop')
+    assert bytes(streams['control'].recv(5)) == b'stop'
+    assert len(streams['bulk'].recv(5)) == 64 * MUX_CONF.chunk_size
+
+
+def test_close_stream(pair):
+    server, client = pair
+    stream = client.open_stream('job')
+    accepted = server.accept_stream(5)
+    stream.close()
+    with pytest.raises(StreamClosed):
+        accepted.recv(5)
+    with pytest.raises(StreamClosed):
+        stream.send(b'late')
+    with pytest.raises(socket.timeout):
+        server.accept_stream(0.1)
+
+
+class Inspector:
+    def __init__(self):
+        self.received = 0
+
+    def update(self, buffer, start, end):
+        self.received = end
+
+
+def test_compressed_messages(monkeypatch):
+    # compression pays off on any link
+    monkeypatch.setattr(AdaptiveCompressor, 'choose', lambda self, data, size=None: 'zlib')
+    left, right = socket.socketpair()
+    connections = queue.Queue()
+    thread = threading.Thread(target=lambda: connections.put(MultiplexedConnection(left, True, compression=True)))
+    thread.start()
+    client = MultiplexedConnection(right, False, compression=True)
+    thread.join(5)
+    server = connections.get(timeout=5)
+    try:
+        stream = client.open_stream('weights')
+        accepted = server.accept_stream(5)
+        payload = bytes(10 * MUX_CONF.chunk_size)
+        stream.send(payload)
+        assert bytes(accepted.recv(5)) == payload
+        assert client.bytes_sent < len(payload)
+        # the messages of a stream that is not compressed are inspected while they arrive
+        plain = client.open_stream('tagged')
+        plain.compressed = False
+        accepted = server.accept_stream(5)
+        accepted.inspector = Inspector
+        plain.send(payload)
+        assert bytes(accepted.recv(5)) == payload
+        assert accepted.inspection.received == len(payload)
+    finally:
+        client.close()
+        server.close()
+
+
+def test_bombs_and_unauthenticated_peers_are_disconnected(monkeypatch):
+    monkeypatch.setattr(MUX_CONF, 'max_message_size', 1024 * 1024)
+    for authenticated in [True, False]:
+        left, right = socket.socketpair()
+        connections = queue.Queue()
+        thread = threading.Thread(target=lambda: connections.put(
+            MultiplexedConnection(left, True, compression=True, authenticated=authenticated)))
+        thread.start()
+        client = MultiplexedConnection(right, False, compression=True)
+        thread.join(5)
+        server = connections.get(timeout=5)
+        try:
+            client.compressor = None
+            stream = client.open_stream('weights')
+            accepted = server.accept_stream(5)
+            # it inflates to more than the largest message, or it is compressed and the peer is not authenticated
+            payload = compress(bytes(16 * 1024 * 1024 if authenticated else 1024), 'zlib')
+            stream.send(payload)
+            with pytest.raises(StreamClosed):
+                accepted.recv(5)
+            assert server.closed
+        finally:
+            client.close()
+            server.close()
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    """
+    Receive budget of four chunks, besides the buffers of earlier tests that are still alive
+    """
+    gc.collect()
+    used = receive_budget_used()
+    monkeypatch.setattr(MUX_CONF, 'receive_budget', used + 4 * MUX_CONF.chunk_size)
+    return used
+
+
+def test_receive_budget(pair, budget):
+    server, client = pair
+    stream = client.open_stream('weights')
+    accepted = server.accept_stream(5)
+    stream.send(bytes(3 * MUX_CONF.chunk_size))
+    message = accepted.recv(5)
+    assert receive_budget_used() == budget + len(message)
+    message = None
+    deadline = time.time() + 5
+    while receive_budget_used() > budget and time.time() < deadline:
+        time.sleep(0.01)
+    assert receive_budget_used() == budget
+
+
+def test_control_messages_flow_while_the_budget_is_used_up(pair, budget):
+    server, client = pair
+    bulk = client.open_stream('weights', MUX_CONF.priority_bulk)
+    control = client.open_stream('control', MUX_CONF.priority_control)
+    streams = dict((stream.label, stream) for stream in [server.accept_stream(5), server.accept_stream(5)])
+    bulk.send(bytes(3 * MUX_CONF.chunk_size))
+    held = streams['weights'].recv(5)
+    # the second message does not fit in the budget while the first is held, the one after it waits for it
+    bulk.send(np.ones(3 * MUX_CONF.chunk_size, dtype=np.uint8), wait=False)
+    bulk.send(b'after', wait=False)
+    for _ in range(3):
+        control.send(b'ping')
+        assert bytes(streams['control'].recv(5)) == b'ping'
+    with pytest.raises(socket.timeout):
+        streams['weights'].recv(0.5)
+    assert not server.closed and receive_budget_used() == budget + len(held)
+    held = None
+    assert bytes(streams['weights'].recv(5)) == bytes(np.ones(3 * MUX_CONF.chunk_size, dtype=np.uint8))
+    assert bytes(streams['weights'].recv(5)) == b'after'
+
+
+def test_message_larger_than_the_maximum_closes_the_connection(monkeypatch):
+    left, right = socket.socketpair()
+    server = MultiplexedConnection(left, True)
+    monkeypatch.setattr(MUX_CONF, 'max_message_size', 1024)
+    try:
+        with pytest.raises(FrameTooLarge):
+            server.allocate(1025)
+        # a peer announcing a huge message without sending it
+        right.sendall(mux._HEADER.pack(1, mux._FLAG_OPEN, 2, 0) + bytes([4]) + b'x')
+        right.sendall(mux._HEADER.pack(1, mux._FLAG_START, 16, 2 ** 62) + bytes(16))
+        deadline = time.time() + 5
+        while not server.closed and time.time() < deadline:
+            time.sleep(0.01)
+        assert server.closed
+    finally:
+        server.close()
+        right.close()
+
+
+def test_chunk_beyond_the_message_closes_the_connection():
+    left, right = socket.socketpair()
+    server = MultiplexedConnection(left, True)
+    try:
+        right.sendall(mux._HEADER.pack(1, mux._FLAG_OPEN, 2, 0) + bytes([4]) + b'x')
+        right.sendall(mux._HEADER.pack(1, mux._FLAG_START, 64, 8) + bytes(64))
+        deadline = time.time() + 5
+        while not server.closed and time.time() < deadline:
+            time.sleep(0.01)
+        assert server.closed
+    finally:
+        server.close()
+        right.close()
+
+
+def test_listener_and_shared_connections():
+    received = queue.Queue()
+    listener = MultiplexedListener('127.0.0.1', 0, lambda stream: received.put((stream.label, bytes(stream.recv(5)))))
+    listener.start()
+    listener.wait_listening()
+    try:
+        connection = get_connection('127.0.0.1', listener.port)
+        assert get_connection('127.0.0.1', listener.port) is connection
+        connection.open_stream('job1').send(b'one')
+        connection.open_stream('job2').send(b'two')
+        assert sorted([received.get(timeout=5), received.get(timeout=5)]) == [('job1', b'one'), ('job2', b'two')]
+        connection.close()
+    finally:
+        listener.stop()
+
+
+def test_shared_connections_resume_the_tls_session(tls):
+    from layers.communication.tls import tls_statistics
+
+    def echo(stream):
+        stream.send(stream.recv(5))
+
+    listener = MultiplexedListener('127.0.0.1', 0, echo, tls=True)
+    listener.start()
+    listener.wait_listening()
+    before = tls_statistics()
+    try:
+        for _ in range(3):
+            connection = get_connection('127.0.0.1', listener.port, tls=True)
+            stream = connection.open_stream('job')
+            stream.send(b'ping')
+            assert bytes(stream.recv(5)) == b'ping'
+            connection.close()
+    finally:
+        listener.stop()
+    after = tls_statistics()
+    assert after['client']['handshakes'] - before['client']['handshakes'] == 3
+    assert after['client']['resumed'] - before['client']['resumed'] == 2
+
+
+def test_listener_reports_a_port_in_use():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        listener = MultiplexedListener('127.0.0.1', sock.getsockname()[1], lambda stream: None)
+        listener.start()
+        with pytest.raises(OSError):
+            listener.wait_listening(5)
+
+
+def test_socket_is_closed_once_the_reader_and_the_writer_end(pair):
+    server, client = pair
+    client.open_stream('job').send(b'message')
+    client.close()
+    deadline = time.time() + 5
+    while (client._sock.fileno() != -1 or server._sock.fileno() != -1) and time.time() < deadline:
+        time.sleep(0.01)
+    assert client._sock.fileno() == -1 and server._sock.fileno() == -1
+    assert server.closed
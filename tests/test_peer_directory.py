@@ -0,0 +1,86 @@
+import json
+import time
+import pytest
+
+pytest.importorskip('iroha')
+from layers.communication import peer_directory
+from layers.communication.peer_directory import PeerDirectory, format_endpoint, parse_endpoint
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """
+    Endpoints published in a fake BSMD, and the queries sent to it
+    """
+    endpoints = {'chief@federated': '10.0.0.1:7777', 'worker1@other': '10.0.0.2:5555'}
+    sent = []
+
+    def get_a_detail_from_node(name, node, private_key, detail_key, domain, ip, node_domain=None):
+        sent.append((name + '@' + domain, node + '@' + (node_domain or domain)))
+        node_id = node + '@' + (node_domain or domain)
+        if node_id not in endpoints:
+            return '{}'
+        return json.dumps({node_id: {detail_key: endpoints[node_id]}})
+
+    monkeypatch.setattr(peer_directory, 'get_a_detail_from_node', get_a_detail_from_node)
+    return endpoints, sent
+
+
+def test_endpoint_format():
+    assert parse_endpoint(format_endpoint('10.0.0.1', '7777')) == ('10.0.0.1', 7777)
+    assert parse_endpoint('[::1]:80') == ('[::1]', 80)
+
+
+def test_resolve_is_cached(queries):
+    _, sent = queries
+    directory = PeerDirectory('worker2', 'key', 'federated', 'ip', refresh_interval=0)
+    assert directory.resolve('chief') == ('10.0.0.1', 7777)
+    assert directory.resolve_address('chief@federated') == '10.0.0.1:7777'
+    assert len(sent) == 1
+    directory.invalidate('chief')
+    directory.resolve('chief')
+    assert len(sent) == 2
+
+
+def test_queries_are_signed_by_the_own_account(queries):
+    _, sent = queries
+    directory = PeerDirectory('worker2', 'key', 'federated', 'ip', refresh_interval=0)
+    assert directory.resolve('worker1@other') == ('10.0.0.2', 5555)
+    assert sent == [('worker2@federated', 'worker1@other')]
+
+
+def test_missing_endpoints(queries):
+    directory = PeerDirectory('worker2', 'key', 'federated', 'ip', refresh_interval=0)
+    with pytest.raises(LookupError):
+        directory.resolve('worker9')
+    assert directory.prefetch(['chief', 'worker9']) == ['worker9']
+
+
+def test_refresh_only_consults_the_expired_entries(queries):
+    endpoints, sent = queries
+    directory = PeerDirectory('worker2', 'key', 'federated', 'ip', ttl=0.2, refresh_interval=0)
+    directory.prefetch(['chief', 'worker1@other'])
+    assert directory.refresh() == 0
+    time.sleep(0.25)
+    endpoints['chief@federated'] = '10.0.0.3:7777'
+    assert directory.refresh(max_queries=1) == 1
+    assert directory.refresh() == 1
+    assert len(sent) == 4
+    assert directory.resolve('chief') == ('10.0.0.3', 7777)
+    assert len(sent) == 4
+
+
+def test_background_refresh(queries):
+    endpoints, sent = queries
+    directory = PeerDirectory('worker2', 'key', 'federated', 'ip', ttl=0.3, refresh_interval=0.1)
+    try:
+        directory.resolve('chief')
+        endpoints['chief@federated'] = '10.0.0.3:7777'
+        deadline = time.time() + 5
+        while len(sent) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        # the entry was refreshed before it expired, resolving it does not wait for the BSMD
+        with directory._lock:
+            assert directory._cache['chief@federated'][0] == ('10.0.0.3', 7777)
+    finally:
+        directory.close()
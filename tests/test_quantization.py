@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from layers.communication.layout import Layout
+from layers.communication.quantization import QUANTIZATION_MODES, Quantizer, dequantize
+
+
+def weights(seed=0):
+    random = np.random.RandomState(seed)
+    return [random.normal(size=(20, 10)).astype(np.float32), random.normal(scale=1e-3, size=30).astype(np.float32)]
+
+
+@pytest.mark.parametrize('mode', QUANTIZATION_MODES)
+def test_round_trip(mode):
+    original = weights()
+    arrays, description = Quantizer(mode, seed=1).quantize(original)
+    restored = dequantize(arrays, description)
+    assert description['mode'] == mode
+    for weight, value in zip(original, restored):
+        assert value.shape == weight.shape and value.dtype == weight.dtype
+        # a level of the 8-bit modes is (maximum - minimum) / 255
+        assert np.max(np.abs(value - weight)) <= (weight.max() - weight.min()) / 255 * 1.01
+
+
+def test_sizes_of_the_modes():
+    original = weights()
+    assert Quantizer('float16').quantize(original)[0][0].dtype == np.float16
+    assert Quantizer('int8').quantize(original)[0][0].dtype == np.uint8
+
+
+def test_integer_and_empty_tensors_are_sent_as_they_are():
+    original = [np.arange(5), np.zeros(0, dtype=np.float32)]
+    arrays, description = Quantizer('int8').quantize(original)
+    assert np.array_equal(arrays[0], original[0])
+    assert [value.tolist() for value in dequantize(arrays, description)] == [[0, 1, 2, 3, 4], []]
+
+
+def test_constant_tensor():
+    arrays, description = Quantizer('int8').quantize([np.full(10, 3.5, dtype=np.float32)])
+    assert np.allclose(dequantize(arrays, description)[0], 3.5)
+
+
+def test_error_feedback_does_not_accumulate():
+    quantizer = Quantizer('int8')
+    original = weights()
+    sent = [np.zeros_like(weight) for weight in original]
+    rounds = 20
+    for _ in range(rounds):
+        arrays, description = quantizer.quantize(original)
+        sent = [total + value for total, value in zip(sent, dequantize(arrays, description))]
+    # the residuals are sent in the next rounds, the mean of what was sent converges to the weights
+    for weight, total in zip(original, sent):
+        level = (weight.max() - weight.min()) / 255
+        assert np.max(np.abs(total / rounds - weight)) < level / 2
+
+
+def test_stochastic_rounding_is_unbiased():
+    value = np.full(100000, 0.3, dtype=np.float32)
+    # the extremes fix the levels, the rest of the values fall between two of them
+    value[0], value[1] = 0.0, 255.0
+    arrays, description = Quantizer('stochastic', error_feedback=False, seed=3).quantize([value])
+    assert abs(float(dequantize(arrays, description)[0][2:].mean()) - 0.3) < 0.01
+
+
+def test_flat_vector_is_quantized_by_segments():
+    original = weights()
+    layout = Layout([weight.shape for weight in original])
+    flat = layout.flatten(original)
+    quantizer = Quantizer('int8', error_feedback=False)
+    quantizer.segments = layout.sizes
+    arrays, description = quantizer.quantize([flat])
+    assert description['tensors'][0]['segments'] == layout.sizes
+    restored = layout.unflatten(dequantize(arrays, description))
+    # the small variable keeps its own scale instead of the one of the whole model
+    small = original[1]
+    assert np.max(np.abs(restored[1] - small)) <= (small.max() - small.min()) / 255 * 0.51
+    whole = Quantizer('int8', error_feedback=False)
+    arrays, description = whole.quantize([flat])
+    assert np.max(np.abs(layout.unflatten(dequantize(arrays, description))[1] - small)) > \
+        np.max(np.abs(restored[1] - small))
+
+
+def test_segments_with_an_empty_variable():
+    layout = Layout([(3,), (0,), (2,)])
+    flat = layout.flatten([np.array([1, 2, 3], np.float32), np.zeros(0, np.float32), np.array([-5, 5], np.float32)])
+    quantizer = Quantizer('int8')
+    quantizer.segments = layout.sizes
+    arrays, description = quantizer.quantize([flat])
+    assert np.allclose(dequantize(arrays, description)[0], flat, atol=0.05)
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        Quantizer('int4')
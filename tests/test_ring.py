@@ -0,0 +1,105 @@
+import queue
+import threading
+import numpy as np
+import pytest
+from layers.communication.ring import RingAllReduce
+
+
+def run_ring(all_weights, send_hook=None, timeout=10):
+    """
+    All-reduce the weights of every node in its own thread, the chunks go through queues
+
+    :param list all_weights: weights of every node
+    :param send_hook: function called with the rank, chunk and step of every chunk sent
+    :param float timeout: seconds a node waits for a chunk
+    :return: averaged weights of every node, or the exception it raised
+    :rtype: list
+    """
+    size = len(all_weights)
+    inboxes = [queue.Queue() for _ in range(size)]
+    results = [None] * size
+
+    def node(rank):
+        ring = RingAllReduce(rank, size)
+
+        def send(chunk, step):
+            if send_hook is not None:
+                chunk = send_hook(rank, chunk, step)
+            inboxes[(rank + 1) % size].put((step, np.array(chunk, copy=True)))
+
+        def receive(step):
+            received_step, chunk = inboxes[rank].get(timeout=timeout)
+            assert received_step == step
+            return chunk
+
+        try:
+            results[rank] = ring.all_reduce(all_weights[rank], send, receive)
+        except Exception as error:
+            results[rank] = error
+        finally:
+            ring.close()
+
+    threads = [threading.Thread(target=node, args=(rank,)) for rank in range(size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    return results
+
+
+def weights(seed):
+    random = np.random.RandomState(seed)
+    return [random.normal(size=(7, 3)).astype(np.float32), random.normal(size=5).astype(np.float32)]
+
+
+@pytest.mark.parametrize('size', [2, 3, 5])
+def test_every_node_ends_with_the_average(size):
+    all_weights = [weights(rank) for rank in range(size)]
+    expected = [np.mean([node[i] for node in all_weights], axis=0) for i in range(2)]
+    for result in run_ring(all_weights):
+        assert [value.shape for value in result] == [(7, 3), (5,)]
+        assert all(value.dtype == np.float32 for value in result)
+        for value, average in zip(result, expected):
+            assert np.allclose(value, average, atol=1e-6)
+
+
+def test_traffic_of_a_node():
+    # every node sends 2 (N - 1) / N times the size of the model
+    size = 4
+    sent = [0] * size
+
+    def count(rank, chunk, step):
+        sent[rank] += chunk.size
+        return chunk
+
+    run_ring([weights(rank) for rank in range(size)], count)
+    # the model has 26 values, split into chunks of 6 or 7
+    assert sum(sent) == 2 * (size - 1) * 26
+    assert all(abs(value - 2 * (size - 1) * 26 / size) <= 2 for value in sent)
+
+
+def test_model_smaller_than_the_ring():
+    all_weights = [[np.full(2, float(rank))] for rank in range(4)]
+    for result in run_ring(all_weights):
+        assert np.allclose(result[0], 1.5)
+
+
+def test_single_node():
+    ring = RingAllReduce(0, 1)
+    original = weights(0)
+    result = ring.all_reduce(original, None, None)
+    assert all(np.array_equal(value, weight) for value, weight in zip(result, original))
+    ring.close()
+
+
+def test_rank_outside_the_ring():
+    with pytest.raises(ValueError):
+        RingAllReduce(3, 3)
+
+
+def test_chunk_of_the_wrong_size():
+    def truncate(rank, chunk, step):
+        return chunk[:-1] if rank == 0 and step == 0 else chunk
+
+    results = run_ring([weights(rank) for rank in range(3)], truncate, timeout=1)
+    assert isinstance(results[1], ValueError)
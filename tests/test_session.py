@@ -0,0 +1,144 @@
+import hmac
+import json
+import socket
+import time
+import pytest
+from layers.communication.compression import AdaptiveCompressor, compress
+from layers.communication.mux import MultiplexedConnection, MUX_CONF, StreamClosed
+from layers.communication.session import SESSION_CONF, SessionServer, WorkerSession, _sign_hello
+
+KEY = b'shared key'
+
+
+@pytest.fixture
+def server(tls):
+    server = SessionServer('127.0.0.1', 0, KEY)
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_session_round_trip(server):
+    worker = WorkerSession('127.0.0.1', server.port, 'worker1', KEY, info={'role': 'trainer'})
+    worker.connect()
+    chief_side = server.session('worker1', timeout=5)
+    assert chief_side is not None and chief_side.info == {'role': 'trainer'}
+    chief_side.send_control(b'1:2')
+    assert bytes(worker.recv_control(5)) == b'1:2'
+    worker.send(b'weights')
+    assert bytes(chief_side.recv(5)) == b'weights'
+    worker.close()
+
+
+def test_reconnect_replaces_the_session(server):
+    worker = WorkerSession('127.0.0.1', server.port, 'worker1', KEY)
+    worker.connect()
+    first = server.session('worker1', timeout=5)
+    worker.reconnect()
+    assert worker.reconnections == 1
+    deadline = time.time() + 5
+    while server.session('worker1') is first and time.time() < deadline:
+        time.sleep(0.05)
+    assert server.session('worker1') is not first
+    worker.close()
+
+
+def test_wrong_key_is_rejected(server):
+    worker = WorkerSession('127.0.0.1', server.port, 'intruder', b'other key')
+    with pytest.raises(ConnectionRefusedError):
+        worker.connect()
+    assert server.session('intruder') is None
+
+
+def send_hello(port, hello):
+    from layers.communication.tls import connect
+    connection = MultiplexedConnection(connect('127.0.0.1', port), server_side=False, compression=True)
+    control = connection.open_stream('control', MUX_CONF.priority_control)
+    connection.open_stream('weights', MUX_CONF.priority_bulk)
+    control.send(hello)
+    try:
+        return bytes(control.recv(5)) == SESSION_CONF.welcome
+    except Exception:
+        return False
+    finally:
+        connection.close()
+
+
+def test_old_hello_is_rejected(server):
+    hello = json.dumps({'name': 'worker1', 'time': time.time() - 2 * SESSION_CONF.hello_window, 'info': {}})
+    hello = hello.encode('utf-8')
+    assert not send_hello(server.port, hmac.new(KEY, hello, SESSION_CONF.hashfunction).digest() + hello)
+
+
+def test_replayed_hello_is_rejected(server):
+    hello = _sign_hello('worker1', KEY)
+    assert send_hello(server.port, hello)
+    assert not send_hello(server.port, hello)
+
+
+def test_compressed_message_before_the_hello_is_refused(server):
+    from layers.communication.tls import connect
+    connection = MultiplexedConnection(connect('127.0.0.1', server.port), server_side=False, compression=True)
+    # the bomb is sent as it is, the compressor of the connection would not compress it again
+    connection.compressor = None
+    control = connection.open_stream('control', MUX_CONF.priority_control)
+    connection.open_stream('weights', MUX_CONF.priority_bulk)
+    try:
+        control.send(compress(bytes(256 * 1024 * 1024), 'zlib'))
+        with pytest.raises(StreamClosed):
+            control.recv(10)
+    finally:
+        connection.close()
+    assert server.sessions() == []
+
+
+def test_start_raises_when_the_port_is_in_use(tls):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        server = SessionServer('127.0.0.1', sock.getsockname()[1], KEY)
+        with pytest.raises(OSError):
+            server.start()
+
+
+def test_reconnections_resume_the_tls_session(server):
+    from layers.communication.tls import tls_statistics
+    before = tls_statistics()
+    worker = WorkerSession('127.0.0.1', server.port, 'worker1', KEY)
+    worker.connect()
+    for _ in range(3):
+        worker.reconnect()
+    worker.close()
+    after = tls_statistics()
+    assert after['client']['handshakes'] - before['client']['handshakes'] == 4
+    assert after['client']['resumed'] - before['client']['resumed'] == 3
+    assert after['server']['resumed'] - before['server']['resumed'] == 3
+
+
+class Inspector:
+    def __init__(self):
+        self.received = 0
+
+    def update(self, buffer, start, end):
+        self.received = end
+
+
+def test_weights_are_inspected_while_they_arrive(tls, monkeypatch):
+    server = SessionServer('127.0.0.1', 0, KEY, inspector=Inspector)
+    server.start()
+    try:
+        worker = WorkerSession('127.0.0.1', server.port, 'worker1', KEY, inspector=Inspector)
+        worker.connect()
+        chief_side = server.session('worker1', timeout=5)
+        # the sessions compress their messages, whatever the link, but not the weights
+        monkeypatch.setattr(AdaptiveCompressor, 'choose', lambda self, data, size=None: 'zlib')
+        payload = bytes(4 * MUX_CONF.chunk_size)
+        worker.send(payload)
+        assert bytes(chief_side.recv(5)) == payload
+        assert chief_side.inspection.received == len(payload)
+        chief_side.send(payload)
+        assert bytes(worker.recv(5)) == payload
+        assert worker.inspection.received == len(payload)
+        worker.close()
+    finally:
+        server.stop()
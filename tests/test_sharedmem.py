@@ -0,0 +1,104 @@
+import multiprocessing
+import pytest
+from layers.communication import sharedmem
+from layers.communication.sharedmem import SHM_CONF, SharedChannel, colocated, is_descriptor, read
+
+if sharedmem.shared_memory is None:
+    pytest.skip('shared memory needs Python 3.8 or newer', allow_module_level=True)
+
+
+class Connection:
+    """
+    Connection with a peer, only what the channel needs of a MultiplexedConnection
+    """
+
+    def __init__(self, address=('127.0.0.1', 5000), local_address=('127.0.0.1', 6000)):
+        self.address = address
+        self.local_address = local_address
+
+    def allocate(self, size):
+        return memoryview(bytearray(size))
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    monkeypatch.setattr(SHM_CONF, 'min_size', 0)
+    channel = SharedChannel()
+    yield channel
+    channel.close()
+
+
+def test_colocated():
+    assert colocated(Connection())
+    assert colocated(Connection(('10.0.0.2', 5000), ('10.0.0.2', 6000)))
+    assert colocated(Connection(('::1', 5000), ('::1', 6000)))
+    assert not colocated(Connection(('10.0.0.3', 5000), ('10.0.0.2', 6000)))
+    assert not colocated(Connection(('10.0.0.3', 5000), None))
+    assert not colocated(None)
+
+
+def test_small_messages_go_through_the_session():
+    channel = SharedChannel()
+    assert not channel.accepts([b'x' * 100])
+    assert channel.accepts([bytearray(SHM_CONF.min_size)])
+    channel.close()
+
+
+def test_write_and_read(channel):
+    connection = Connection()
+    descriptor = channel.write([b'header', b'x' * 1000])
+    assert is_descriptor(descriptor)
+    assert not is_descriptor(b'header' + b'x' * 100)
+    assert bytes(read(descriptor, connection)) == b'header' + b'x' * 1000
+    # the next message reuses the segment
+    name = channel.segment.name
+    descriptor = channel.write([b'y' * 10])
+    assert channel.segment.name == name
+    assert bytes(read(descriptor, connection)) == b'y' * 10
+
+
+def test_segment_grows_with_the_messages(channel):
+    connection = Connection()
+    read(channel.write([b'x' * 10]), connection)
+    name = channel.segment.name
+    descriptor = channel.write([b'z' * 10000])
+    assert channel.segment.name != name and channel.segment.size >= 10000
+    assert bytes(read(descriptor, connection)) == b'z' * 10000
+
+
+def test_closed_channel(channel):
+    descriptor = channel.write([b'x' * 100])
+    channel.close()
+    assert not channel.accepts([b'x' * 100])
+    assert channel.write([b'x' * 100]) is None
+    # the receiver cannot open a removed segment and asks for the message again
+    with pytest.raises(OSError):
+        read(descriptor, Connection())
+
+
+def test_invalid_descriptor(channel):
+    descriptor = bytearray(channel.write([b'x' * 100]))
+    descriptor[:4] = b'XXXX'
+    with pytest.raises(ValueError):
+        read(descriptor, Connection())
+
+
+def receive_in_another_process(descriptor, results):
+    results.put(bytes(read(descriptor, Connection())))
+
+
+def test_read_from_another_process(channel):
+    message = bytes(range(256)) * 100
+    descriptor = channel.write([message])
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=receive_in_another_process, args=(descriptor, results))
+    process.start()
+    try:
+        assert results.get(timeout=60) == message
+    finally:
+        process.join(60)
+    assert process.exitcode == 0
+    # the segment still belongs to the sender after the receiver ended
+    descriptor = channel.write([b'again'])
+    assert bytes(read(descriptor, Connection())) == b'again'
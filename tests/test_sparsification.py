@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from layers.communication.sparsification import Sparsifier, densify
+
+
+def weights(seed=0):
+    random = np.random.RandomState(seed)
+    return [random.normal(size=(20, 10)).astype(np.float32), random.normal(size=50).astype(np.float32)]
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        Sparsifier('random')
+
+
+def test_topk_sends_the_largest_entries():
+    reference = [np.zeros((20, 10), dtype=np.float32), np.zeros(50, dtype=np.float32)]
+    update = weights()
+    sparsifier = Sparsifier('topk', ratio=0.1)
+    arrays, description = sparsifier.sparsify(update, reference)
+    assert description['tensors'] == [{'sparse': True}, {'sparse': True}]
+    indices, values = arrays[0], arrays[1]
+    assert len(indices) == 20 and indices.dtype == np.uint32
+    flat = update[0].reshape(-1)
+    assert np.min(np.abs(values)) >= np.sort(np.abs(flat))[-20]
+    assert np.array_equal(values, flat[indices])
+    assert sparsifier.last_density == pytest.approx(0.1, abs=0.01)
+
+
+def test_threshold_mode():
+    reference = [np.zeros(6, dtype=np.float32)]
+    update = [np.array([0.5, 1e-5, -2.0, 0.0, 1e-3, -1e-4], dtype=np.float32)]
+    arrays, _ = Sparsifier('threshold', threshold=1e-3).sparsify(update, reference)
+    assert arrays[0].tolist() == [0, 2, 4]
+
+
+def test_densify_restores_the_weights_sent():
+    reference = weights(1)
+    update = weights(2)
+    arrays, description = Sparsifier('topk', ratio=1.0).sparsify(update, reference)
+    restored = densify(arrays, description, reference)
+    for weight, value in zip(update, restored):
+        assert value.shape == weight.shape
+        assert np.allclose(value, weight, atol=1e-6)
+
+
+def test_residuals_are_sent_in_the_next_rounds():
+    # the sum of the restored updates converges to the total update, nothing is lost
+    reference = [np.zeros(100, dtype=np.float32)]
+    update = [np.random.RandomState(3).normal(size=100).astype(np.float32)]
+    sparsifier = Sparsifier('topk', ratio=0.1)
+    received = np.zeros(100, dtype=np.float32)
+    for round_ in range(10):
+        # the worker does not change its weights after the first round
+        arrays, description = sparsifier.sparsify(update if round_ == 0 else reference, reference)
+        received += densify(arrays, description, reference)[0]
+    assert np.allclose(received, update[0], atol=1e-6)
+
+
+def test_quantized_values():
+    reference = weights(1)
+    update = weights(2)
+    arrays, description = Sparsifier('topk', ratio=0.5, quantization='int8').sparsify(update, reference)
+    assert description['quantization']['mode'] == 'int8'
+    restored = densify(arrays, description, reference)
+    assert all(value.shape == weight.shape for value, weight in zip(restored, update))
+
+
+def test_integer_tensors_are_sent_as_they_are():
+    reference = [np.zeros(4, dtype=np.int64), np.zeros(3, dtype=np.float32)]
+    update = [np.arange(4), np.ones(3, dtype=np.float32)]
+    arrays, description = Sparsifier('topk', ratio=1.0).sparsify(update, reference)
+    assert description['tensors'][0] == {'sparse': False}
+    restored = densify(arrays, description, reference)
+    assert restored[0].tolist() == [0, 1, 2, 3] and restored[1].tolist() == [1, 1, 1]
+
+
+def test_malformed_messages():
+    reference = [np.zeros(4, dtype=np.float32)]
+    description = {'mode': 'topk', 'tensors': [{'sparse': True}]}
+    with pytest.raises(ValueError):
+        densify([np.array([7], dtype=np.uint32), np.ones(1, dtype=np.float32)], description, reference)
+    with pytest.raises(ValueError):
+        densify([np.array([1, 2], dtype=np.uint32), np.ones(1, dtype=np.float32)], description, reference)
+    with pytest.raises(ValueError):
+        densify([], {'mode': 'topk', 'tensors': []}, reference)
@@ -0,0 +1,84 @@
+import json
+import numpy as np
+import pytest
+from layers.communication.tensors import TENSOR_CONF, decode, encode, message_size
+
+
+def join(parts):
+    return b''.join(memoryview(part).cast('B') for part in parts)
+
+
+def test_round_trip():
+    arrays = [np.arange(12, dtype=np.float32).reshape(3, 4), np.array([1, 2, 3], dtype=np.int64),
+              np.zeros((0, 5), dtype=np.float64), np.array(2.5, dtype=np.float16)]
+    parts = encode(arrays, sender='worker1', iteration=4)
+    message = join(parts)
+    assert message_size(parts) == len(message)
+    metadata, decoded = decode(message)
+    assert metadata['sender'] == 'worker1' and metadata['iteration'] == 4
+    assert metadata['names'] == ['0', '1', '2', '3']
+    for array, value in zip(arrays, decoded):
+        assert value.dtype == array.dtype and value.shape == array.shape
+        assert np.array_equal(value, array)
+
+
+def test_names():
+    _, arrays = decode(join(encode([np.ones(2), np.zeros(3)], names=['weights', 'bias'])))
+    assert [array.size for array in arrays] == [2, 3]
+    assert decode(join(encode([np.ones(2)], names=['weights'])))[0]['names'] == ['weights']
+
+
+def test_arrays_are_not_copied():
+    array = np.arange(100, dtype=np.float32)
+    parts = encode([array])
+    assert any(np.shares_memory(np.frombuffer(part, dtype=np.uint8), array) for part in parts
+               if isinstance(part, np.ndarray))
+    message = bytearray(join(parts))
+    _, (decoded,) = decode(message)
+    assert np.shares_memory(decoded, np.frombuffer(message, dtype=np.uint8))
+
+
+def test_arrays_are_aligned():
+    message = bytearray(join(encode([np.ones(3, dtype=np.int8), np.ones(5, dtype=np.float64)])))
+    base = np.frombuffer(message, dtype=np.uint8).ctypes.data
+    _, arrays = decode(message)
+    assert all((array.ctypes.data - base) % TENSOR_CONF.alignment == 0 for array in arrays)
+
+
+def test_non_contiguous_arrays():
+    array = np.arange(20).reshape(4, 5)[:, 1:3]
+    _, (decoded,) = decode(join(encode([array])))
+    assert np.array_equal(decoded, array)
+
+
+def test_objects_are_refused():
+    with pytest.raises(TypeError):
+        encode([np.array([{}, None], dtype=object)])
+
+
+def tampered(change):
+    """
+    A message whose description was changed
+    """
+    message = join(encode([np.ones(4, dtype=np.float32)]))
+    length = int.from_bytes(message[5:9], 'big')
+    description = json.loads(message[9:9 + length].decode('utf-8'))
+    change(description)
+    description = json.dumps(description).encode('utf-8')
+    header = message[:5] + len(description).to_bytes(4, 'big')
+    # the arrays keep their position after the description
+    start = 9 + length
+    return header + description + message[start:]
+
+
+@pytest.mark.parametrize('message', [
+    b'',
+    b'XXXX' + bytes(20),
+    tampered(lambda description: description['tensors'][0].update(dtype='|O')),
+    tampered(lambda description: description['tensors'][0].update(shape=[4000])),
+    tampered(lambda description: description['tensors'][0].update(shape=[-4])),
+    tampered(lambda description: description['tensors'][0].pop('offset')),
+])
+def test_malformed_messages(message):
+    with pytest.raises(ValueError):
+        decode(message)
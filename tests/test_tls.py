@@ -0,0 +1,71 @@
+import socket
+import ssl
+import threading
+import pytest
+from layers.communication.tls import connect, release, tls_statistics, wrap_server_socket
+
+
+@pytest.fixture
+def echo(tls):
+    """
+    TLS server on the loopback that answers every connection with the byte it receives
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(10)
+    sock.settimeout(0.2)
+    stopped = threading.Event()
+
+    def serve():
+        while not stopped.is_set():
+            try:
+                connection, _ = sock.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(5)
+            try:
+                connection = wrap_server_socket(connection)
+                connection.sendall(connection.recv(1))
+            except OSError:
+                pass
+            finally:
+                connection.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield sock.getsockname()[1]
+    stopped.set()
+    thread.join(5)
+    sock.close()
+
+
+def exchange(port):
+    connection = connect('127.0.0.1', port, timeout=5)
+    connection.sendall(b'x')
+    assert connection.recv(1) == b'x'
+    release(connection)
+
+
+def differences(before):
+    after = tls_statistics()
+    return {role: {count: after[role][count] - before[role][count] for count in ('handshakes', 'resumed')}
+            for role in after}
+
+
+def test_reconnections_resume_the_session(echo):
+    before = tls_statistics()
+    for _ in range(4):
+        exchange(echo)
+    assert differences(before) == {'client': {'handshakes': 4, 'resumed': 3},
+                                   'server': {'handshakes': 4, 'resumed': 3}}
+
+
+@pytest.mark.skipif(not ssl.HAS_TLSv1_3, reason='the ticket arrives with the handshake before TLS 1.3')
+def test_the_ticket_is_kept_once_data_arrived(echo):
+    before = tls_statistics()
+    # with TLS 1.3 the ticket arrives after the handshake, a connection closed before reading leaves none
+    connection = connect('127.0.0.1', echo, timeout=5)
+    connection.close()
+    exchange(echo)
+    exchange(echo)
+    assert differences(before)['client'] == {'handshakes': 3, 'resumed': 1}
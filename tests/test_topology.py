@@ -0,0 +1,39 @@
+import pytest
+from layers.communication.topology import assign
+
+
+def test_star_without_aggregators():
+    tree = assign('chief', [], ['worker1', 'worker2', 'worker3'])
+    assert tree['chief'] == {'parent': None, 'children': ['worker1', 'worker2', 'worker3'], 'level': 0}
+    assert all(tree[name] == {'parent': 'chief', 'children': [], 'level': 1}
+               for name in ['worker1', 'worker2', 'worker3'])
+
+
+def test_workers_are_split_among_the_aggregators():
+    tree = assign('chief', ['aggregator1', 'aggregator2'], ['worker{}'.format(i) for i in range(1, 6)])
+    assert tree['chief']['children'] == ['aggregator1', 'aggregator2']
+    assert tree['aggregator1']['children'] == ['worker1', 'worker2', 'worker3']
+    assert tree['aggregator2']['children'] == ['worker4', 'worker5']
+    assert tree['worker5'] == {'parent': 'aggregator2', 'children': [], 'level': 2}
+
+
+def test_fanout():
+    aggregators = ['aggregator{}'.format(i) for i in range(1, 4)]
+    workers = ['worker{}'.format(i) for i in range(1, 9)]
+    tree = assign('chief', aggregators, workers, fanout=2)
+    assert len(tree) == 12
+    # the last aggregator takes the workers that do not fit in the tree
+    assert all(len(node['children']) <= 2 for name, node in tree.items() if name != 'aggregator3')
+    assert tree['aggregator3']['children'] == ['worker4', 'worker5', 'worker6', 'worker7', 'worker8']
+    assert tree['chief']['children'] == ['aggregator1', 'aggregator2']
+    assert tree['aggregator3']['level'] == 2
+    # every node reaches the chief
+    for name in workers:
+        while tree[name]['parent'] is not None:
+            name = tree[name]['parent']
+        assert name == 'chief'
+
+
+def test_invalid_fanout():
+    with pytest.raises(ValueError):
+        assign('chief', [], ['worker1'], fanout=0)
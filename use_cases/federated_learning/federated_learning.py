@@ -4,6 +4,12 @@
 from use_cases.federated_learning.Mode_Detection_CNN import *
 # Custom federated hook
 from layers.communication.federated_hook import _FederatedHook
+# Endpoints of the nodes published in the BSMD
+from layers.communication.peer_directory import PeerDirectory, publish_endpoint
+# Quantization of the weights exchanged in every round
+from layers.communication.quantization import QUANTIZATION_MODES
+# Sparse updates of the workers
+from layers.communication.sparsification import SPARSIFICATION_MODES
 # Helper libraries
 import os
 import numpy as np
@@ -13,8 +19,8 @@ import tensorflow as tf
 BATCH_SIZE = 16
 EPOCHS = 250
 INTERVAL_STEPS = 1  # Steps between averages
-WAIT_TIME = 15  # How many seconds to wait for new workers to connect
-CHIEF_PUBLIC_IP = 'localhost:7777'  # Public IP of the chief worker
+WAIT_TIME = 15  # How many seconds to wait at most for new workers to connect
+CHIEF_PUBLIC_IP = 'localhost:7777'  # Public IP of the chief worker, published in the BSMD
 CHIEF_PRIVATE_IP = 'localhost:7777'  # Private IP of the chief worker
 
 flags = tf.app.flags
@@ -26,6 +32,25 @@ flags.DEFINE_string("ip", None, "ip address for connecting to the BSMD")
 flags.DEFINE_string("private_key", None, "private ket of the node")
 flags.DEFINE_string("file_X", None, "X information file of the node")
 flags.DEFINE_string("file_Y", None, "Y information file of the node")
+flags.DEFINE_string("chief_name", "chief", "name of the chief node in the BSMD")
+flags.DEFINE_enum("quantization", "none", QUANTIZATION_MODES, "quantization of the weights exchanged in every round")
+flags.DEFINE_enum("sparsification", "none", SPARSIFICATION_MODES, "sparse updates sent by the workers")
+flags.DEFINE_string("aggregator_ip", None, "ip:port in which the node aggregates other workers, if it is an aggregator")
+flags.DEFINE_integer("fanout", None, "chief only, maximum number of children of the chief and of every aggregator")
+flags.DEFINE_enum("synchronization", "star", ["star", "ring", "async"],
+                  "average through the chief, with a ring all-reduce or asynchronously")
+flags.DEFINE_string("peer_ip", None, "ip:port in which the node accepts the previous node of the ring")
+flags.DEFINE_integer("max_staleness", None, "chief only, versions after which the weights of a worker are discarded")
+flags.DEFINE_boolean("adaptive_interval", False, "adapt the steps between two synchronizations to the divergence of "
+                                                 "the nodes and the communication time")
+flags.DEFINE_integer("min_interval_steps", None, "minimum steps between two synchronizations with adaptive_interval")
+flags.DEFINE_integer("max_interval_steps", None, "maximum steps between two synchronizations with adaptive_interval")
+flags.DEFINE_string("checkpoint", None, "chief only, path in which the chief keeps its round state to be started again")
+flags.DEFINE_integer("quorum", None, "chief only, workers after which the training starts without waiting for the rest")
+flags.DEFINE_string("metrics", None, "path of the JSONL file in which the metrics of every round are written")
+flags.DEFINE_integer("metrics_port", None, "port in which the metrics of the rounds are offered to Prometheus")
+flags.DEFINE_boolean("shared_memory", True, "send the weights to the nodes on the same host through shared memory")
+flags.DEFINE_boolean("flat", False, "exchange the weights as a single float32 vector of all the variables")
 
 # Disable GPU for all workers in local testing.
 # Enable it when testing in different computers
@@ -36,8 +61,23 @@ FLAGS = flags.FLAGS
 
 list_of_workers = ['worker1', 'worker2', 'worker3', 'worker4', 'worker5', 'worker6', 'worker7', 'worker8', 'worker9']
 
+# The chief publishes its endpoint and the workers resolve it from the BSMD
+if FLAGS.is_chief:
+    publish_endpoint(FLAGS.name, FLAGS.private_key, *CHIEF_PUBLIC_IP.split(':'), FLAGS.domain, FLAGS.ip)
+else:
+    directory = PeerDirectory(FLAGS.name, FLAGS.private_key, FLAGS.domain, FLAGS.ip)
+    CHIEF_PUBLIC_IP = directory.resolve_address(FLAGS.chief_name)
+
 federated_hook = _FederatedHook(FLAGS.is_chief, FLAGS.name, CHIEF_PRIVATE_IP, CHIEF_PUBLIC_IP, FLAGS.private_key,
-                                list_of_workers, FLAGS.domain, FLAGS.ip, WAIT_TIME, INTERVAL_STEPS)
+                                list_of_workers, FLAGS.domain, FLAGS.ip, wait_time=WAIT_TIME,
+                                interval_steps=INTERVAL_STEPS, quantization=FLAGS.quantization,
+                                sparsification=FLAGS.sparsification, aggregator_ip=FLAGS.aggregator_ip,
+                                fanout=FLAGS.fanout, synchronization=FLAGS.synchronization, peer_ip=FLAGS.peer_ip,
+                                max_staleness=FLAGS.max_staleness, adaptive_interval=FLAGS.adaptive_interval,
+                                min_interval_steps=FLAGS.min_interval_steps,
+                                max_interval_steps=FLAGS.max_interval_steps, checkpoint=FLAGS.checkpoint,
+                                quorum=FLAGS.quorum, metrics=FLAGS.metrics, metrics_port=FLAGS.metrics_port,
+                                shared_memory=FLAGS.shared_memory, flat=FLAGS.flat)
 
 # parameters definition
 num_channels_ensemble = [5]
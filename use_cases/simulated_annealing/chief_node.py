@@ -4,22 +4,26 @@ import random
 import json
 from math import exp, log
 from utils.iroha import set_detail_to_node, get_a_detail_written_by
+from layers.communication.peer_directory import PeerDirectory
 from absl import flags
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('name', None, 'Your name')
 flags.DEFINE_string('private_key', None, 'Your private key to sign transactions')
+flags.DEFINE_string('domain', None, 'Name of the domain')
+flags.DEFINE_string('ip', None, 'Ip address for connecting to the BSMD')
 
 # Connect to the working nodes
 workers_proxies = []
-# List all ports for connecting
-ports = [9990, 9991, 9993, 9994]
 # type the names of all workers
 workers = ['worker1', 'worker2', 'worker3', 'worker4']
+# The endpoints of the workers are published in the BSMD
+directory = PeerDirectory(FLAGS.name, FLAGS.private_key, FLAGS.domain, FLAGS.ip)
 
 # Get the proxies of all workers
-for port in ports:
-    worker_proxy = rpyc.connect('localhost', port, config={'allow_public_attrs': True})
+for worker in workers:
+    host, port = directory.resolve(worker)
+    worker_proxy = rpyc.connect(host, port, config={'allow_public_attrs': True})
     workers_proxies.append(worker_proxy)
 
 
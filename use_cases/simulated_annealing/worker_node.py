@@ -4,12 +4,16 @@ import csv
 import json
 from absl import flags
 from utils.iroha import get_a_detail_written_by, set_detail_to_node
+from layers.communication.peer_directory import publish_endpoint
 from rpyc.utils.server import ThreadedServer
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('name', None, 'Your name')
 flags.DEFINE_string('private_key', None, 'Your private key to sign transactions')
 flags.DEFINE_string('port', None, 'The port for listening the transactions')
+flags.DEFINE_string('host', 'localhost', 'The host where the chief can reach this worker')
+flags.DEFINE_string('domain', None, 'Name of the domain')
+flags.DEFINE_string('ip', None, 'Ip address for connecting to the BSMD')
 
 
 class RunNode(rpyc.Service):
@@ -47,7 +51,9 @@ class RunNode(rpyc.Service):
         set_detail_to_node(FLAGS.name, writer, FLAGS.private_key, 'cost', cost, domain, ip)
 
 
-t = ThreadedServer(RunNode, FLAGS.port)
+# Let the chief find this worker in the BSMD
+publish_endpoint(FLAGS.name, FLAGS.private_key, FLAGS.host, FLAGS.port, FLAGS.domain, FLAGS.ip)
+t = ThreadedServer(RunNode, port=int(FLAGS.port))
 t.start()
 
 
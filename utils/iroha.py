@@ -84,6 +84,37 @@ def set_detail_to_node(sender, receiver, private_key, detail_key, detail_value,
     send_transaction_and_print_status(tx, network)
 
 
+def set_details_to_nodes(sender, private_key, details, domain, ip):
+    """
+    Set several details, possibly of different nodes, in a single transaction. The sender must have permission to
+    write in the details of all the receivers.
+
+    :Example:
+    >>> set_details_to_nodes('David', 'private key of david', [('Juan', 'key', 'value'), ('Ana', 'key', 'value')], \
+    'domain', 'ip')
+
+    :param str sender: Name of the node sending the information
+    :param str private_key: Private key of the user
+    :param list details: (receiver, detail key, detail value) of every detail
+    :param str domain: Name of the domain
+    :param str ip: address for connecting to the BSMD
+
+    """
+    account = sender + '@' + domain
+    iroha = Iroha(account)
+    ip_address = ip + ':50051'
+    network = IrohaGrpc(ip_address)
+    tx = iroha.transaction([
+        iroha.command('SetAccountDetail',
+                      account_id=receiver + '@' + domain,
+                      key=detail_key,
+                      value=detail_value)
+        for receiver, detail_key, detail_value in details
+    ])
+    IrohaCrypto.sign_transaction(tx, private_key)
+    send_transaction_and_print_status(tx, network)
+
+
 def get_a_detail_written_by(name, writer, private_key, detail_key, domain, ip):
     """
     This function can be use when the User object is no available. Consult a details of the node writen by other node
@@ -122,3 +153,43 @@ def get_a_detail_written_by(name, writer, private_key, detail_key, domain, ip):
     data = response.account_detail_response
     print('Account id = {}, details = {}'.format(account_id, data.detail))
     return data.detail
+
+
+def get_a_detail_from_node(name, node, private_key, detail_key, domain, ip, node_domain=None):
+    """
+    This function can be use when the User object is no available. Consult a detail that a node wrote in its own
+    account, e.g., the p2p endpoint published by the node. The role of the consulting node must have the
+    can_get_domain_acc_detail permission
+
+    :Example:
+    >>> endpoint = get_a_detail_from_node('David', 'Juan', 'private key of david', 'p2p_endpoint', 'domain', 'ip')
+    >>> print(endpoint)
+    {
+        "Juan@domain":{
+        "p2p_endpoint":"123.456.789:5555"
+    }
+
+    :param str name: Name of the node consulting the information
+    :param str node: Name of the node who owns and wrote the detail
+    :param str private_key: Private key of the user
+    :param str detail_key: Name of the detail we want to consult
+    :param str domain: Name of the domain of the node consulting the information
+    :param str ip: Address for connecting to the BSMD
+    :param str,optional node_domain: Name of the domain of the node who owns the detail, the same domain by default
+    :return: returns the detail writen by the node in its own account
+    :rtype: json
+
+    """
+    account_id = name + '@' + domain
+    node_id = node + '@' + (node_domain or domain)
+    iroha = Iroha(account_id)
+    ip_address = ip + ':50051'
+    network = IrohaGrpc(ip_address)
+    query = iroha.query('GetAccountDetail',
+                        account_id=node_id,
+                        key=detail_key,
+                        writer=node_id)
+    IrohaCrypto.sign_query(query, private_key)
+    response = network.send_query(query)
+    data = response.account_detail_response
+    return data.detail